@@ -1,25 +1,295 @@
+import abc
 import json
 import collections
-from flask import Flask, request, jsonify, Response
-from flask_sqlalchemy import SQLAlchemy
+import glob
+import hashlib
+import os
+import queue
+import sqlite3
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+import msgpack
+from urllib.request import pathname2url
+from flask import Flask, Request, g, has_request_context, request, jsonify, Response, send_from_directory
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 from sqlalchemy.engine import Engine
-from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy import create_engine, event, func, and_, or_
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import object_session, sessionmaker
+from sqlalchemy.pool import Pool, QueuePool
+from werkzeug.exceptions import NotFound
 from flask_restful import Resource
 from flask_restful import Api
 from jsonschema import validate, ValidationError
 from sqlite3 import Connection as SQLite3Connection
 from flask_cors import CORS
 
+# Brotli is optional, without it the responses are only compressed with gzip.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# gevent is optional. The gevent workers of gunicorn (see gunicorn_gevent.py) patch the standard library
+# before they import the application, so its threads, locks and queues are cooperative greenlets.
+try:
+    from gevent import monkey
+except ImportError:
+    monkey = None
+
 # Configuring the application.
 app = Flask("SurveyPWP")
 api = Api(app)
-cors = CORS(app, expose_headers='Location')
+cors = CORS(app, expose_headers=['Location', 'X-Total-Count'])
 
-# Setting up the database.
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///database.db"
+# Setting up the database. The GET requests read through a pool of SQLITE_READ_CONNECTIONS read-only
+# connections, and the other requests use the one writer connection, see RoutingSQLAlchemy. With 0
+# every request uses the default engine.
+app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("SURVEY_DATABASE_URI", "sqlite:///database.db")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-db = SQLAlchemy(app)
+app.config["SQLITE_READ_CONNECTIONS"] = 8
+
+# Configuring the storage of the questionnaires, questions and answers: "sql" for the database, or
+# "memory" for the MemoryRepository of the worker, which keeps nothing when the worker stops.
+app.config["STORAGE_BACKEND"] = os.environ.get("SURVEY_STORAGE_BACKEND", "sql")
+
+# Configuring the sharding of the questionnaires. With a list of database URIs (separated by spaces in
+# SURVEY_SHARD_URIS), the questions and answers of each questionnaire are stored in the shard of its id,
+# and the main database is the catalog of the questionnaires and the jobs. Each shard is written by its
+# own writer, so the writes to different questionnaires do not wait for each other. The mapping is the
+# id modulo the number of shards, so the list can not be changed once it has data.
+app.config["SHARD_URIS"] = os.environ.get("SURVEY_SHARD_URIS", "").split()
+
+
+class RoutingSession(SignallingSession):
+    """
+    A session which runs the GET and HEAD requests on the read engine of RoutingSQLAlchemy and
+    everything else on its write engine. A GET request which has to write marks its session with
+    use_writer before its first query.
+
+    With shards, the jobs and the queries without a questionnaire go to the catalog, and the others to
+    the shard of the questionnaire in the URL of the request, or of the routed_to block around them.
+    """
+    READ_METHODS = ("GET", "HEAD")
+
+    # The tables which are only in the catalog.
+    CATALOG_TABLES = ("job",)
+
+    def __init__(self, db, **options):
+        self.db = db
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        shard = None
+        if mapper is None or mapper.local_table.name not in self.CATALOG_TABLES:
+            shard = self.routed_shard()
+        read_engine, write_engine = self.db.get_engines(shard)
+        if has_request_context() and request.method in self.READ_METHODS and not self.info.get("writer"):
+            return read_engine
+        return write_engine
+
+    def routed_shard(self):
+        """
+        Returns the index of the shard which the session works on, or None for the catalog.
+        """
+        if "shard" in self.info:
+            return self.info["shard"]
+        if has_request_context() and request.view_args:
+            questionnaire_id = request.view_args.get("questionnaire_id")
+            if questionnaire_id is None and request.endpoint == "questionnaireitem":
+                questionnaire_id = request.view_args.get("id")
+            return self.db.shard_of(questionnaire_id)
+        return None
+
+
+def use_writer(session):
+    """
+    Routes the queries of the session to the write engine until the session is removed.
+    """
+    session.info["writer"] = True
+
+
+@contextmanager
+def routed_to(shard):
+    """
+    Routes the queries of the session to the shard with the given index, or to the catalog with None,
+    inside the block.
+    """
+    info = db.session().info
+    previous = info.get("shard", routed_to)
+    info["shard"] = shard
+    try:
+        yield
+    finally:
+        if previous is routed_to:
+            del info["shard"]
+        else:
+            info["shard"] = previous
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """
+    Flask-SQLAlchemy with separate read and write engines for a SQLite file. The write engine has one
+    connection, so the writers of a worker wait for each other in the pool instead of in SQLite. The
+    read engine is a pool of read-only connections (mode=ro and query_only). The database is in WAL
+    mode, so the readers do not block the writer, the writer does not block the readers, and the
+    readers see the last committed data.
+
+    The shards of SHARD_URIS have engines of their own, the main database is the catalog.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.routing_lock = threading.Lock()
+        self.routed_for = None
+        self.routed_engines = {}
+        SQLAlchemy.__init__(self, *args, **kwargs)
+
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def shard_count(self):
+        return len(self.get_app().config["SHARD_URIS"])
+
+    def shard_of(self, questionnaire_id):
+        """
+        Returns the index of the shard of a questionnaire, or None if the questionnaires are not sharded or
+        the id is not valid.
+        """
+        count = self.shard_count()
+        try:
+            return int(questionnaire_id) % count if count else None
+        except (TypeError, ValueError):
+            return None
+
+    def get_engines(self, shard=None):
+        """
+        Returns the read and the write engine of the catalog, or of the shard with the given index. They
+        are the same engine if the requests are not routed. The engines are created on their first use,
+        and created again when the configuration changes. The tables of a shard are created with its
+        engines.
+        """
+        config = self.get_app().config
+        key = (str(self.engine.url), tuple(config["SHARD_URIS"]), config["SQLITE_READ_CONNECTIONS"])
+        with self.routing_lock:
+            if self.routed_for != key:
+                self.dispose_engines()
+                self.routed_for = key
+            if shard not in self.routed_engines:
+                if shard is None:
+                    self.routed_engines[shard] = self.create_engines(self.engine.url, self.engine)
+                else:
+                    engines = self.create_engines(make_url(config["SHARD_URIS"][shard]))
+                    self.Model.metadata.create_all(bind=engines[1])
+                    self.routed_engines[shard] = engines
+            return self.routed_engines[shard]
+
+    def create_engines(self, url, default=None):
+        """
+        Returns the read and the write engine of the database at the URL. The default engine, or a new
+        one, is both if the database is not a SQLite file or the reads are not routed. A SQLite file is
+        put in WAL mode here in both cases, so the snapshots do not block the writer.
+        """
+        size = self.get_app().config["SQLITE_READ_CONNECTIONS"]
+        if url.drivername != "sqlite" or url.database in (None, "", ":memory:"):
+            engine = default or create_engine(url)
+            return engine, engine
+        if not size:
+            engine = default or create_engine(url)
+            engine.execute("PRAGMA journal_mode=WAL")
+            return engine, engine
+
+        write_engine = create_engine(url, poolclass=QueuePool, pool_size=1, max_overflow=0,
+                                     connect_args={"check_same_thread": False})
+        write_engine.execute("PRAGMA journal_mode=WAL")
+        path = "file:{}?mode=ro".format(pathname2url(os.path.abspath(url.database)))
+        read_engine = create_engine("sqlite://", creator=lambda: self.connect_read_only(path),
+                                    poolclass=QueuePool, pool_size=size, max_overflow=0)
+        return read_engine, write_engine
+
+    @contextmanager
+    def snapshot(self, shard=None):
+        """
+        Yields a connection which reads one snapshot of the catalog, or of the shard with the given index,
+        while the session goes on committing. It is a connection of the read engine, in a transaction of
+        its own. The SQLite file is in WAL mode, so the snapshot does not block the commits.
+        """
+        read_engine, write_engine = self.get_engines(shard)
+        connection = read_engine.connect()
+        try:
+            # pysqlite does not begin a transaction for a SELECT.
+            if write_engine.url.drivername == "sqlite" and write_engine.url.database not in (None, "", ":memory:"):
+                connection.execute("BEGIN")
+            yield connection
+        finally:
+            connection.close()
+
+    def dispose_engines(self):
+        """
+        Closes the connections of the routed engines, which are created again on their next use.
+        """
+        for engines in self.routed_engines.values():
+            for engine in set(engines):
+                if engine is not self.engine:
+                    engine.dispose()
+        self.routed_engines = {}
+
+    @staticmethod
+    def connect_read_only(path):
+        connection = sqlite3.connect(path, uri=True, check_same_thread=False)
+        connection.execute("PRAGMA query_only=1")
+        return connection
+
+
+db = RoutingSQLAlchemy(app)
+
+# Configuring the cooperative locking of SQLite, which is enabled under gevent. SQLite waits for the lock
+# of the database in C, which would block every greenlet of the worker, including the one holding the
+# lock. With cooperative locking the database is in WAL mode, so the readers never wait for the writer,
+# and the writers of one worker wait for each other on a lock of the worker, which lets the others run.
+app.config["SQLITE_COOPERATIVE_LOCKING"] = monkey is not None and monkey.is_module_patched("threading")
+
+# Configuring the response compression. Bodies smaller than the minimum size are sent as they are,
+# since compressing them costs more CPU than it saves bytes.
+app.config["COMPRESS_MIN_SIZE"] = 512
+app.config["COMPRESS_GZIP_LEVEL"] = 6
+app.config["COMPRESS_BROTLI_LEVEL"] = 5
+app.config["COMPRESS_CACHE_SIZE"] = 256
+
+# Configuring the coalescing of the identical GET requests. A request waits at most this many seconds
+# for the response of the identical request which is running before it computes its own.
+app.config["COALESCE_REQUESTS"] = True
+app.config["COALESCE_TIMEOUT"] = 10
+
+# Configuring the live streams of answers. A comment is sent to idle streams every heartbeat seconds
+# so proxies keep them open, and a subscriber which falls behind by more than the queue size is
+# disconnected. It can resume from its last event id.
+app.config["SSE_HEARTBEAT"] = 15
+app.config["SSE_QUEUE_SIZE"] = 256
+
+# Configuring the background jobs. The job table is the queue, and at most JOB_WORKERS jobs run at
+# once in each worker process. A running job which has not reported progress for JOB_STALE_AFTER
+# seconds is considered crashed, and is run again when the application starts. A failed job of the
+# required kinds is run again after JOB_RETRY_DELAY seconds, doubled after each attempt, until it has
+# been run JOB_MAX_ATTEMPTS times.
+app.config["JOB_WORKERS"] = 2
+app.config["JOB_STALE_AFTER"] = 300
+app.config["JOB_RETRY_DELAY"] = 30
+app.config["JOB_MAX_ATTEMPTS"] = 5
+app.config["EXPORT_FOLDER"] = os.path.join(app.instance_path, "exports")
+
+# Configuring the published documents of the questionnaires. They never change once written, so the
+# clients and the proxies can keep them for PUBLISH_MAX_AGE seconds.
+app.config["PUBLISH_FOLDER"] = os.path.join(app.instance_path, "published")
+app.config["PUBLISH_MAX_AGE"] = 365 * 24 * 3600
+
+# Configuring the purge of the deleted questionnaires. Each transaction of the purge deletes at most
+# this many rows, so the other writers wait for the write lock only briefly.
+app.config["PURGE_BATCH_SIZE"] = 500
 
 # Defining the profiles that are used in our API.
 QUESTIONNAIRE_PROFILE = "/profiles/questionnaire/"
@@ -27,7 +297,35 @@ QUESTION_PROFILE = "/profiles/question/"
 ANSWER_PROFILE = "/profiles/answer/"
 LINK_RELATIONS_URL = "/survey/link-relations/"
 ERROR_PROFILE = "/profiles/error/"
+COMPACT_PROFILE = "/profiles/compact/"
 MASON = "application/vnd.mason+json"
+MASON_MSGPACK = "application/vnd.mason+msgpack"
+MSGPACK_TYPES = (MASON_MSGPACK, "application/msgpack", "application/x-msgpack")
+
+
+class MasonRequest(Request):
+    """
+    A request whose body can also be encoded with MessagePack. The decoded body is returned by
+    get_json, so the resources read it from request.json the same way as a JSON body.
+    """
+
+    def get_json(self, force=False, silent=False, cache=True):
+        if self.mimetype not in MSGPACK_TYPES:
+            return super(MasonRequest, self).get_json(force=force, silent=silent, cache=cache)
+        if cache and hasattr(self, "_cached_msgpack"):
+            return self._cached_msgpack
+        try:
+            data = msgpack.unpackb(self.get_data(cache=cache), raw=False)
+        except ValueError as e:
+            if silent:
+                return None
+            return self.on_json_loading_failed(e)
+        if cache:
+            self._cached_msgpack = data
+        return data
+
+
+app.request_class = MasonRequest
 
 
 # Enforcing foreign key constraints which needs a manual configuration.
@@ -36,9 +334,70 @@ MASON = "application/vnd.mason+json"
 def set_sqlite_pragma(dbapi_connection, connection_record):
     cursor = dbapi_connection.cursor()
     cursor.execute("PRAGMA foreign_keys=ON")
+    if app.config["SQLITE_COOPERATIVE_LOCKING"]:
+        cursor.execute("PRAGMA journal_mode=WAL")
     cursor.close()
 
 
+class WriterLock(object):
+    """
+    The locks which a connection holds from its first write until the end of its transaction, when the
+    cooperative locking is enabled. SQLite allows one writer at a time anyway, so the writers of the
+    worker wait for each other here instead of in SQLite. There is one lock for each database file, so
+    the writers of different shards do not wait for each other. The locks are threading.Locks, which are
+    greenlet locks under gevent.
+    """
+    WRITES = ("INSERT", "UPDATE", "DELETE", "REPLACE")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.locks = {}
+        self.acquisitions = 0
+        self.waits = 0
+
+    def acquire(self, connection_info, database):
+        if connection_info.get("writer"):
+            return
+        with self.lock:
+            lock = self.locks.setdefault(database, threading.Lock())
+        if not lock.acquire(False):
+            self.waits += 1
+            lock.acquire()
+        self.acquisitions += 1
+        connection_info["writer"] = lock
+
+    def release(self, connection_info):
+        lock = connection_info.pop("writer", None)
+        if lock is not None:
+            lock.release()
+
+    def stats(self):
+        return {"acquisitions": self.acquisitions, "waits": self.waits}
+
+
+writer_lock = WriterLock()
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def acquire_writer_lock(conn, cursor, statement, parameters, context, executemany):
+    if app.config["SQLITE_COOPERATIVE_LOCKING"] and statement.lstrip().upper().startswith(WriterLock.WRITES):
+        writer_lock.acquire(conn.info, conn.engine.url.database)
+
+
+# The lock is released just before the commit or the rollback, which runs right after it without
+# letting another greenlet run. A connection which returns to the pool in a transaction is rolled back.
+@event.listens_for(Engine, "commit")
+@event.listens_for(Engine, "rollback")
+def release_writer_lock(conn):
+    writer_lock.release(conn.info)
+
+
+@event.listens_for(Pool, "checkin")
+def release_returned_writer_lock(dbapi_connection, connection_record):
+    if connection_record is not None:
+        writer_lock.release(connection_record.info)
+
+
 class Questionnaire(db.Model):
     """
     Table : Questionnaire
@@ -48,12 +407,27 @@ class Questionnaire(db.Model):
     - 'id', INTEGER, PRIMARY KEY, Contains id of each questionnaire.
     - 'title', STRING, MAX 64 Characters, NOT NULL, Contains the title of each questionnaire.
     - 'description', STRING, MAX 512 Characters, NULLABLE, Contains the description of each questionnaire.
+    - 'deleted', BOOLEAN, NOT NULL, Tells that the questionnaire is deleted. It is hidden from the API
+      until the purge job has removed it with its questions and answers.
+    - 'archived', BOOLEAN, NOT NULL, Tells that the questions and answers of the questionnaire are in
+      its archive instead of the question and answer tables. They are read-only.
+    - 'published_version', INTEGER, NULLABLE, Contains the version of the published document of the
+      questionnaire, or NULL if it has not been published.
+    - 'question_count', INTEGER, NOT NULL, Contains the number of questions of the questionnaire.
+    - 'answer_count', INTEGER, NOT NULL, Contains the number of answers to the questions of the questionnaire.
+      Both counts are kept by the triggers of the question and answer tables, and they keep their values
+      when the questions and answers are moved into the archive.
 
     * 'question', RELATIONSHIP with the Question table.
     """
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(64), nullable=False)
     description = db.Column(db.String(512), nullable=True)
+    deleted = db.Column(db.Boolean, nullable=False, default=False, index=True)
+    archived = db.Column(db.Boolean, nullable=False, default=False)
+    published_version = db.Column(db.Integer, nullable=True)
+    question_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    answer_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
 
     question = db.relationship("Question", back_populates="questionnaire", cascade="save-update, delete")
 
@@ -68,19 +442,81 @@ class Question(db.Model):
     - 'questionnaire_id', INTEGER, FOREIGN KEY, NOT NULL, Contains id of the questionnaire.
     - 'title', STRING, MAX 64 Characters, NOT NULL, Contains the title of each question.
     - 'description', STRING, MAX 512 Characters, NULLABLE, Contains the description of each question.
+    - 'position', FLOAT, NOT NULL, Contains the position of the question in its questionnaire. A new
+      question is placed last, and a moved question gets a position between its new neighbours, so
+      only the moved row changes.
+    - 'answer_count', INTEGER, NOT NULL, Contains the number of answers to the question, kept by the
+      triggers of the answer table.
 
     * 'questionnaire', RELATIONSHIP with the Questionnaire table.
     * 'answer', RELATIONSHIP with the Answer table.
     """
+    __table_args__ = (
+        db.Index("ix_question_questionnaire_position", "questionnaire_id", "position"),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     questionnaire_id = db.Column(db.Integer, db.ForeignKey("questionnaire.id"), nullable=False)
     title = db.Column(db.String(64), nullable=False)
     description = db.Column(db.String(512), nullable=True)
+    position = db.Column(db.Float, nullable=False, default=lambda context: next_question_position(
+        context.connection, context.get_current_parameters()["questionnaire_id"]))
+    answer_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
 
     questionnaire = db.relationship("Questionnaire", back_populates="question")
     answer = db.relationship("Answer", back_populates="question", cascade="save-update, delete")
 
 
+def next_question_position(connection, questionnaire_id):
+    """
+    Returns the position after the last question of a questionnaire, read from the end of the index
+    on (questionnaire_id, position).
+    """
+    last = connection.execute("SELECT max(position) FROM question WHERE questionnaire_id = ?",
+                              (questionnaire_id,)).scalar()
+    return (last or 0) + 1
+
+
+class User(db.Model):
+    """
+    Table : User
+    ----------------------
+    Description : This table stores all the users who have answered, so the answers refer to them by id.
+
+    - 'id', INTEGER, PRIMARY KEY, Contains id of each user.
+    - 'name', STRING, MAX 64 Characters, NOT NULL, UNIQUE, Contains the username of the user.
+
+    * 'answer', RELATIONSHIP with the Answer table.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64), nullable=False, unique=True)
+
+    answer = db.relationship("Answer", back_populates="user")
+
+    @staticmethod
+    def get_or_create(name):
+        """
+        Returns the user with the given name, which is created if it does not exist yet.
+        """
+        new_users = db.session.info.setdefault("new_users", {})
+        if name in new_users:
+            return new_users[name]
+        with db.session.no_autoflush:
+            user = User.query.filter_by(name=name).first()
+        if user is None:
+            user = new_users[name] = User(name=name)
+        return user
+
+
+@event.listens_for(db.session, "after_commit")
+@event.listens_for(db.session, "after_rollback")
+def forget_new_users(session):
+    """
+    The users created in a transaction are found by the queries after it.
+    """
+    session.info.pop("new_users", None)
+
+
 class Answer(db.Model):
     """
     Table : Answer
@@ -90,16 +526,606 @@ class Answer(db.Model):
     - 'id', INTEGER, PRIMARY KEY, Contains id of each answer.
     - 'question_id', INTEGER, FOREIGN KEY, NULLABLE, Contains id of the question.
     - 'content', STRING, MAX 512 Characters, NOT NULL, Contains the answer as a string.
-    - 'userName', STRING, MAX 64 Characters, NOT NULL, Contains the username of the user.
+    - 'user_id', INTEGER, FOREIGN KEY, NOT NULL, Contains id of the user who gave the answer.
 
     * 'question', RELATIONSHIP with the Question table.
+    * 'user', RELATIONSHIP with the User table. It is always loaded with the answer.
+    * 'userName', the name of the user, which is how the API represents the user of an answer.
+
+    A user has at most one answer to a question, which the unique index on (question_id, user_id)
+    enforces. It and the index on (question_id, content) serve the filters and the sort keys of the
+    answer collection, the index on question_id serves the sorting by id.
     """
+    __table_args__ = (
+        db.Index("ix_answer_question_user", "question_id", "user_id", unique=True),
+        db.Index("ix_answer_question_content", "question_id", "content"),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    question_id = db.Column(db.Integer, db.ForeignKey("question.id"), nullable=False)
+    question_id = db.Column(db.Integer, db.ForeignKey("question.id"), nullable=False, index=True)
     content = db.Column(db.String(512), nullable=False)
-    userName = db.Column(db.String(64), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
 
     question = db.relationship("Question", back_populates="answer")
+    user = db.relationship("User", back_populates="answer", lazy="joined")
+
+    @property
+    def userName(self):
+        return self.user.name if self.user is not None else None
+
+    @userName.setter
+    def userName(self, name):
+        if self.user is None or self.user.name != name:
+            self.user = User.get_or_create(name)
+
+
+class AnswerChange(db.Model):
+    """
+    Table : AnswerChange
+    ----------------------
+    Description : This table is an append-only log of the changes of the answers, used by the change feed.
+    The rows are written by triggers on the answer table, so every insert, update and delete is logged.
+
+    - 'seq', INTEGER, PRIMARY KEY AUTOINCREMENT, Contains the sequence number of each change. It only grows.
+    - 'questionnaire_id', INTEGER, NOT NULL, Contains id of the questionnaire of the changed answer.
+    - 'question_id', INTEGER, NOT NULL, Contains id of the question of the changed answer.
+    - 'answer_id', INTEGER, NOT NULL, Contains id of the changed answer.
+    - 'operation', STRING, MAX 6 Characters, NOT NULL, Contains the change: insert, update or delete.
+
+    The ids are not foreign keys, since the log keeps the changes of the deleted rows. The index on
+    (questionnaire_id, seq) serves the reads of the feed of one questionnaire.
+    """
+    __table_args__ = (
+        db.Index("ix_answer_change_questionnaire_seq", "questionnaire_id", "seq"),
+        {"sqlite_autoincrement": True},
+    )
+
+    seq = db.Column(db.Integer, primary_key=True)
+    questionnaire_id = db.Column(db.Integer, nullable=False)
+    question_id = db.Column(db.Integer, nullable=False)
+    answer_id = db.Column(db.Integer, nullable=False)
+    operation = db.Column(db.String(6), nullable=False)
+
+
+class Job(db.Model):
+    """
+    Table : Job
+    ----------------------
+    Description : This table stores the background jobs, and is also the queue of the jobs to run.
+
+    - 'id', INTEGER, PRIMARY KEY, Contains id of each job.
+    - 'kind', STRING, MAX 32 Characters, NOT NULL, Contains the kind of the job, one of JOB_KINDS.
+    - 'params', TEXT, NOT NULL, Contains the keyword arguments of the job as a JSON object.
+    - 'status', STRING, MAX 16 Characters, NOT NULL, Contains queued, running, done, failed or cancelled.
+    - 'progress', FLOAT, NOT NULL, Contains the done part of the job, from 0 to 1.
+    - 'result', STRING, MAX 256 Characters, NULLABLE, Contains the location of the result of a done job.
+    - 'error', STRING, MAX 512 Characters, NULLABLE, Contains the error of a failed job.
+    - 'cancel_requested', BOOLEAN, NOT NULL, Tells that the job should stop at its next progress report.
+    - 'updated', DATETIME, NOT NULL, Contains the time of the last change, which shows that a running job is alive.
+    - 'attempts', INTEGER, NOT NULL, Contains the number of times the job has been started.
+    - 'run_after', DATETIME, NULLABLE, Contains the time before which a queued job which is retried is not run.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(32), nullable=False)
+    params = db.Column(db.Text, nullable=False, default="{}")
+    status = db.Column(db.String(16), nullable=False, default="queued", index=True)
+    progress = db.Column(db.Float, nullable=False, default=0)
+    result = db.Column(db.String(256), nullable=True)
+    error = db.Column(db.String(512), nullable=True)
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    updated = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    run_after = db.Column(db.DateTime, nullable=True)
+
+
+class Archive(db.Model):
+    """
+    Table : Archive
+    ----------------------
+    Description : This table stores the questions and answers of the archived questionnaires, one
+    compressed row per questionnaire, so they do not grow the question and answer tables and their indexes.
+
+    - 'questionnaire_id', INTEGER, PRIMARY KEY, FOREIGN KEY, Contains id of the archived questionnaire.
+    - 'question_count', INTEGER, NOT NULL, Contains the number of archived questions.
+    - 'answer_count', INTEGER, NOT NULL, Contains the number of archived answers.
+    - 'data', BLOB, NOT NULL, Contains the questions and answers, packed with MessagePack and compressed with zlib.
+    """
+    questionnaire_id = db.Column(db.Integer, db.ForeignKey("questionnaire.id"), primary_key=True)
+    question_count = db.Column(db.Integer, nullable=False)
+    answer_count = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+
+    @staticmethod
+    def pack(questions, answers):
+        """
+        Returns the data of an archive. The questions are (id, title, description) rows in the order of
+        their positions, and the answers are (id, question_id, content, userName) rows in the order of
+        their ids.
+        """
+        return zlib.compress(msgpack.packb({
+            "questions": [list(row) for row in questions],
+            "answers": [list(row) for row in answers],
+        }, use_bin_type=True), 9)
+
+    def unpack(self):
+        return ArchiveContents(self.questionnaire_id, msgpack.unpackb(zlib.decompress(self.data), raw=False))
+
+
+class ArchiveContents(object):
+    """
+    The questions and answers of an archived questionnaire. They are read-only namedtuples with the
+    same attributes as the Question and Answer instances, so the resources can render either one.
+    """
+    Question = collections.namedtuple(
+        "ArchivedQuestion", ["id", "questionnaire_id", "title", "description", "answer_count"])
+    Answer = collections.namedtuple("ArchivedAnswer", ["id", "question_id", "content", "userName"])
+
+    def __init__(self, questionnaire_id, data):
+        self.answers = [self.Answer(*row) for row in data["answers"]]
+        answer_counts = collections.Counter(answer.question_id for answer in self.answers)
+        self.questions = collections.OrderedDict(
+            (row[0], self.Question(row[0], questionnaire_id, row[1], row[2], answer_counts[row[0]]))
+            for row in data["questions"])
+
+    def question(self, id):
+        try:
+            return self.questions.get(int(id))
+        except (TypeError, ValueError):
+            return None
+
+    def answers_to(self, question_id):
+        return [answer for answer in self.answers if answer.question_id == int(question_id)]
+
+    def answer(self, question_id, id):
+        try:
+            id = int(id)
+        except (TypeError, ValueError):
+            return None
+        for answer in self.answers_to(question_id):
+            if answer.id == id:
+                return answer
+        return None
+
+
+# Full-text indexes. Each FTS5 table is an external content table over the indexed columns of one
+# model table, so the text is not stored twice. The triggers keep the index in sync with every
+# insert, update and delete, including the ones which do not go through the ORM.
+FTS_TABLES = {
+    "questionnaire_fts": ("questionnaire", ["title", "description"]),
+    "question_fts": ("question", ["title", "description"]),
+    "answer_fts": ("answer", ["content"]),
+}
+
+
+def _fts_ddl(fts_table, table, columns):
+    """
+    Returns the statements creating one FTS5 table and the triggers keeping it in sync.
+    """
+    names = ", ".join(columns)
+    new_values = ", ".join("new." + column for column in columns)
+    old_values = ", ".join("old." + column for column in columns)
+    insert = "INSERT INTO {0}(rowid, {1}) VALUES (new.id, {2});".format(fts_table, names, new_values)
+    delete = "INSERT INTO {0}({0}, rowid, {1}) VALUES ('delete', old.id, {2});".format(fts_table, names, old_values)
+    return [
+        "CREATE VIRTUAL TABLE {} USING fts5({}, content='{}', content_rowid='id')".format(fts_table, names, table),
+        "CREATE TRIGGER IF NOT EXISTS {0}_ai AFTER INSERT ON {1} BEGIN {2} END".format(fts_table, table, insert),
+        "CREATE TRIGGER IF NOT EXISTS {0}_ad AFTER DELETE ON {1} BEGIN {2} END".format(fts_table, table, delete),
+        _fts_update_trigger(fts_table, table, columns),
+        # Indexes the rows which existed before the full-text table.
+        "INSERT INTO {0}({0}) VALUES ('rebuild')".format(fts_table),
+    ]
+
+
+def _fts_update_trigger(fts_table, table, columns):
+    """
+    Returns the statement creating the trigger which indexes the changed rows again. It only fires when
+    an indexed column changes, not when the position or the counters of a row do.
+    """
+    names = ", ".join(columns)
+    insert = "INSERT INTO {0}(rowid, {1}) VALUES (new.id, {2});".format(
+        fts_table, names, ", ".join("new." + column for column in columns))
+    delete = "INSERT INTO {0}({0}, rowid, {1}) VALUES ('delete', old.id, {2});".format(
+        fts_table, names, ", ".join("old." + column for column in columns))
+    return "CREATE TRIGGER IF NOT EXISTS {0}_au AFTER UPDATE OF {1} ON {2} BEGIN {3} {4} END".format(
+        fts_table, names, table, delete, insert)
+
+
+@event.listens_for(db.Model.metadata, "after_create")
+def create_fts_tables(target, connection, **kw):
+    """
+    Creates the missing full-text tables every time the tables are created.
+    """
+    if connection.dialect.name != "sqlite":
+        return
+    for fts_table, (table, columns) in FTS_TABLES.items():
+        exists = connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                    (fts_table,)).scalar()
+        if not exists:
+            for statement in _fts_ddl(fts_table, table, columns):
+                connection.execute(statement)
+
+
+def _answer_change_trigger(event_name, row):
+    """
+    Returns the statement creating the trigger which logs one kind of change of the answers. The
+    questionnaire is looked up from the question, which still exists when an answer is deleted. The
+    answers which are deleted because they were moved into the archive are not logged.
+    """
+    return ("CREATE TRIGGER IF NOT EXISTS answer_change_{0} AFTER {1} ON answer BEGIN "
+            "INSERT INTO answer_change(questionnaire_id, question_id, answer_id, operation) "
+            "SELECT question.questionnaire_id, {2}.question_id, {2}.id, '{0}' FROM question "
+            "JOIN questionnaire ON questionnaire.id = question.questionnaire_id "
+            "WHERE question.id = {2}.question_id AND NOT questionnaire.archived; "
+            "END").format(event_name.lower(), event_name, row)
+
+
+@event.listens_for(db.Model.metadata, "after_create")
+def create_answer_change_triggers(target, connection, **kw):
+    """
+    Creates the missing triggers of the answer change log every time the tables are created.
+    """
+    if connection.dialect.name != "sqlite":
+        return
+    for event_name, row in [("INSERT", "new"), ("UPDATE", "new"), ("DELETE", "old")]:
+        connection.execute(_answer_change_trigger(event_name, row))
+
+
+# The counters of the questions and answers. The questionnaire of an answer is looked up from its
+# question, which still exists when the answer is deleted. The deletes of the rows which are moved into
+# the archive do not change the counts of the questionnaire.
+COUNTER_TRIGGERS = {
+    "question_count_insert": "AFTER INSERT ON question BEGIN "
+                             "UPDATE questionnaire SET question_count = question_count + 1 "
+                             "WHERE id = new.questionnaire_id; END",
+    "question_count_delete": "AFTER DELETE ON question BEGIN "
+                             "UPDATE questionnaire SET question_count = question_count - 1 "
+                             "WHERE id = old.questionnaire_id AND NOT archived; END",
+    "answer_count_insert": "AFTER INSERT ON answer BEGIN "
+                           "UPDATE question SET answer_count = answer_count + 1 WHERE id = new.question_id; "
+                           "UPDATE questionnaire SET answer_count = answer_count + 1 "
+                           "WHERE id = (SELECT questionnaire_id FROM question WHERE id = new.question_id); END",
+    "answer_count_delete": "AFTER DELETE ON answer BEGIN "
+                           "UPDATE question SET answer_count = answer_count - 1 WHERE id = old.question_id; "
+                           "UPDATE questionnaire SET answer_count = answer_count - 1 "
+                           "WHERE id = (SELECT questionnaire_id FROM question WHERE id = old.question_id) "
+                           "AND NOT archived; END",
+}
+
+
+@event.listens_for(db.Model.metadata, "after_create")
+def create_counter_triggers(target, connection, **kw):
+    """
+    Creates the missing triggers of the counters every time the tables are created.
+    """
+    if connection.dialect.name != "sqlite":
+        return
+    for name, body in COUNTER_TRIGGERS.items():
+        connection.execute("CREATE TRIGGER IF NOT EXISTS {} {}".format(name, body))
+
+
+# The guards of the archived and deleted questionnaires. A request checks the flags of the questionnaire
+# when it resolves its path, which may be served from the entity cache or may race the commit of an
+# archive or a delete in another worker. These triggers check them again in the transaction of the write,
+# so no question or answer is written to a questionnaire whose rows are being moved into its archive or
+# purged. The counters, the positions and the deletes of the rows are not guarded, since the archive and
+# the purge change them.
+READ_ONLY_ERROR = "the questionnaire is archived or deleted"
+_READ_ONLY_QUESTIONNAIRE = "SELECT 1 FROM questionnaire WHERE id = {} AND (archived OR deleted)"
+_READ_ONLY_QUESTION = ("SELECT 1 FROM question JOIN questionnaire ON questionnaire.id = question.questionnaire_id "
+                       "WHERE question.id = {} AND (questionnaire.archived OR questionnaire.deleted)")
+_RAISE_READ_ONLY = "BEGIN SELECT RAISE(ABORT, '{}'); END".format(READ_ONLY_ERROR)
+GUARD_TRIGGERS = {
+    "question_guard_insert": "BEFORE INSERT ON question WHEN EXISTS ({}) {}".format(
+        _READ_ONLY_QUESTIONNAIRE.format("new.questionnaire_id"), _RAISE_READ_ONLY),
+    "question_guard_update": "BEFORE UPDATE OF title, description, questionnaire_id ON question "
+                             "WHEN EXISTS ({}) {}".format(_READ_ONLY_QUESTIONNAIRE.format("new.questionnaire_id"),
+                                                         _RAISE_READ_ONLY),
+    "answer_guard_insert": "BEFORE INSERT ON answer WHEN EXISTS ({}) {}".format(
+        _READ_ONLY_QUESTION.format("new.question_id"), _RAISE_READ_ONLY),
+    "answer_guard_update": "BEFORE UPDATE ON answer WHEN EXISTS ({}) {}".format(
+        _READ_ONLY_QUESTION.format("new.question_id"), _RAISE_READ_ONLY),
+}
+
+
+@event.listens_for(db.Model.metadata, "after_create")
+def create_guard_triggers(target, connection, **kw):
+    """
+    Creates the missing guards of the archived and deleted questionnaires every time the tables are
+    created.
+    """
+    if connection.dialect.name != "sqlite":
+        return
+    for name, body in GUARD_TRIGGERS.items():
+        connection.execute("CREATE TRIGGER IF NOT EXISTS {} {}".format(name, body))
+
+
+def reconcile_counters():
+    """
+    Counts the questions and answers again and repairs the counters which have drifted, for example
+    after the rows were changed with the triggers dropped. The counts of an archived questionnaire come
+    from its archive. Returns the number of repaired rows.
+    """
+    answers_of_question = "(SELECT count(*) FROM answer WHERE answer.question_id = question.id)"
+    questions_of_questionnaire = "(SELECT count(*) FROM question WHERE question.questionnaire_id = questionnaire.id)"
+    answers_of_questionnaire = ("(SELECT count(*) FROM answer JOIN question ON question.id = answer.question_id "
+                                "WHERE question.questionnaire_id = questionnaire.id)")
+    archived_questions = ("coalesce((SELECT question_count FROM archive "
+                          "WHERE archive.questionnaire_id = questionnaire.id), 0)")
+    archived_answers = ("coalesce((SELECT answer_count FROM archive "
+                        "WHERE archive.questionnaire_id = questionnaire.id), 0)")
+    statements = [
+        "UPDATE question SET answer_count = {0} WHERE answer_count != {0}".format(answers_of_question),
+        "UPDATE questionnaire SET question_count = {0}, answer_count = {1} WHERE NOT archived "
+        "AND (question_count != {0} OR answer_count != {1})".format(questions_of_questionnaire,
+                                                                   answers_of_questionnaire),
+        "UPDATE questionnaire SET question_count = {0}, answer_count = {1} WHERE archived "
+        "AND (question_count != {0} OR answer_count != {1})".format(archived_questions, archived_answers),
+    ]
+
+    repaired = 0
+    for shard in [None] + list(range(db.shard_count())):
+        with routed_to(shard):
+            for statement in statements:
+                repaired += db.session.execute(statement).rowcount
+            db.session.commit()
+    return repaired
+
+
+class EntityCache(object):
+    """
+    A bounded per-worker read-through cache of the parent entities, keyed by the scope, the table and
+    the id. The scope is the shard of the row, since the ids of the questions repeat across the shards.
+    The resources use it to check that the questionnaire or the question in the URL exists without
+    querying the same few rows on every request.
+
+    The cached values are read-only snapshots of the columns (namedtuples) instead of ORM instances,
+    since an instance belongs to the session of the request which loaded it. The entries are
+    invalidated by the after_update and after_delete mapper events. Those only see the writes of this
+    worker, so the entries also expire ttl seconds after they were loaded, and the writes of the other
+    workers are seen at most that late. The writes do not rely on the deleted and archived flags of
+    the entries, since the guard triggers check them again in the transaction of the write.
+    """
+
+    def __init__(self, max_size, ttl, scope=lambda: None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.scope = scope
+        self.entries = collections.OrderedDict()
+        self.snapshots = {}
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def snapshot(self, row):
+        """
+        Copies the column values of an ORM instance into a namedtuple.
+        """
+        table = row.__table__
+        if table.name not in self.snapshots:
+            self.snapshots[table.name] = collections.namedtuple(
+                table.name.capitalize() + "Snapshot", [column.key for column in table.columns])
+        return self.snapshots[table.name](*[getattr(row, column.key) for column in table.columns])
+
+    def key(self, table, id):
+        """
+        Returns the key of a row in the current scope. Raises ValueError or TypeError for an invalid id.
+        """
+        return self.scope(), table, int(id)
+
+    def get(self, model, id):
+        """
+        Returns the snapshot of the row with the given id, loading it from the database on a miss or
+        when the entry has expired. Returns None if there is no such row. Missing rows are not cached
+        since they can be created.
+        """
+        try:
+            key = self.key(model.__tablename__, id)
+        except (TypeError, ValueError):
+            return None
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            generation = self.generation
+
+        row = model.query.get(key[2])
+        if row is None:
+            return None
+        value = self.snapshot(row)
+
+        # The row is not cached if anything was invalidated while it was being loaded, since the
+        # loaded values may already be stale.
+        with self.lock:
+            if generation == self.generation:
+                self.entries[key] = value, time.monotonic() + self.ttl
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+        return value
+
+    def contains(self, model, id):
+        try:
+            key = self.key(model.__tablename__, id)
+        except (TypeError, ValueError):
+            return False
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and entry[1] > time.monotonic()
+
+    def invalidate(self, table, id):
+        self.discard(self.key(table, id))
+
+    def discard(self, key):
+        with self.lock:
+            self.generation += 1
+            self.invalidations += 1
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+    def stats(self):
+        """
+        Returns the counters of the cache. Every hit is an existence query which was not run.
+        """
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+            }
+
+
+# Configuring the entity cache. The other workers do not invalidate the entries of this one, so an
+# entry is loaded again when it is older than ENTITY_CACHE_TTL seconds.
+app.config["ENTITY_CACHE_SIZE"] = 4096
+app.config["ENTITY_CACHE_TTL"] = 5
+entity_cache = EntityCache(app.config["ENTITY_CACHE_SIZE"], app.config["ENTITY_CACHE_TTL"],
+                           scope=lambda: db.session().routed_shard())
+
+
+@event.listens_for(Questionnaire, "after_update")
+@event.listens_for(Questionnaire, "after_delete")
+@event.listens_for(Question, "after_update")
+@event.listens_for(Question, "after_delete")
+def invalidate_entity(mapper, connection, target):
+    """
+    Removes a changed parent entity from the entity cache. The key is also remembered in the session
+    and invalidated again after the commit, in case another request cached the old row in between.
+    """
+    key = entity_cache.key(target.__tablename__, target.id)
+    entity_cache.discard(key)
+    object_session(target).info.setdefault("invalidated_entities", set()).add(key)
+
+
+@event.listens_for(db.session, "after_commit")
+def invalidate_committed_entities(session):
+    for key in session.info.pop("invalidated_entities", ()):
+        entity_cache.discard(key)
+
+
+@event.listens_for(db.session, "after_rollback")
+def forget_invalidated_entities(session):
+    session.info.pop("invalidated_entities", None)
+
+
+@event.listens_for(db.Model.metadata, "after_create")
+def clear_entity_cache(target, connection, **kw):
+    """
+    The cached ids belong to the database which was just created, or to a previous one.
+    """
+    entity_cache.clear()
+
+
+def sync_questionnaire(questionnaire_id, to_shard=False):
+    """
+    Copies the row of a questionnaire from its shard to the catalog, or from the catalog to its shard
+    with to_shard, in the transaction of the session. The copy is deleted if the row is not found. Does
+    nothing when the questionnaires are not sharded. The changes must be flushed before.
+    """
+    shard = db.shard_of(questionnaire_id)
+    if shard is None:
+        return
+    params = {"id": questionnaire_id}
+    with routed_to(None if to_shard else shard):
+        row = db.session.execute("SELECT id, title, description, deleted, archived FROM questionnaire "
+                                 "WHERE id = :id", params).first()
+    with routed_to(shard if to_shard else None):
+        if row is None:
+            db.session.execute("DELETE FROM questionnaire WHERE id = :id", params)
+        else:
+            db.session.execute(
+                "INSERT INTO questionnaire (id, title, description, deleted, archived) "
+                "VALUES (:id, :title, :description, :deleted, :archived) ON CONFLICT (id) DO UPDATE SET "
+                "title = excluded.title, description = excluded.description, deleted = excluded.deleted, "
+                "archived = excluded.archived", dict(row.items()))
+
+
+class PathNotFound(Exception):
+    """
+    Raised when one level of a nested resource path does not exist. The message tells which one.
+    """
+
+
+def load_archive(questionnaire_id):
+    """
+    Returns the contents of the archive of a questionnaire. An archive is decompressed once per request.
+    """
+    archives = g.setdefault("archives", {})
+    if questionnaire_id not in archives:
+        archives[questionnaire_id] = Archive.query.get(questionnaire_id).unpack()
+    return archives[questionnaire_id]
+
+
+def resolve_path(questionnaire_id, question_id=None, answer_id=None):
+    """
+    Loads the questionnaire, the question and the answer of a nested resource path with one query.
+    The question and the answer are outer joined with their parent, so a missing level is returned
+    as NULL instead of losing the whole row, and the first missing level can be told apart.
+
+    Returns a tuple with one ORM instance for each given id. The questions and answers of an archived
+    questionnaire are read from its archive instead, and returned as ArchiveContents namedtuples.
+    Raises PathNotFound if any level does not exist or does not belong to its parent.
+    """
+    query = db.session.query(Questionnaire)
+    if question_id is not None:
+        query = query.add_entity(Question).outerjoin(
+            Question, and_(Question.questionnaire_id == Questionnaire.id, Question.id == question_id))
+    if answer_id is not None:
+        query = query.add_entity(Answer).outerjoin(
+            Answer, and_(Answer.question_id == Question.id, Answer.id == answer_id))
+    row = query.filter(Questionnaire.id == questionnaire_id, Questionnaire.deleted.is_(False)).first()
+
+    if question_id is None:
+        row = (row,)
+    if row is None or row[0] is None:
+        raise PathNotFound("No questionnaire was found with the id {}".format(questionnaire_id))
+    if question_id is not None and row[0].archived:
+        archive = load_archive(row[0].id)
+        row = (row[0], archive.question(question_id))
+        if answer_id is not None:
+            row += (archive.answer(question_id, answer_id) if row[1] is not None else None,)
+    if question_id is not None and row[1] is None:
+        raise PathNotFound("No question was found with the id {} in questionnaire {}".format(
+            question_id, questionnaire_id))
+    if answer_id is not None and row[2] is None:
+        raise PathNotFound("No answer was found with the id {} in question {}".format(answer_id, question_id))
+    return tuple(row)
+
+
+def resolve_parents(questionnaire_id, question_id=None):
+    """
+    Checks that the parents of a collection exist, like resolve_path, but returns their snapshots
+    from the entity cache. When a parent is not cached, the path is resolved with one query, which
+    also puts the rows into the session so the cache is filled without querying them again.
+    """
+    if not entity_cache.contains(Questionnaire, questionnaire_id) or (
+            question_id is not None and not entity_cache.contains(Question, question_id)):
+        resolve_path(questionnaire_id, question_id)
+
+    questionnaire = entity_cache.get(Questionnaire, questionnaire_id)
+    if questionnaire is None or questionnaire.deleted:
+        raise PathNotFound("No questionnaire was found with the id {}".format(questionnaire_id))
+    if question_id is None:
+        return (questionnaire,)
+
+    if questionnaire.archived:
+        question = load_archive(questionnaire.id).question(question_id)
+    else:
+        question = entity_cache.get(Question, question_id)
+    if question is None or question.questionnaire_id != questionnaire.id:
+        raise PathNotFound("No question was found with the id {} in questionnaire {}".format(
+            question_id, questionnaire_id))
+    return questionnaire, question
 
 
 # Build up the database.
@@ -222,6 +1248,47 @@ class MasonBuilder(dict):
 
         return schema
 
+    def clone_schema(self):
+        """
+        This is the schema we used in our API for cloning a questionnaire. Both the title of the copy,
+        which is the title of the questionnaire by default, and the answers flag, which tells to copy
+        the answers too, can be left out.
+        """
+        schema = {
+            "type": "object",
+        }
+
+        props = schema["properties"] = {}
+        props["title"] = {
+            "description": "Title of the copy",
+            "type": "string"
+        }
+
+        props["answers"] = {
+            "description": "Whether the answers are copied with the questions",
+            "type": "boolean"
+        }
+
+        return schema
+
+    def move_question_schema(self):
+        """
+        This is the schema we used in our API for moving a question. It enforces to have the id of the
+        question after which the question is placed, which is null to place it first.
+        """
+        schema = {
+            "type": "object",
+            "required": ["after"],
+        }
+
+        props = schema["properties"] = {}
+        props["after"] = {
+            "description": "Id of the question after which this question is placed, or null for the first place",
+            "type": ["integer", "null"]
+        }
+
+        return schema
+
     def answer_schema(self):
         """
         This is the schema we used in our API for an answer. An answer is an object
@@ -244,6 +1311,36 @@ class MasonBuilder(dict):
         }
         return schema
 
+    def batch_schema(self):
+        """
+        This is the schema we used in our API for a batch. A batch is an object which enforces to
+        have a list of requests, each with a method and an href. The body of a request is optional,
+        and 'atomic' tells whether all the requests are run in one transaction.
+        """
+        schema = {
+            "type": "object",
+            "required": ["requests"]
+        }
+        props = schema["properties"] = {}
+        props["atomic"] = {
+            "description": "Whether the requests are committed all together or not at all",
+            "type": "boolean"
+        }
+        props["requests"] = {
+            "description": "The requests to run in order",
+            "type": "array",
+            "items": {
+                "type": "object",
+                "required": ["method", "href"],
+                "properties": {
+                    "method": {"type": "string", "enum": ["GET", "POST", "PUT", "DELETE"]},
+                    "href": {"type": "string", "pattern": "^/api/"},
+                    "body": {"type": "object"}
+                }
+            }
+        }
+        return schema
+
     def create_error_response(status_code, title, message=None):
         """
         This is the part where the error message starts to be created.
@@ -257,7 +1354,7 @@ class MasonBuilder(dict):
         body.add_error(title, message)
         body.add_control("profile", href=ERROR_PROFILE)
 
-        return Response(json.dumps(body), status_code, mimetype=MASON)
+        return mason_response(body, status_code)
 
 
 class InventoryBuilder(MasonBuilder):
@@ -279,57 +1376,139 @@ class InventoryBuilder(MasonBuilder):
             title="Get all questionnaires"
         )
 
-    def add_control_delete_questionnaire(self, id):
+    def add_control_search(self):
         """
-        This control is to delete an existing questionnaire from
-        the application. It works with the DELETE method and requires
-        a questionnaire id in the request body.
+        This control is to search questionnaires, questions and answers by keywords.
+        It works with the GET method and the href is a template of the query parameters.
         """
         self.add_control(
-            "survey:delete",
-            href=api.url_for(QuestionnaireItem, id=id),
-            method="DELETE",
-            title="Delete this questionnaire"
+            "survey:search",
+            "/api/search/{?q,type,page,limit}",
+            method="GET",
+            isHrefTemplate=True,
+            title="Search questionnaires, questions and answers"
         )
 
-    def add_control_add_questionnaire(self):
+    def add_control_batch(self):
         """
-        This control is to add a new questionnaire into the application.
-        It works with the POST method and the schema can be found by a
-        request to the resource.
+        This control is to run many requests to the API at once. It works
+        with the POST method and the schema can be found by a request to
+        the resource.
         """
         self.add_control(
-            "survey:add-questionnaire",
-            "api/questionnaires/",
+            "survey:batch",
+            "/api/batch/",
             method="POST",
             encoding="json",
-            title="Add a new questionnaire",
-            schema=self.questionnaire_schema()
+            title="Run a batch of requests",
+            schema=self.batch_schema()
         )
 
-    def add_control_edit_questionnaire(self, id):
+    def add_control_export_questionnaire(self, id):
         """
-        This control is to edit an existing questionnaire in the application.
-        It works with the PUT method and requires a questionnaire id in the
-        request body.
+        This control is to export a questionnaire with its questions and
+        answers into a file for pandas. It works with the POST method and
+        starts a job, whose location is returned.
         """
         self.add_control(
-            "edit",
-            href=api.url_for(QuestionnaireItem, id=id),
-            method="PUT",
-            encoding="json",
-            title="Edit this questionnaire",
-            schema=self.questionnaire_schema()
+            "survey:export",
+            href=api.url_for(QuestionnaireExport, questionnaire_id=id),
+            method="POST",
+            title="Export this questionnaire"
         )
 
-    def add_control_all_question(self, questionnaire_id):
+    def add_control_archive_questionnaire(self, id):
         """
-        This control is to retrieve all existing questions for a specified
-        questionnaire. It works with the GET method and it requies a questionnaire
-        id in the request body.
+        This control is to move the questions and answers of a questionnaire
+        into its archive, after which they are read-only. It works with the
+        POST method and starts a job, whose location is returned.
         """
         self.add_control(
-            "survey:question-of",
+            "survey:archive",
+            href=api.url_for(QuestionnaireArchive, questionnaire_id=id),
+            method="POST",
+            title="Archive this questionnaire"
+        )
+
+    def add_control_publish_questionnaire(self, id):
+        """
+        This control is to publish the questionnaire and its questions as an
+        immutable document, which is published again when they change. It
+        works with the POST method and returns the location of the document.
+        """
+        self.add_control(
+            "survey:publish",
+            href=api.url_for(QuestionnairePublish, questionnaire_id=id),
+            method="POST",
+            title="Publish this questionnaire"
+        )
+
+    def add_control_clone_questionnaire(self, id):
+        """
+        This control is to copy the questionnaire with its questions, and
+        optionally their answers, into a new questionnaire. It works with the
+        POST method and returns the location of the copy.
+        """
+        self.add_control(
+            "survey:clone",
+            href=api.url_for(QuestionnaireClone, questionnaire_id=id),
+            method="POST",
+            encoding="json",
+            title="Clone this questionnaire",
+            schema=self.clone_schema()
+        )
+
+    def add_control_delete_questionnaire(self, id):
+        """
+        This control is to delete an existing questionnaire from
+        the application. It works with the DELETE method and requires
+        a questionnaire id in the request body.
+        """
+        self.add_control(
+            "survey:delete",
+            href=api.url_for(QuestionnaireItem, id=id),
+            method="DELETE",
+            title="Delete this questionnaire"
+        )
+
+    def add_control_add_questionnaire(self):
+        """
+        This control is to add a new questionnaire into the application.
+        It works with the POST method and the schema can be found by a
+        request to the resource.
+        """
+        self.add_control(
+            "survey:add-questionnaire",
+            "api/questionnaires/",
+            method="POST",
+            encoding="json",
+            title="Add a new questionnaire",
+            schema=self.questionnaire_schema()
+        )
+
+    def add_control_edit_questionnaire(self, id):
+        """
+        This control is to edit an existing questionnaire in the application.
+        It works with the PUT method and requires a questionnaire id in the
+        request body.
+        """
+        self.add_control(
+            "edit",
+            href=api.url_for(QuestionnaireItem, id=id),
+            method="PUT",
+            encoding="json",
+            title="Edit this questionnaire",
+            schema=self.questionnaire_schema()
+        )
+
+    def add_control_all_question(self, questionnaire_id):
+        """
+        This control is to retrieve all existing questions for a specified
+        questionnaire. It works with the GET method and it requies a questionnaire
+        id in the request body.
+        """
+        self.add_control(
+            "survey:question-of",
             href="/api/questionnaires/{}/questions/".format(questionnaire_id),
             method="GET",
             title="Get all questions of one questionnaire"
@@ -365,6 +1544,21 @@ class InventoryBuilder(MasonBuilder):
             schema=self.question_schema()
         )
 
+    def add_control_move_question(self, questionnaire_id, id):
+        """
+        This control is to move a question to another place in the order of
+        the questions of its questionnaire. It works with the POST method and
+        it requires the id of the question after which it is placed.
+        """
+        self.add_control(
+            "survey:move-question",
+            href=api.url_for(QuestionMove, questionnaire_id=questionnaire_id, id=id),
+            method="POST",
+            encoding="json",
+            title="Move this question",
+            schema=self.move_question_schema()
+        )
+
     def add_control_delete_question(self, questionnaire_id, id):
         """
         This control is to delete an existing question in a specified questionnaire.
@@ -433,6 +1627,804 @@ class InventoryBuilder(MasonBuilder):
             title="Delete this answer"
         )
 
+    def add_control_item_template(self, href, profile):
+        """
+        This control replaces the per-item "self" and "profile" controls in the compact representation
+        of a collection. The href is a URI template which is expanded with the id of each item.
+        """
+        self.add_control(
+            "item",
+            href,
+            isHrefTemplate=True,
+            title="Get one item of this collection, replace {id} with the id of the item"
+        )
+        self.add_control("survey:item-profile", profile)
+
+
+def wants_compact():
+    """
+    Tells whether the client asked for the compact representation of a collection. It can be asked
+    either with the 'compact' query parameter or with the compact profile in the Accept header, for
+    example: Accept: application/vnd.mason+json; profile="/profiles/compact/"
+    """
+    if request.args.get("compact", "").lower() in ("1", "true", "yes"):
+        return True
+
+    for media_range in request.headers.get("Accept", "").split(","):
+        mimetype, _, params = media_range.partition(";")
+        if mimetype.strip() in (MASON, MASON_MSGPACK) and COMPACT_PROFILE in params:
+            return True
+    return False
+
+
+def mason_response(body, status=200, headers=None):
+    """
+    Returns a response with a Mason document, encoded as JSON or as MessagePack. MessagePack is used
+    when the client prefers it in the Accept header, for example: Accept: application/vnd.mason+msgpack
+    """
+    headers = dict(headers or {}, Vary="Accept")
+    if request.accept_mimetypes.best_match([MASON, MASON_MSGPACK]) == MASON_MSGPACK:
+        return Response(msgpack.packb(body, use_bin_type=True), status, mimetype=MASON_MSGPACK, headers=headers)
+    return Response(json.dumps(body), status, mimetype=MASON, headers=headers)
+
+
+def select_fields(model, field_names, columns=None):
+    """
+    Returns the columns of the model which are requested with the 'fields' query parameter
+    (for example fields=id,title). Without the parameter all the fields are returned. The id is
+    always selected since the items can not be addressed without it. The fields which are not
+    columns of the model are given in columns, by name.
+
+    Raises ValueError if a requested field is not one of the field_names.
+    """
+    columns = columns or {}
+    requested = request.args.get("fields")
+    if not requested:
+        return [columns.get(name, getattr(model, name, None)) for name in field_names]
+
+    names = set(name.strip() for name in requested.split(",") if name.strip())
+    unknown = names.difference(field_names)
+    if unknown:
+        raise ValueError("Unknown fields: {}. Available fields are: {}".format(
+            ", ".join(sorted(unknown)), ", ".join(field_names)))
+
+    names.add("id")
+    return [columns.get(name, getattr(model, name, None)) for name in field_names if name in names]
+
+
+def archived_error(questionnaire_id):
+    """
+    Returns the error response to a change of the questions or answers of an archived questionnaire.
+    """
+    return MasonBuilder.create_error_response(409, "Archived", "The questions and answers of the questionnaire {} "
+                                              "are archived and can not be changed".format(questionnaire_id))
+
+
+def read_only_error(questionnaire_id):
+    """
+    Returns the error response to a change of the questions or answers of a questionnaire which was
+    archived or deleted after the path of the request was resolved.
+    """
+    return MasonBuilder.create_error_response(409, "Read only", "The questionnaire {} has been archived or "
+                                              "deleted, so its questions and answers can not be "
+                                              "changed".format(questionnaire_id))
+
+
+class AlreadyAnswered(Exception):
+    """
+    Raised when an answer is changed to the user of another answer to the same question.
+    """
+
+
+class ReadOnlyQuestionnaire(Exception):
+    """
+    Raised when a question or an answer is written to a questionnaire which has been archived or deleted
+    since the path of the request was resolved.
+    """
+
+
+@contextmanager
+def guarded_write():
+    """
+    Turns the error of the guard triggers into ReadOnlyQuestionnaire, after rolling back the write.
+    """
+    try:
+        yield
+    except IntegrityError as e:
+        if READ_ONLY_ERROR not in str(e.orig):
+            raise
+        db.session.rollback()
+        raise ReadOnlyQuestionnaire()
+
+
+def filter_and_sort_answers(answers, parameters):
+    """
+    Applies the filter and sort parameters of AnswerCollection.query_parameters to a list of answers
+    which are in memory, like the answers of an archive.
+    """
+    user_name, prefix, min_id, max_id, key, descending = parameters
+    answers = [answer for answer in answers if
+               (user_name is None or answer.userName == user_name) and
+               (prefix is None or answer.content.startswith(prefix)) and
+               (min_id is None or answer.id >= min_id) and
+               (max_id is None or answer.id <= max_id)]
+    return sorted(answers, key=lambda answer: (getattr(answer, key), answer.id), reverse=descending)
+
+
+class Repository(abc.ABC):
+    """
+    The storage of the questionnaires, questions and answers which the resources read and change.
+    The entities have the attributes of the columns of their models, and the answers a userName.
+
+    The find methods raise PathNotFound if any level of the path does not exist. The lists are
+    returned as dicts with the keys of the given columns, which come from select_fields. The changes
+    are saved by the method which makes them. A backend which does not implement every abstract method
+    can not be instantiated.
+    """
+
+    # Tells whether the changes of many requests can be committed or rolled back together.
+    transactional = False
+
+    @abc.abstractmethod
+    def find(self, questionnaire_id, question_id=None, answer_id=None):
+        """
+        Returns the questionnaire, the question and the answer of a path, one for each given id.
+        """
+
+    def find_parents(self, questionnaire_id, question_id=None):
+        """
+        Returns the parents of a collection, like find. They may be read-only snapshots.
+        """
+        return self.find(questionnaire_id, question_id)
+
+    @abc.abstractmethod
+    def list_questionnaires(self, columns):
+        pass
+
+    @abc.abstractmethod
+    def count_questionnaires(self):
+        pass
+
+    @abc.abstractmethod
+    def add_questionnaire(self, title, description):
+        """
+        Creates a questionnaire and returns its id.
+        """
+
+    @abc.abstractmethod
+    def update_questionnaire(self, questionnaire, title, description):
+        pass
+
+    @abc.abstractmethod
+    def delete_questionnaire(self, questionnaire):
+        """
+        Deletes a questionnaire with its questions and answers. It is not found anymore, even if the
+        rows are removed later.
+        """
+
+    @abc.abstractmethod
+    def clone_questionnaire(self, questionnaire, title, with_answers):
+        """
+        Copies a questionnaire with its questions in their order, and with the answers to them if
+        with_answers is set. The copy is not archived nor published. Returns the id of the copy.
+        """
+
+    @abc.abstractmethod
+    def list_questions(self, questionnaire, columns):
+        """
+        Returns the questions of a questionnaire in the order of their positions.
+        """
+
+    @abc.abstractmethod
+    def add_question(self, questionnaire, title, description):
+        """
+        Creates a question and returns its id. Raises ReadOnlyQuestionnaire if the questionnaire has
+        been archived or deleted in the meantime.
+        """
+
+    @abc.abstractmethod
+    def update_question(self, question, title, description):
+        """
+        Changes a question. Raises ReadOnlyQuestionnaire like add_question.
+        """
+
+    @abc.abstractmethod
+    def delete_question(self, question):
+        pass
+
+    @abc.abstractmethod
+    def move_question(self, questionnaire, question, after_id):
+        """
+        Moves a question right after the question with the given id, or first if it is None. Raises
+        PathNotFound if there is no such question in the questionnaire.
+        """
+
+    @abc.abstractmethod
+    def list_answers(self, questionnaire, question_id, columns, parameters):
+        """
+        Returns the answers to a question, filtered and sorted with the parameters of
+        AnswerCollection.query_parameters.
+        """
+
+    @abc.abstractmethod
+    def save_answer(self, questionnaire, question_id, content, user_name):
+        """
+        Creates the answer of a user to a question, or replaces the content of the answer which the
+        user already gave. Returns the id of the answer and whether it was created. Raises
+        ReadOnlyQuestionnaire like add_question.
+        """
+
+    @abc.abstractmethod
+    def update_answer(self, answer, content, user_name):
+        """
+        Changes an answer. Raises AlreadyAnswered if the user has another answer to the question, and
+        ReadOnlyQuestionnaire like add_question.
+        """
+
+    @abc.abstractmethod
+    def delete_answer(self, answer):
+        pass
+
+    @abc.abstractmethod
+    def answers_of_user(self, questionnaire, user_name):
+        """
+        Returns the answers of a user to the questions of a questionnaire, in the order of their ids.
+        Raises PathNotFound if there is no such user.
+        """
+
+
+class SQLRepository(Repository):
+    """
+    The repository in the database of Flask-SQLAlchemy, which is the default. The paths are resolved
+    with resolve_path and resolve_parents, so the questions and answers of an archived questionnaire
+    are read from its archive.
+    """
+    transactional = True
+
+    # The answers are sorted by id and content in the order of the indexes on (question_id, key), so
+    # those rows are not sorted in memory. The user names are in the user table, so the answers of the
+    # question are found with the index on question_id, and only they are sorted by the names of their
+    # users.
+    SORT_KEYS = {
+        "id": Answer.id,
+        "userName": User.name,
+        "content": Answer.content,
+    }
+
+    # Inserts the answer, or replaces the content of the answer which the user already gave to the
+    # question, in one statement. The change is always written, so the trigger always logs it. The
+    # user is created before, if it is new.
+    INSERT_USER = 'INSERT INTO "user" (name) VALUES (:userName) ON CONFLICT (name) DO NOTHING'
+    UPSERT = (
+        "INSERT INTO answer (question_id, content, user_id) "
+        "SELECT :question_id, :content, id FROM \"user\" WHERE name = :userName "
+        "ON CONFLICT (question_id, user_id) DO UPDATE SET content = excluded.content"
+    )
+    # The id of the answer of a user to a question, read with the unique index on (question_id, user_id).
+    ANSWER_OF_USER = ('SELECT answer.id FROM answer JOIN "user" ON "user".id = answer.user_id '
+                      'WHERE answer.question_id = :question_id AND "user".name = :userName')
+
+    def find(self, questionnaire_id, question_id=None, answer_id=None):
+        return resolve_path(questionnaire_id, question_id, answer_id)
+
+    def find_parents(self, questionnaire_id, question_id=None):
+        return resolve_parents(questionnaire_id, question_id)
+
+    COUNTERS = ("question_count", "answer_count")
+
+    def list_questionnaires(self, columns):
+        # Only the requested columns are loaded from the database.
+        items = [item._asdict() for item in
+                 Questionnaire.query.with_entities(*columns).filter(Questionnaire.deleted.is_(False))]
+
+        # The counters are kept in the rows of the shards, which are not copied to the catalog on every
+        # write, so they are read from each shard with one query.
+        counters = [column.key for column in columns if column.key in self.COUNTERS]
+        if counters and db.shard_count():
+            counts = {}
+            for shard in range(db.shard_count()):
+                with routed_to(shard):
+                    counts.update((row.id, row) for row in db.session.execute(
+                        "SELECT id, question_count, answer_count FROM questionnaire"))
+            for item in items:
+                for name in counters:
+                    item[name] = getattr(counts[item["id"]], name) if item["id"] in counts else 0
+        return items
+
+    def count_questionnaires(self):
+        return Questionnaire.query.filter(Questionnaire.deleted.is_(False)).count()
+
+    def add_questionnaire(self, title, description):
+        questionnaire = Questionnaire(title=title, description=description)
+        db.session.add(questionnaire)
+        db.session.flush()
+        sync_questionnaire(questionnaire.id, to_shard=True)
+        db.session.commit()
+        return questionnaire.id
+
+    def update_questionnaire(self, questionnaire, title, description):
+        questionnaire.title = title
+        questionnaire.description = description
+        db.session.flush()
+        sync_questionnaire(questionnaire.id)
+        db.session.commit()
+
+    def delete_questionnaire(self, questionnaire):
+        """
+        The questionnaire is only marked as deleted, which hides it right away, and a job purges it
+        with its questions and answers.
+        """
+        questionnaire.deleted = True
+        db.session.add(Job(kind="purge", params=json.dumps({"questionnaire_id": questionnaire.id})))
+        db.session.flush()
+        sync_questionnaire(questionnaire.id)
+        db.session.commit()
+
+    # Copies the questions and the answers of a questionnaire. The copy of a question gets the id of the
+    # question shifted by an offset past the last id of the table, so the answers can be copied to it in
+    # one statement too. The triggers count and index the copies and log the copied answers.
+    CLONE_QUESTIONS = (
+        "INSERT INTO question (id, questionnaire_id, title, description, position) "
+        "SELECT id + :offset, :clone_id, title, description, position FROM question WHERE questionnaire_id = :id"
+    )
+    CLONE_ANSWERS = (
+        "INSERT INTO answer (question_id, content, user_id) "
+        "SELECT answer.question_id + :offset, answer.content, answer.user_id FROM answer "
+        "JOIN question ON question.id = answer.question_id WHERE question.questionnaire_id = :id"
+    )
+
+    def clone_questionnaire(self, questionnaire, title, with_answers):
+        """
+        The questions and answers are copied with INSERT ... SELECT statements in the transaction which
+        creates the copy. The questions of an archived questionnaire, and the questions of a shard when
+        the copy falls in another shard, are read first and written with one executemany statement.
+        """
+        with routed_to(None):
+            clone = Questionnaire(title=title, description=questionnaire.description)
+            db.session.add(clone)
+            db.session.flush()
+            clone_id = clone.id
+        sync_questionnaire(clone_id, to_shard=True)
+        source, target = db.shard_of(questionnaire.id), db.shard_of(clone_id)
+        params = {"id": questionnaire.id, "clone_id": clone_id}
+
+        if questionnaire.archived:
+            archive = load_archive(questionnaire.id)
+            questions = [(question.id, question.title, question.description, position)
+                         for position, question in enumerate(archive.questions.values(), 1)]
+            answers = [(answer.question_id, answer.content, answer.userName) for answer in archive.answers]
+        elif source != target:
+            with routed_to(source):
+                questions = db.session.execute(
+                    "SELECT id, title, description, position FROM question WHERE questionnaire_id = :id",
+                    params).fetchall()
+                answers = db.session.execute(
+                    'SELECT answer.question_id, answer.content, "user".name FROM answer '
+                    'JOIN question ON question.id = answer.question_id JOIN "user" ON "user".id = answer.user_id '
+                    'WHERE question.questionnaire_id = :id', params).fetchall()
+        else:
+            with routed_to(target):
+                params["offset"] = db.session.execute(
+                    "SELECT (SELECT max(id) FROM question) - min(id) + 1 FROM question WHERE questionnaire_id = :id",
+                    params).scalar()
+                if params["offset"] is not None:
+                    db.session.execute(self.CLONE_QUESTIONS, params)
+                    if with_answers:
+                        db.session.execute(self.CLONE_ANSWERS, params)
+            db.session.commit()
+            return clone_id
+
+        with routed_to(target):
+            last_id = db.session.execute("SELECT coalesce(max(id), 0) FROM question").scalar()
+            clone_ids = {}
+            rows = []
+            for number, (id, question_title, description, position) in enumerate(questions, 1):
+                clone_ids[id] = last_id + number
+                rows.append({"id": last_id + number, "questionnaire_id": clone_id, "title": question_title,
+                             "description": description, "position": position})
+            if rows:
+                db.session.execute("INSERT INTO question (id, questionnaire_id, title, description, position) "
+                                   "VALUES (:id, :questionnaire_id, :title, :description, :position)", rows)
+            if with_answers and answers:
+                db.session.execute(self.INSERT_USER, [{"userName": name} for name in set(row[2] for row in answers)])
+                db.session.execute(self.UPSERT, [{"question_id": clone_ids[question_id], "content": content,
+                                                  "userName": name} for question_id, content, name in answers])
+        db.session.commit()
+        return clone_id
+
+    def list_questions(self, questionnaire, columns):
+        if questionnaire.archived:
+            names = [column.key for column in columns]
+            return [collections.OrderedDict((name, getattr(question, name)) for name in names)
+                    for question in load_archive(questionnaire.id).questions.values()]
+        # The questions are read in the order of the index on (questionnaire_id, position), without sorting.
+        return [item._asdict() for item in Question.query.with_entities(*columns).filter_by(
+            questionnaire_id=questionnaire.id).order_by(Question.position, Question.id)]
+
+    def add_question(self, questionnaire, title, description):
+        question = Question(questionnaire_id=questionnaire.id, title=title, description=description)
+        db.session.add(question)
+        with guarded_write():
+            db.session.commit()
+        return question.id
+
+    def update_question(self, question, title, description):
+        question.title = title
+        question.description = description
+        with guarded_write():
+            db.session.commit()
+
+    def delete_question(self, question):
+        db.session.delete(question)
+        db.session.commit()
+
+    def move_question(self, questionnaire, question, after_id):
+        """
+        The question gets the position halfway between its new neighbours, so no other row is changed.
+        Only when the gap is too narrow for a float between them, the questions of the questionnaire
+        are numbered again first.
+        """
+        query = Question.query.with_entities(Question.position).filter(
+            Question.questionnaire_id == questionnaire.id, Question.id != question.id)
+        for renumbered in (False, True):
+            if after_id is None:
+                before = None
+            else:
+                before = query.filter(Question.id == after_id).scalar()
+                if before is None:
+                    raise PathNotFound("No question was found with the id {} in questionnaire {}".format(
+                        after_id, questionnaire.id))
+            following = query.order_by(Question.position)
+            if before is not None:
+                following = following.filter(Question.position > before)
+            after = following.limit(1).scalar()
+
+            if before is None and after is None:
+                position = question.position
+            elif before is None:
+                position = after - 1
+            elif after is None:
+                position = before + 1
+            else:
+                position = (before + after) / 2.0
+            if renumbered or before is None or after is None or before < position < after:
+                break
+            self.renumber_questions(questionnaire.id)
+
+        question.position = position
+        db.session.commit()
+
+    @staticmethod
+    def renumber_questions(questionnaire_id):
+        ids = [row[0] for row in db.session.execute(
+            "SELECT id FROM question WHERE questionnaire_id = :id ORDER BY position, id", {"id": questionnaire_id})]
+        db.session.execute("UPDATE question SET position = :position WHERE id = :id",
+                           [{"id": id, "position": number} for number, id in enumerate(ids, 1)])
+
+    def list_answers(self, questionnaire, question_id, columns, parameters):
+        # The answers of an archived questionnaire are filtered and sorted in memory.
+        if questionnaire.archived:
+            names = [column.key for column in columns]
+            return [collections.OrderedDict((name, getattr(answer, name)) for name in names)
+                    for answer in filter_and_sort_answers(load_archive(questionnaire.id).answers_to(question_id),
+                                                          parameters)]
+
+        user_name, prefix, min_id, max_id, key, descending = parameters
+        query = Answer.query.with_entities(*columns).join(User, User.id == Answer.user_id).filter(
+            Answer.question_id == question_id)
+        if user_name is not None:
+            query = query.filter(User.name == user_name)
+
+        # A range on the content instead of LIKE, since LIKE can not use the index.
+        if prefix is not None:
+            query = query.filter(Answer.content >= prefix, Answer.content < prefix + u"\U0010ffff")
+        if min_id is not None:
+            query = query.filter(Answer.id >= min_id)
+        if max_id is not None:
+            query = query.filter(Answer.id <= max_id)
+
+        if descending:
+            query = query.order_by(self.SORT_KEYS[key].desc(), Answer.id.desc())
+        else:
+            query = query.order_by(self.SORT_KEYS[key], Answer.id)
+        return [item._asdict() for item in query]
+
+    def save_answer(self, questionnaire, question_id, content, user_name):
+        """
+        The answer of the user is looked up with the unique index before and after the upsert, in its
+        transaction, so it was created if it did not exist before.
+        """
+        params = {"question_id": question_id, "content": content, "userName": user_name}
+        with guarded_write():
+            db.session.execute(self.INSERT_USER, params)
+            answer_id = db.session.execute(self.ANSWER_OF_USER, params).scalar()
+            db.session.execute(self.UPSERT, params)
+        created = answer_id is None
+        if created:
+            answer_id = db.session.execute(self.ANSWER_OF_USER, params).scalar()
+            if answer_broker.has_subscribers():
+                seq = db.session.execute(
+                    "SELECT seq FROM answer_change WHERE questionnaire_id = :questionnaire_id "
+                    "AND answer_id = :answer_id ORDER BY seq DESC LIMIT 1",
+                    {"questionnaire_id": questionnaire.id, "answer_id": answer_id}).scalar()
+                remember_answer_event(db.session(), questionnaire.id, seq, {
+                    "id": answer_id,
+                    "question_id": int(question_id),
+                    "content": content,
+                    "userName": user_name
+                })
+        db.session.commit()
+        return answer_id, created
+
+    def update_answer(self, answer, content, user_name):
+        answer.content = content
+        answer.userName = user_name
+        try:
+            with guarded_write():
+                db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            raise AlreadyAnswered()
+
+    def delete_answer(self, answer):
+        db.session.delete(answer)
+        db.session.commit()
+
+    def answers_of_user(self, questionnaire, user_name):
+        user = User.query.filter_by(name=user_name).first()
+        if user is None:
+            raise PathNotFound("No user was found with name {}".format(user_name))
+
+        # A user has at most one answer to a question, so each one is read from the unique index on
+        # (question_id, user_id).
+        if questionnaire.archived:
+            return [answer for answer in load_archive(questionnaire.id).answers if answer.userName == user.name]
+        return Answer.query.join(Question).filter(
+            Question.questionnaire_id == questionnaire.id, Answer.user_id == user.id
+        ).order_by(Answer.id).all()
+
+
+class MemoryRepository(Repository):
+    """
+    A repository which keeps everything in the memory of the worker, for short-lived surveys and for
+    tests. The rows are namedtuples in dicts by their ids, and a change replaces the tuple, so a
+    reader never sees a half changed row. The secondary indexes are the ids of the questions of each
+    questionnaire, the ids of the answers to each question by their users, and the ids of the
+    answers of each user. The changes are saved at once, and a lock keeps the indexes consistent.
+    """
+    Questionnaire = collections.namedtuple(
+        "StoredQuestionnaire",
+        ["id", "title", "description", "deleted", "archived", "published_version", "question_count", "answer_count"])
+    Question = collections.namedtuple("StoredQuestion",
+                                      ["id", "questionnaire_id", "title", "description", "answer_count"])
+    Answer = collections.namedtuple("StoredAnswer", ["id", "question_id", "content", "userName"])
+
+    # The resources which need the SQL database, by endpoint.
+    UNSUPPORTED = {"answerchangecollection", "answerstream", "search", "questionnaireexport",
+                   "questionnairearchive", "questionnairepublish", "jobitem"}
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.last_ids = collections.Counter()
+            self.questionnaires = collections.OrderedDict()
+            self.questions = {}
+            self.answers = {}
+            self.questions_by_questionnaire = collections.defaultdict(collections.OrderedDict)
+            self.answers_by_question = collections.defaultdict(dict)
+            self.answers_by_user = collections.defaultdict(set)
+
+    def next_id(self, table):
+        self.last_ids[table] += 1
+        return self.last_ids[table]
+
+    @staticmethod
+    def count(mapping, id, name, change):
+        """
+        Changes a counter of a row, if the row still exists.
+        """
+        row = mapping.get(id)
+        if row is not None:
+            mapping[id] = row._replace(**{name: getattr(row, name) + change})
+
+    @staticmethod
+    def row(mapping, id):
+        try:
+            return mapping.get(int(id))
+        except (TypeError, ValueError):
+            return None
+
+    def find(self, questionnaire_id, question_id=None, answer_id=None):
+        questionnaire = self.row(self.questionnaires, questionnaire_id)
+        if questionnaire is None:
+            raise PathNotFound("No questionnaire was found with the id {}".format(questionnaire_id))
+        if question_id is None:
+            return (questionnaire,)
+
+        question = self.row(self.questions, question_id)
+        if question is None or question.questionnaire_id != questionnaire.id:
+            raise PathNotFound("No question was found with the id {} in questionnaire {}".format(
+                question_id, questionnaire_id))
+        if answer_id is None:
+            return questionnaire, question
+
+        answer = self.row(self.answers, answer_id)
+        if answer is None or answer.question_id != question.id:
+            raise PathNotFound("No answer was found with the id {} in question {}".format(answer_id, question_id))
+        return questionnaire, question, answer
+
+    @staticmethod
+    def fields(row, columns):
+        return collections.OrderedDict((column.key, getattr(row, column.key)) for column in columns)
+
+    def list_questionnaires(self, columns):
+        return [self.fields(questionnaire, columns) for questionnaire in list(self.questionnaires.values())]
+
+    def count_questionnaires(self):
+        return len(self.questionnaires)
+
+    def add_questionnaire(self, title, description):
+        with self.lock:
+            id = self.next_id("questionnaire")
+            self.questionnaires[id] = self.Questionnaire(id, title, description, False, False, None, 0, 0)
+        return id
+
+    def update_questionnaire(self, questionnaire, title, description):
+        with self.lock:
+            if questionnaire.id in self.questionnaires:
+                self.questionnaires[questionnaire.id] = self.questionnaires[questionnaire.id]._replace(
+                    title=title, description=description)
+
+    def delete_questionnaire(self, questionnaire):
+        with self.lock:
+            for question_id in list(self.questions_by_questionnaire.pop(questionnaire.id, ())):
+                self.delete_question(self.questions[question_id])
+            self.questionnaires.pop(questionnaire.id, None)
+
+    def clone_questionnaire(self, questionnaire, title, with_answers):
+        with self.lock:
+            clone_id = self.add_questionnaire(title, questionnaire.description)
+            clone, = self.find(clone_id)
+            for question_id in list(self.questions_by_questionnaire.get(questionnaire.id, ())):
+                question = self.questions[question_id]
+                clone_question_id = self.add_question(clone, question.title, question.description)
+                if with_answers:
+                    for answer_id in list(self.answers_by_question.get(question_id, {}).values()):
+                        answer = self.answers[answer_id]
+                        self.save_answer(clone, clone_question_id, answer.content, answer.userName)
+        return clone_id
+
+    def list_questions(self, questionnaire, columns):
+        with self.lock:
+            questions = [self.questions[id] for id in self.questions_by_questionnaire.get(questionnaire.id, ())]
+        return [self.fields(question, columns) for question in questions]
+
+    def add_question(self, questionnaire, title, description):
+        with self.lock:
+            id = self.next_id("question")
+            self.questions[id] = self.Question(id, questionnaire.id, title, description, 0)
+            self.questions_by_questionnaire[questionnaire.id][id] = True
+            self.count(self.questionnaires, questionnaire.id, "question_count", 1)
+        return id
+
+    def update_question(self, question, title, description):
+        with self.lock:
+            if question.id in self.questions:
+                self.questions[question.id] = self.questions[question.id]._replace(
+                    title=title, description=description)
+
+    def move_question(self, questionnaire, question, after_id):
+        with self.lock:
+            order = self.questions_by_questionnaire[questionnaire.id]
+            if after_id is not None and (after_id == question.id or int(after_id) not in order):
+                raise PathNotFound("No question was found with the id {} in questionnaire {}".format(
+                    after_id, questionnaire.id))
+            ids = [id for id in order if id != question.id]
+            index = 0 if after_id is None else ids.index(int(after_id)) + 1
+            ids.insert(index, question.id)
+            self.questions_by_questionnaire[questionnaire.id] = collections.OrderedDict((id, True) for id in ids)
+
+    def delete_question(self, question):
+        with self.lock:
+            for answer_id in list(self.answers_by_question.pop(question.id, {}).values()):
+                self.delete_answer(self.answers[answer_id])
+            if self.questions_by_questionnaire.get(question.questionnaire_id, {}).pop(question.id, None):
+                self.count(self.questionnaires, question.questionnaire_id, "question_count", -1)
+            self.questions.pop(question.id, None)
+
+    def list_answers(self, questionnaire, question_id, columns, parameters):
+        user_name = parameters[0]
+        with self.lock:
+            by_user = self.answers_by_question.get(int(question_id), {})
+            if user_name is not None:
+                ids = [by_user[user_name]] if user_name in by_user else []
+            else:
+                ids = list(by_user.values())
+            answers = [self.answers[id] for id in ids]
+        return [self.fields(answer, columns) for answer in filter_and_sort_answers(answers, parameters)]
+
+    def save_answer(self, questionnaire, question_id, content, user_name):
+        question_id = int(question_id)
+        with self.lock:
+            id = self.answers_by_question[question_id].get(user_name)
+            if id is not None:
+                self.answers[id] = self.answers[id]._replace(content=content)
+                return id, False
+            id = self.next_id("answer")
+            self.answers[id] = self.Answer(id, question_id, content, user_name)
+            self.answers_by_question[question_id][user_name] = id
+            self.answers_by_user[user_name].add(id)
+            self.count(self.questions, question_id, "answer_count", 1)
+            self.count(self.questionnaires, questionnaire.id, "answer_count", 1)
+            return id, True
+
+    def update_answer(self, answer, content, user_name):
+        with self.lock:
+            current = self.answers.get(answer.id)
+            if current is None:
+                return
+            by_user = self.answers_by_question[current.question_id]
+            if by_user.get(user_name, current.id) != current.id:
+                raise AlreadyAnswered()
+            del by_user[current.userName]
+            self.answers_by_user[current.userName].discard(current.id)
+            by_user[user_name] = current.id
+            self.answers_by_user[user_name].add(current.id)
+            self.answers[current.id] = current._replace(content=content, userName=user_name)
+
+    def delete_answer(self, answer):
+        with self.lock:
+            current = self.answers.pop(answer.id, None)
+            if current is not None:
+                self.answers_by_question.get(current.question_id, {}).pop(current.userName, None)
+                self.answers_by_user[current.userName].discard(current.id)
+                self.count(self.questions, current.question_id, "answer_count", -1)
+                self.count(self.questionnaires, self.questions[current.question_id].questionnaire_id,
+                           "answer_count", -1)
+
+    def answers_of_user(self, questionnaire, user_name):
+        with self.lock:
+            if user_name not in self.answers_by_user:
+                raise PathNotFound("No user was found with name {}".format(user_name))
+            answers = [self.answers[id] for id in self.answers_by_user[user_name]]
+        return sorted((answer for answer in answers
+                       if self.questions[answer.question_id].questionnaire_id == questionnaire.id),
+                      key=lambda answer: answer.id)
+
+
+REPOSITORIES = {
+    "sql": SQLRepository(),
+    "memory": MemoryRepository(),
+}
+
+
+def repository():
+    """
+    Returns the repository of the configured STORAGE_BACKEND.
+    """
+    return REPOSITORIES[app.config["STORAGE_BACKEND"]]
+
+
+def supports(resource):
+    """
+    Tells whether the configured repository supports a resource, which needs the SQL database otherwise.
+    """
+    return resource.__name__.lower() not in getattr(repository(), "UNSUPPORTED", ())
+
+
+@app.before_request
+def check_storage_backend():
+    """
+    Refuses the requests to the resources which the configured repository does not support.
+    """
+    if request.endpoint in getattr(repository(), "UNSUPPORTED", ()):
+        return MasonBuilder.create_error_response(501, "Not implemented", "This resource needs the sql storage "
+                                                  "backend, but it is {}".format(app.config["STORAGE_BACKEND"]))
+    return None
+
 
 class EntryPoint(Resource):
     """
@@ -443,8 +2435,11 @@ class EntryPoint(Resource):
         body = InventoryBuilder()
         body.add_namespace("survey", LINK_RELATIONS_URL)
         body.add_control_all_questionnaires()
+        if supports(Search):
+            body.add_control_search()
+        body.add_control_batch()
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return mason_response(body, 200)
 
 
 class QuestionnaireCollection(Resource):
@@ -457,17 +2452,20 @@ class QuestionnaireCollection(Resource):
         """
         This method is used to retrieve all the questionnaires. It returns a list of questionnaires.
         """
-        db_questionnaire = Questionnaire.query.all()
+        try:
+            columns = select_fields(Questionnaire, ["id", "title", "description", "question_count", "answer_count"])
+        except ValueError as e:
+            return MasonBuilder.create_error_response(400, "Invalid fields", str(e))
+
+        compact = wants_compact()
+        db_questionnaire = repository().list_questionnaires(columns)
         items = []
 
         for item in db_questionnaire:
-            questionnaire = InventoryBuilder(
-                id=item.id,
-                title=item.title,
-                description=item.description
-            )
-            questionnaire.add_control("self", api.url_for(QuestionnaireItem, id=item.id))
-            questionnaire.add_control("profile", QUESTIONNAIRE_PROFILE)
+            questionnaire = InventoryBuilder(**item)
+            if not compact:
+                questionnaire.add_control("self", api.url_for(QuestionnaireItem, id=item["id"]))
+                questionnaire.add_control("profile", QUESTIONNAIRE_PROFILE)
             items.append(questionnaire)
 
         body = InventoryBuilder(
@@ -476,9 +2474,18 @@ class QuestionnaireCollection(Resource):
 
         body.add_namespace("survey", LINK_RELATIONS_URL)
         body.add_control("self", "/api/questionnaires/")
+        if compact:
+            body.add_control_item_template("/api/questionnaires/{id}/", QUESTIONNAIRE_PROFILE)
         body.add_control_add_questionnaire()
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return mason_response(body, 200)
+
+    def head(self):
+        """
+        This method is used to count the questionnaires. The count is given in the X-Total-Count header.
+        """
+        return Response(status=200, mimetype=MASON,
+                        headers={"X-Total-Count": str(repository().count_questionnaires())})
 
     def post(self):
         """
@@ -495,14 +2502,9 @@ class QuestionnaireCollection(Resource):
             return MasonBuilder.create_error_response(400, "Invalid JSON document", str(e))
 
         # If no error, then start executing the request.
-        questionnaire = Questionnaire(
-            title=request.json["title"],
-            description=request.json.get("description")
-        )
-        db.session.add(questionnaire)
-        db.session.commit()
+        questionnaire_id = repository().add_questionnaire(request.json["title"], request.json.get("description"))
 
-        return Response(status=201, headers={"Location": api.url_for(QuestionnaireItem, id=questionnaire.id)})
+        return Response(status=201, headers={"Location": api.url_for(QuestionnaireItem, id=questionnaire_id)})
 
 
 class QuestionnaireItem(Resource):
@@ -516,19 +2518,20 @@ class QuestionnaireItem(Resource):
         This method is used to retrieve a specific questionnaire. It returns the specified questionnaire.
         """
 
-        # Filters the database with the one searched for.
-        db_questionnaire = Questionnaire.query.filter_by(id=id).first()
-
-        # If no result is found, return an error.
-        if db_questionnaire is None:
-            return MasonBuilder.create_error_response(404, "Not found",
-                                                      "No questionnaire was found with the id {}".format(id))
+        # Resolves the whole path of the resource, and returns an error if any level is not found.
+        try:
+            db_questionnaire, = repository().find(id)
+        except PathNotFound as e:
+            return MasonBuilder.create_error_response(404, "Not found", str(e))
 
         # Otherwise, continue building the response.
         body = InventoryBuilder(
             id=db_questionnaire.id,
             title=db_questionnaire.title,
-            description=db_questionnaire.description
+            description=db_questionnaire.description,
+            archived=db_questionnaire.archived,
+            question_count=db_questionnaire.question_count,
+            answer_count=db_questionnaire.answer_count
         )
 
         body.add_namespace("survey", LINK_RELATIONS_URL)
@@ -537,22 +2540,29 @@ class QuestionnaireItem(Resource):
         body.add_control("collection", "/api/questionnaires/")
         body.add_control("question-of", api.url_for(QuestionCollection, questionnaire_id=id))
         body.add_control_edit_questionnaire(id)
+        if supports(QuestionnaireExport):
+            body.add_control_export_questionnaire(id)
+        if not db_questionnaire.archived and supports(QuestionnaireArchive):
+            body.add_control_archive_questionnaire(id)
+        if supports(QuestionnairePublish):
+            body.add_control_publish_questionnaire(id)
+        if db_questionnaire.published_version:
+            body.add_control("survey:published", published_url(id, db_questionnaire.published_version))
+        body.add_control_clone_questionnaire(id)
         body.add_control_delete_questionnaire(id)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return mason_response(body, 200)
 
     def put(self, id):
         """
         This method is used to edit a specific questionnaire.
         """
 
-        # Filters the database with the one searched for.
-        questionnaire = Questionnaire.query.filter_by(id=id).first()
-
-        # If no result is found, return an error.
-        if questionnaire is None:
-            return MasonBuilder.create_error_response(404, "Not found",
-                                                      "No Questionnaire was found with the id {}".format(id))
+        # Resolves the whole path of the resource, and returns an error if any level is not found.
+        try:
+            questionnaire, = repository().find(id)
+        except PathNotFound as e:
+            return MasonBuilder.create_error_response(404, "Not found", str(e))
         if not request.json:
             return MasonBuilder.create_error_response(415, "Unsupported media type", "Request must be JSON")
 
@@ -562,28 +2572,25 @@ class QuestionnaireItem(Resource):
             return MasonBuilder.create_error_response(400, "Invalid JSON document", str(e))
 
         # Otherwise, continue building the response.
-        questionnaire.title = request.json["title"]
-        questionnaire.description = request.json.get("description")
-        db.session.commit()
+        repository().update_questionnaire(questionnaire, request.json["title"], request.json.get("description"))
+        if questionnaire.published_version:
+            publish_questionnaire(questionnaire.id)
 
         return Response(status=204, headers={"Location": api.url_for(QuestionnaireItem, id=id)})
 
     def delete(self, id):
         """
-        This method is used to delete a specific questionnaire.
+        This method is used to delete a specific questionnaire with its questions and answers.
         """
 
-        # Filters the database with the one searched for.
-        questionnaire = Questionnaire.query.filter_by(id=id).first()
-
-        # If no result is found, return an error.
-        if questionnaire is None:
-            return MasonBuilder.create_error_response(404, "Not found",
-                                                      "No Questionnaire was found with the id {}".format(id))
+        # Resolves the whole path of the resource, and returns an error if any level is not found.
+        try:
+            questionnaire, = repository().find(id)
+        except PathNotFound as e:
+            return MasonBuilder.create_error_response(404, "Not found", str(e))
 
         # Otherwise, continue building the response.
-        db.session.delete(questionnaire)
-        db.session.commit()
+        repository().delete_questionnaire(questionnaire)
 
         return Response(status=204, headers={"Location": api.url_for(QuestionnaireItem, id=id)})
 
@@ -599,28 +2606,28 @@ class QuestionCollection(Resource):
         This method is used to retrieve all questions for a specified questionnaire. It returns a list of questions.
         """
 
-        # Filters the database with the one questionnaire searched for.
-        questionnaire = Questionnaire.query.filter_by(id=questionnaire_id).first()
+        # Resolves the whole path of the resource, and returns an error if any level is not found.
+        try:
+            questionnaire, = repository().find_parents(questionnaire_id)
+        except PathNotFound as e:
+            return MasonBuilder.create_error_response(404, "Not found", str(e))
 
-        # If no result is found, return an error.
-        if questionnaire is None:
-            return MasonBuilder.create_error_response(404, "Not found",
-                                                      "No Questionnaire was found with id {}".format(questionnaire_id))
+        try:
+            columns = select_fields(Question, ["id", "questionnaire_id", "title", "description", "answer_count"])
+        except ValueError as e:
+            return MasonBuilder.create_error_response(400, "Invalid fields", str(e))
 
         # Otherwise, continue building the response.
-        db_question = Question.query.filter_by(questionnaire_id=questionnaire_id).all()
+        compact = wants_compact()
+        db_question = repository().list_questions(questionnaire, columns)
         items = []
 
         for item in db_question:
-            question = InventoryBuilder(
-                id=item.id,
-                questionnaire_id=item.questionnaire_id,
-                title=item.title,
-                description=item.description
-            )
-
-            question.add_control("self", api.url_for(QuestionItem, questionnaire_id=questionnaire_id, id=item.id))
-            question.add_control("profile", QUESTION_PROFILE)
+            question = InventoryBuilder(**item)
+            if not compact:
+                question.add_control("self", api.url_for(QuestionItem, questionnaire_id=questionnaire_id,
+                                                         id=item["id"]))
+                question.add_control("profile", QUESTION_PROFILE)
             items.append(question)
 
         body = InventoryBuilder(
@@ -629,21 +2636,37 @@ class QuestionCollection(Resource):
         body.add_namespace("survey", LINK_RELATIONS_URL)
         body.add_control("self", api.url_for(QuestionCollection, questionnaire_id=questionnaire_id))
         body.add_control("questionnaire-with", api.url_for(QuestionnaireItem, id=questionnaire_id))
-        body.add_control_add_question(questionnaire_id)
+        if compact:
+            body.add_control_item_template(
+                "/api/questionnaires/{}/questions/{{id}}/".format(questionnaire_id), QUESTION_PROFILE)
+        if not questionnaire.archived:
+            body.add_control_add_question(questionnaire_id)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return mason_response(body, 200)
+
+    def head(self, questionnaire_id):
+        """
+        This method is used to count the questions of a questionnaire. The count is given in the
+        X-Total-Count header, from the counter of the questionnaire.
+        """
+        try:
+            questionnaire, = repository().find(questionnaire_id)
+        except PathNotFound as e:
+            return MasonBuilder.create_error_response(404, "Not found", str(e))
+
+        return Response(status=200, mimetype=MASON, headers={"X-Total-Count": str(questionnaire.question_count)})
 
     def post(self, questionnaire_id):
         """
         This method is used to add a new question for a specified questionnaire.
         """
-        # Filters the database with the one questionnaire searched for.
-        questionnaire = Questionnaire.query.filter_by(id=questionnaire_id).first()
-
-        # If no result is found, return an error.
-        if questionnaire is None:
-            return MasonBuilder.create_error_response(404, "Not found",
-                                                      "No Questionnaire with the id {}".format(questionnaire_id))
+        # Resolves the whole path of the resource, and returns an error if any level is not found.
+        try:
+            questionnaire, = repository().find_parents(questionnaire_id)
+        except PathNotFound as e:
+            return MasonBuilder.create_error_response(404, "Not found", str(e))
+        if questionnaire.archived:
+            return archived_error(questionnaire_id)
         # Request validity checking..
         if not request.json:
             return MasonBuilder.create_error_response(415, "Unsupported media type", "Request must be JSON")
@@ -653,16 +2676,16 @@ class QuestionCollection(Resource):
             return MasonBuilder.create_error_response(400, "Invalid JSON document", str(e))
 
         # Otherwise, continue building the response.
-        question = Question(
-            questionnaire_id=questionnaire_id,
-            title=request.json["title"],
-            description=request.json.get("description")
-        )
-        db.session.add(question)
-        db.session.commit()
+        try:
+            question_id = repository().add_question(questionnaire, request.json["title"],
+                                                    request.json.get("description"))
+        except ReadOnlyQuestionnaire:
+            return read_only_error(questionnaire_id)
+        if questionnaire.published_version:
+            publish_questionnaire(questionnaire.id)
 
         return Response(status=201, headers={
-            "Location": api.url_for(QuestionItem, questionnaire_id=questionnaire_id, id=question.id)})
+            "Location": api.url_for(QuestionItem, questionnaire_id=questionnaire_id, id=question_id)})
 
 
 class QuestionItem(Resource):
@@ -676,21 +2699,19 @@ class QuestionItem(Resource):
         This method is to retrieve a specific question for a specific questionnaire.
         """
 
-        # Filters the database for a specific question.
-        db_question = Question.query.filter_by(id=id, questionnaire_id=questionnaire_id).first()
-
-        # If no result is found, return an error.
-        if db_question is None:
-            return MasonBuilder.create_error_response(404, "Not found",
-                                                      "No question was found with the id {} in questionnaire {}".format(
-                                                          id, questionnaire_id))
+        # Resolves the whole path of the resource, and returns an error if any level is not found.
+        try:
+            questionnaire, db_question = repository().find(questionnaire_id, id)
+        except PathNotFound as e:
+            return MasonBuilder.create_error_response(404, "Not found", str(e))
 
         # Creating the rest of the response.
         body = InventoryBuilder(
             id=db_question.id,
             questionnaire_id=db_question.questionnaire_id,
             title=db_question.title,
-            description=db_question.description
+            description=db_question.description,
+            answer_count=db_question.answer_count
         )
 
         body.add_namespace("survey", LINK_RELATIONS_URL)
@@ -698,24 +2719,25 @@ class QuestionItem(Resource):
         body.add_control("profile", QUESTION_PROFILE)
         body.add_control("collection", api.url_for(QuestionCollection, questionnaire_id=questionnaire_id))
         body.add_control("answer-to", api.url_for(AnswerCollection, questionnaire_id=questionnaire_id, question_id=id))
-        body.add_control_edit_question(questionnaire_id, id)
-        body.add_control_delete_question(questionnaire_id, id)
+        if not questionnaire.archived:
+            body.add_control_edit_question(questionnaire_id, id)
+            body.add_control_move_question(questionnaire_id, id)
+            body.add_control_delete_question(questionnaire_id, id)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return mason_response(body, 200)
 
     def put(self, questionnaire_id, id):
         """
         This method is used to edit an existing question in a specified questionnaire.
         """
 
-        # Filters the database for a specific question.
-        db_question = Question.query.filter_by(id=id, questionnaire_id=questionnaire_id).first()
-
-        # If no result is found, return an error.
-        if db_question is None:
-            return MasonBuilder.create_error_response(404, "Not found",
-                                                      "No question was found with the id {} in questionnaire {}".format(
-                                                          id, questionnaire_id))
+        # Resolves the whole path of the resource, and returns an error if any level is not found.
+        try:
+            questionnaire, db_question = repository().find(questionnaire_id, id)
+        except PathNotFound as e:
+            return MasonBuilder.create_error_response(404, "Not found", str(e))
+        if questionnaire.archived:
+            return archived_error(questionnaire_id)
 
         # Validity check of the request..
         if not request.json:
@@ -726,9 +2748,12 @@ class QuestionItem(Resource):
             return MasonBuilder.create_error_response(400, "Invalid JSON document", str(e))
 
         # Keep building the response.
-        db_question.title = request.json["title"]
-        db_question.description = request.json.get("description")
-        db.session.commit()
+        try:
+            repository().update_question(db_question, request.json["title"], request.json.get("description"))
+        except ReadOnlyQuestionnaire:
+            return read_only_error(questionnaire_id)
+        if questionnaire.published_version:
+            publish_questionnaire(questionnaire.id)
 
         return Response(status=204,
                         headers={"Location": api.url_for(QuestionItem, questionnaire_id=questionnaire_id, id=id)})
@@ -737,57 +2762,128 @@ class QuestionItem(Resource):
         """
         This method is used to delete an existing question in a specific questionnaire.
         """
-        # Filters the database for a specific question.
-        db_question = Question.query.filter_by(id=id, questionnaire_id=questionnaire_id).first()
-
-        # If no result is found, return an error.
-        if db_question is None:
-            return MasonBuilder.create_error_response(404, "Not found",
-                                                      "No question was found with the id {} in questionnaire {}".format(
-                                                          id, questionnaire_id))
+        # Resolves the whole path of the resource, and returns an error if any level is not found.
+        try:
+            questionnaire, db_question = repository().find(questionnaire_id, id)
+        except PathNotFound as e:
+            return MasonBuilder.create_error_response(404, "Not found", str(e))
+        if questionnaire.archived:
+            return archived_error(questionnaire_id)
 
         # Building the response.
-        db.session.delete(db_question)
-        db.session.commit()
+        repository().delete_question(db_question)
+        if questionnaire.published_version:
+            publish_questionnaire(questionnaire.id)
 
         return Response(status=204,
                         headers={"Location": api.url_for(QuestionItem, questionnaire_id=questionnaire_id, id=id)})
 
 
+class QuestionMove(Resource):
+    """
+    This class represents a resource called QuestionMove, which changes the order of the questions.
+    On this resource, there is only one function a client can use: POST.
+    """
+
+    def post(self, questionnaire_id, id):
+        """
+        This method is used to move a question right after another question of its questionnaire, or to
+        the first place. Only the moved question is changed.
+        """
+
+        # Resolves the whole path of the resource, and returns an error if any level is not found.
+        try:
+            questionnaire, db_question = repository().find(questionnaire_id, id)
+        except PathNotFound as e:
+            return MasonBuilder.create_error_response(404, "Not found", str(e))
+        if questionnaire.archived:
+            return archived_error(questionnaire_id)
+
+        # Validity check of the request..
+        if not request.json:
+            return MasonBuilder.create_error_response(415, "Unsupported media type", "Request must be JSON")
+        try:
+            validate(request.json, MasonBuilder.move_question_schema(self))
+        except ValidationError as e:
+            return MasonBuilder.create_error_response(400, "Invalid JSON document", str(e))
+
+        try:
+            repository().move_question(questionnaire, db_question, request.json["after"])
+        except PathNotFound as e:
+            return MasonBuilder.create_error_response(400, "Invalid position", str(e))
+        if questionnaire.published_version:
+            publish_questionnaire(questionnaire.id)
+
+        return Response(status=204,
+                        headers={"Location": api.url_for(QuestionCollection, questionnaire_id=questionnaire_id)})
+
+
 class AnswerCollection(Resource):
     """
     This class represents a resource called AnswerCollection.
     On this resource, there are two functions a client can use: GET and POST.
     """
 
+    SORT_KEYS = ["content", "id", "userName"]
+
+    def query_parameters(self):
+        """
+        Reads the filter and sort query parameters of the answers:
+        - 'userName', only the answers of this user.
+        - 'contentPrefix', only the answers whose content starts with the prefix.
+        - 'minId' and 'maxId', only the answers in this range of ids, both included.
+        - 'sort', one of the SORT_KEYS, prefixed with - for a descending order.
+
+        Returns them as (userName, contentPrefix, minId, maxId, sort key, descending), with None for
+        the missing filters. Raises ValueError if a parameter is invalid.
+        """
+        args = request.args
+        try:
+            min_id = int(args["minId"]) if "minId" in args else None
+            max_id = int(args["maxId"]) if "maxId" in args else None
+        except ValueError:
+            raise ValueError("The minId and maxId must be integers")
+
+        sort = args.get("sort", "id")
+        key = sort.lstrip("-")
+        if key not in self.SORT_KEYS:
+            raise ValueError("Can not sort by {}. The answers can be sorted by: {}".format(
+                key, ", ".join(sorted(self.SORT_KEYS))))
+        return args.get("userName"), args.get("contentPrefix") or None, min_id, max_id, key, sort.startswith("-")
+
     def get(self, questionnaire_id, question_id):
         """
         This method is used to retrieve answers given to a question in a specific questionnaire.
+        The answers can be filtered and sorted with the query parameters described in query_parameters.
         """
 
-        # Filters the database for a specific question.
-        db_question = Question.query.filter_by(id=question_id, questionnaire_id=questionnaire_id).first()
+        # Resolves the whole path of the resource, and returns an error if any level is not found.
+        try:
+            questionnaire, _ = repository().find_parents(questionnaire_id, question_id)
+        except PathNotFound as e:
+            return MasonBuilder.create_error_response(404, "Not found", str(e))
+
+        try:
+            columns = select_fields(Answer, ["id", "question_id", "content", "userName"],
+                                    {"userName": User.name.label("userName")})
+        except ValueError as e:
+            return MasonBuilder.create_error_response(400, "Invalid fields", str(e))
 
-        # If no result is found, return an error.
-        if db_question is None:
-            return MasonBuilder.create_error_response(404, "Not found",
-                                                      "No question was found with the id {} in questionnaire {}".format(
-                                                          question_id, questionnaire_id))
+        try:
+            db_answer = repository().list_answers(questionnaire, question_id, columns, self.query_parameters())
+        except ValueError as e:
+            return MasonBuilder.create_error_response(400, "Invalid query parameters", str(e))
 
         # Keep building the response with all the answers.
-        db_answer = Answer.query.filter_by(question_id=question_id).all()
+        compact = wants_compact()
         items = []
         for item in db_answer:
-            answer = InventoryBuilder(
-                id=item.id,
-                question_id=item.question_id,
-                content=item.content,
-                userName=item.userName
-            )
-            answer.add_control("self",
-                               api.url_for(AnswerItem, questionnaire_id=questionnaire_id, question_id=question_id,
-                                           id=item.id))
-            answer.add_control("profile", ANSWER_PROFILE)
+            answer = InventoryBuilder(**item)
+            if not compact:
+                answer.add_control("self",
+                                   api.url_for(AnswerItem, questionnaire_id=questionnaire_id, question_id=question_id,
+                                               id=item["id"]))
+                answer.add_control("profile", ANSWER_PROFILE)
             items.append(answer)
 
         body = InventoryBuilder(
@@ -797,23 +2893,50 @@ class AnswerCollection(Resource):
         body.add_control("self", api.url_for(AnswerCollection, questionnaire_id=questionnaire_id,
                                              question_id=question_id))
         body.add_control("question-with", api.url_for(QuestionItem, questionnaire_id=questionnaire_id, id=question_id))
-        body.add_control_add_answer(questionnaire_id, question_id)
+        if compact:
+            body.add_control_item_template(
+                "/api/questionnaires/{}/questions/{}/answers/{{id}}/".format(questionnaire_id, question_id),
+                ANSWER_PROFILE)
+        if not questionnaire.archived:
+            body.add_control_add_answer(questionnaire_id, question_id)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return mason_response(body, 200)
 
-    def post(self, questionnaire_id, question_id):
+    def head(self, questionnaire_id, question_id):
         """
-        This method is used to create an answer for a question in a specific questionnaire.
+        This method is used to count the answers to a question. The count is given in the X-Total-Count
+        header, from the counter of the question, or by counting the answers which pass the filters of
+        query_parameters.
         """
+        try:
+            questionnaire, question = repository().find(questionnaire_id, question_id)
+        except PathNotFound as e:
+            return MasonBuilder.create_error_response(404, "Not found", str(e))
+
+        try:
+            parameters = self.query_parameters()
+        except ValueError as e:
+            return MasonBuilder.create_error_response(400, "Invalid query parameters", str(e))
+        if any(value is not None for value in parameters[:4]):
+            count = len(repository().list_answers(questionnaire, question_id, [Answer.id], parameters))
+        else:
+            count = question.answer_count
 
-        # Filters the database for a specific question.
-        question = Question.query.filter_by(id=question_id, questionnaire_id=questionnaire_id).first()
+        return Response(status=200, mimetype=MASON, headers={"X-Total-Count": str(count)})
 
-        # If no result is found, return an error.
-        if question is None:
-            return MasonBuilder.create_error_response(404, "Not found",
-                                                      "Fail to add a Answer to a Question with the id {} "
-                                                      "in questionnaire {}".format(question_id, questionnaire_id))
+    def post(self, questionnaire_id, question_id):
+        """
+        This method is used to create an answer for a question in a specific questionnaire. If the user
+        already answered the question, the answer is replaced, so a resubmission does not add a new row.
+        """
+
+        # Resolves the whole path of the resource, and returns an error if any level is not found.
+        try:
+            questionnaire, _ = repository().find_parents(questionnaire_id, question_id)
+        except PathNotFound as e:
+            return MasonBuilder.create_error_response(404, "Not found", str(e))
+        if questionnaire.archived:
+            return archived_error(questionnaire_id)
 
         # Validity check of the request..
         if not request.json:
@@ -823,18 +2946,16 @@ class AnswerCollection(Resource):
         except ValidationError as e:
             return MasonBuilder.create_error_response(400, "Invalid JSON document", str(e))
 
-        # Keep building the response, adding a new object into the database and application
-        answer = Answer(
-            question_id=question_id,
-            content=request.json["content"],
-            userName=request.json["userName"]
-        )
-        db.session.add(answer)
-        db.session.commit()
+        # Keep building the response, inserting or replacing the answer.
+        try:
+            answer_id, created = repository().save_answer(questionnaire, question_id, request.json["content"],
+                                                          request.json["userName"])
+        except ReadOnlyQuestionnaire:
+            return read_only_error(questionnaire_id)
 
-        return Response(status=201, headers={
+        return Response(status=201 if created else 200, headers={
             "Location": api.url_for(AnswerItem, questionnaire_id=questionnaire_id, question_id=question_id,
-                                    id=answer.id)})
+                                    id=answer_id)})
 
 
 class AnswerItem(Resource):
@@ -847,22 +2968,11 @@ class AnswerItem(Resource):
         """
         This method is used to retrieve an anwer given to a question for a specific questionnaire.
         """
-        # Filters the database for a specific question.
-        db_question = Question.query.filter_by(id=question_id, questionnaire_id=questionnaire_id).first()
-
-        # If no result is found, return an error.
-        if db_question is None:
-            return MasonBuilder.create_error_response(404, "Not found",
-                                                      "No question was found with the id {} in questionnaire {}".format(
-                                                          question_id, questionnaire_id))
-
-        # Filters the database for a specific answer.
-        db_answer = Answer.query.filter_by(id=id, question_id=question_id).first()
-
-        # If no result is found, return an error.
-        if db_answer is None:
-            return MasonBuilder.create_error_response(404, "Not found", "No answer was found with the id {} "
-                                                                        "in question {}".format(id, question_id))
+        # Resolves the whole path of the resource, and returns an error if any level is not found.
+        try:
+            questionnaire, _, db_answer = repository().find(questionnaire_id, question_id, id)
+        except PathNotFound as e:
+            return MasonBuilder.create_error_response(404, "Not found", str(e))
 
         # Keep building the response.
         body = InventoryBuilder(
@@ -877,41 +2987,24 @@ class AnswerItem(Resource):
         body.add_control("profile", ANSWER_PROFILE)
         body.add_control("collection", api.url_for(AnswerCollection, questionnaire_id=questionnaire_id,
                                                    question_id=question_id))
-        body.add_control_edit_answer(questionnaire_id, question_id, id)
-        body.add_control_delete_answer(questionnaire_id, question_id, id)
+        if not questionnaire.archived:
+            body.add_control_edit_answer(questionnaire_id, question_id, id)
+            body.add_control_delete_answer(questionnaire_id, question_id, id)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return mason_response(body, 200)
 
     def put(self, questionnaire_id, question_id, id):
         """
         This method is used to edit an answer to a given question for a specified questionnaire.
         """
 
-        # Filters the database for a specific questionnaire.
-        db_questionnaire = Questionnaire.query.filter_by(id=questionnaire_id).first()
-
-        # If no result is found, return an error.
-        if db_questionnaire is None:
-            return MasonBuilder.create_error_response(404, "Not found",
-                                                      "No questionnaire was found with the id {}".format(
-                                                          questionnaire_id))
-
-        # Filters the database for a specific question.
-        db_question = Question.query.filter_by(id=question_id, questionnaire_id=questionnaire_id).first()
-
-        # If no result is found, return an error.
-        if db_question is None:
-            return MasonBuilder.create_error_response(404, "Not found",
-                                                      "No question was found with the id {} in questionnaire {}"
-                                                      .format(question_id, questionnaire_id))
-
-        # Filters the database for a specific answer.
-        db_answer = Answer.query.filter_by(id=id, question_id=question_id).first()
-
-        # If no result is found, return an error.
-        if db_answer is None:
-            return MasonBuilder.create_error_response(404, "Not found", "No answer was found with the id {} "
-                                                                        "in question {}".format(id, question_id))
+        # Resolves the whole path of the resource, and returns an error if any level is not found.
+        try:
+            questionnaire, _, db_answer = repository().find(questionnaire_id, question_id, id)
+        except PathNotFound as e:
+            return MasonBuilder.create_error_response(404, "Not found", str(e))
+        if questionnaire.archived:
+            return archived_error(questionnaire_id)
 
         # Validity check of the request.
         if not request.json:
@@ -921,10 +3014,14 @@ class AnswerItem(Resource):
         except ValidationError as e:
             return MasonBuilder.create_error_response(400, "Invalid JSON document", str(e))
 
-        # Keep building the response.
-        db_answer.content = request.json["content"]
-        db_answer.userName = request.json["userName"]
-        db.session.commit()
+        # Keep building the response. The user may not have another answer to the same question.
+        try:
+            repository().update_answer(db_answer, request.json["content"], request.json["userName"])
+        except AlreadyAnswered:
+            return MasonBuilder.create_error_response(409, "Already exists", "The user {} has already answered "
+                                                      "the question {}".format(request.json["userName"], question_id))
+        except ReadOnlyQuestionnaire:
+            return read_only_error(questionnaire_id)
 
         return Response(status=204, headers={
             "Location": api.url_for(AnswerItem, questionnaire_id=questionnaire_id, question_id=question_id, id=id)})
@@ -934,35 +3031,16 @@ class AnswerItem(Resource):
         This method is used to delete an answer given to a question in a specific questionnaire.
         """
 
-        # Filters the database for a specific questionnaire.
-        db_questionnaire = Questionnaire.query.filter_by(id=questionnaire_id).first()
-
-        # If no result is found, return an error.
-        if db_questionnaire is None:
-            return MasonBuilder.create_error_response(404, "Not found",
-                                                      "No questionnaire was found with the id {}".format(
-                                                          questionnaire_id))
-
-        # Filters the database for a specific question.
-        db_question = Question.query.filter_by(id=question_id, questionnaire_id=questionnaire_id).first()
-
-        # If no result is found, return an error.
-        if db_question is None:
-            return MasonBuilder.create_error_response(404, "Not found",
-                                                      "No question was found with the id {} in questionnaire {}"
-                                                      .format(question_id, questionnaire_id))
-
-        # Filters the database for a specific answer.
-        db_answer = Answer.query.filter_by(id=id, question_id=question_id).first()
-
-        # If no result is found, return an error.
-        if db_answer is None:
-            return MasonBuilder.create_error_response(404, "Not found", "No answer was found with the id {} "
-                                                                        "in question {}".format(id, question_id))
+        # Resolves the whole path of the resource, and returns an error if any level is not found.
+        try:
+            questionnaire, _, db_answer = repository().find(questionnaire_id, question_id, id)
+        except PathNotFound as e:
+            return MasonBuilder.create_error_response(404, "Not found", str(e))
+        if questionnaire.archived:
+            return archived_error(questionnaire_id)
 
         # Keep building the response.
-        db.session.delete(db_answer)
-        db.session.commit()
+        repository().delete_answer(db_answer)
 
         return Response(status=204, headers={
             "Location": api.url_for(AnswerItem, questionnaire_id=questionnaire_id, question_id=question_id, id=id)})
@@ -979,64 +3057,32 @@ class AnswerOfUserToQuestionnaire(Resource):
         This method is used to retrieve all the answers given to a specific questionnaire by a user.
         """
 
-        # Filters the database for a specific questionnaire.
-        db_questionnire = Questionnaire.query.filter_by(id=questionnaire_id).first()
-
-        # If no result is found, return an error.
-        if db_questionnire is None:
-            return MasonBuilder.create_error_response(404, "Not found",
-                                                      "No Questionnaire was found with id {}".format(questionnaire_id))
-
-        # Filters the database for a specific answer.
-        db_answer = Answer.query.filter_by(userName=userName).first()
+        # Resolves the whole path of the resource, and returns an error if any level is not found.
+        try:
+            questionnaire, = repository().find_parents(questionnaire_id)
+        except PathNotFound as e:
+            return MasonBuilder.create_error_response(404, "Not found", str(e))
 
-        # If no result is found, return an error.
-        if db_answer is None:
-            return MasonBuilder.create_error_response(404, "Not found",
-                                                      "No user was found with name {}".format(userName))
+        # Retrieves the answers of the user to the questions of the questionnaire, and returns an error if
+        # the user is not found.
+        try:
+            answers = repository().answers_of_user(questionnaire, userName)
+        except PathNotFound as e:
+            return MasonBuilder.create_error_response(404, "Not found", str(e))
 
-        # Otherwise, continue building the response. Retrieves all the answers given by a user.
-        questions = []
-        answers = Answer.query.filter_by(userName=userName).all()
-        for a in answers:
-            questions.append(a.question_id)
-
-        # Gets all the questions in the specified questionnaire.
-        idOfQuestion = []
-        for q in questions:
-            question = Question.query.filter_by(id=q).first()
-            idOfQuestionnaire = question.questionnaire_id
-            if int(idOfQuestionnaire) == int(questionnaire_id):
-                idOfQuestion.append(q)
-        idOfQuestion = sorted(set(idOfQuestion), key=idOfQuestion.index)
-
-        # Matches answers with the questions.
+        # Otherwise, continue building the response.
         items = []
-        for index in idOfQuestion:
-            item = Answer.query.filter_by(question_id=index, userName=userName).all()
-            if len(item) == 1:
-                answer = InventoryBuilder(
-                    id=item[0].id,
-                    question_id=item[0].question_id,
-                    content=item[0].content,
-                    userName=item[0].userName
-                )
-                answer.add_control("self", api.url_for(AnswerOfUserToQuestionnaire, questionnaire_id=questionnaire_id,
-                                                       userName=userName))
-                answer.add_control("profile", ANSWER_PROFILE)
-                items.append(answer)
-            else:
-                for i in item:
-                    answer = InventoryBuilder(
-                        id=i.id,
-                        question_id=i.question_id,
-                        content=i.content,
-                        userName=i.userName
-                    )
-                    answer.add_control("self", api.url_for(AnswerOfUserToQuestionnaire,
-                                                           questionnaire_id=questionnaire_id, userName=userName))
-                    answer.add_control("profile", ANSWER_PROFILE)
-                    items.append(answer)
+        for a in answers:
+            answer = InventoryBuilder(
+                id=a.id,
+                question_id=a.question_id,
+                content=a.content,
+                userName=a.userName
+            )
+            answer.add_control("self", api.url_for(AnswerOfUserToQuestionnaire, questionnaire_id=questionnaire_id,
+                                                   userName=userName))
+            answer.add_control("profile", ANSWER_PROFILE)
+            items.append(answer)
 
         # Keep building the answer to return.
         body = InventoryBuilder(
@@ -1046,7 +3092,1283 @@ class AnswerOfUserToQuestionnaire(Resource):
         body.add_control("self", api.url_for(AnswerOfUserToQuestionnaire, questionnaire_id=questionnaire_id,
                                              userName=userName))
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return mason_response(body, 200)
+
+
+class AnswerChangeCollection(Resource):
+    """
+    This class represents a resource called AnswerChangeCollection, the change feed of the answers
+    of one questionnaire. On this resource, there is only one function a client can use: GET.
+    """
+    MAX_LIMIT = 1000
+
+    def get(self, questionnaire_id):
+        """
+        This method is used to retrieve the inserts, updates and deletes of the answers of a questionnaire
+        which happened after the sequence number given in the 'since' query parameter. The client polls
+        the "next" control, which continues from the last returned change.
+        """
+
+        # Resolves the whole path of the resource, and returns an error if any level is not found.
+        try:
+            resolve_parents(questionnaire_id)
+        except PathNotFound as e:
+            return MasonBuilder.create_error_response(404, "Not found", str(e))
+
+        try:
+            since = int(request.args.get("since", 0))
+            limit = int(request.args.get("limit", 100))
+        except ValueError:
+            return MasonBuilder.create_error_response(400, "Invalid query parameters",
+                                                      "The since and limit must be integers")
+        if since < 0 or not 1 <= limit <= self.MAX_LIMIT:
+            return MasonBuilder.create_error_response(400, "Invalid query parameters", "The since must not be "
+                                                      "negative and the limit must be between 1 and {}".format(
+                                                          self.MAX_LIMIT))
+
+        # Reads only the changes after 'since' from the index, with the current state of the answers.
+        changes = db.session.query(AnswerChange, Answer).outerjoin(
+            Answer, Answer.id == AnswerChange.answer_id
+        ).filter(
+            AnswerChange.questionnaire_id == questionnaire_id, AnswerChange.seq > since
+        ).order_by(AnswerChange.seq).limit(limit).all()
+
+        items = []
+        for change, answer in changes:
+            item = InventoryBuilder(
+                seq=change.seq,
+                operation=change.operation,
+                question_id=change.question_id,
+                answer_id=change.answer_id
+            )
+            if answer is not None and change.operation != "delete":
+                item["content"] = answer.content
+                item["userName"] = answer.userName
+                item.add_control("self", api.url_for(AnswerItem, questionnaire_id=questionnaire_id,
+                                                     question_id=answer.question_id, id=answer.id))
+            items.append(item)
+
+        last_seq = changes[-1][0].seq if changes else since
+        body = InventoryBuilder(
+            items=items,
+            last_seq=last_seq
+        )
+        body.add_namespace("survey", LINK_RELATIONS_URL)
+        body.add_control("self", api.url_for(AnswerChangeCollection, questionnaire_id=questionnaire_id,
+                                             since=since, limit=limit))
+        body.add_control("next", api.url_for(AnswerChangeCollection, questionnaire_id=questionnaire_id,
+                                             since=last_seq, limit=limit))
+        body.add_control("questionnaire-with", api.url_for(QuestionnaireItem, id=questionnaire_id))
+
+        return mason_response(body, 200)
+
+
+class Subscription(object):
+    """
+    The queue of the events of one live stream.
+    """
+
+    def __init__(self, questionnaire_id, max_size):
+        self.questionnaire_id = questionnaire_id
+        self.queue = queue.Queue(max_size)
+        self.overflowed = False
+
+
+class AnswerBroker(object):
+    """
+    An in-process fan-out of the committed answers to the live streams of each questionnaire.
+    The publishers only put the events into the queues of the subscribers, so a stream holds a queue
+    but no database connection. The queues and the lock are cooperative when gevent has patched them.
+    """
+
+    def __init__(self):
+        self.subscribers = collections.defaultdict(set)
+        self.lock = threading.Lock()
+
+    def subscribe(self, questionnaire_id):
+        subscription = Subscription(int(questionnaire_id), app.config["SSE_QUEUE_SIZE"])
+        with self.lock:
+            self.subscribers[subscription.questionnaire_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscribers[subscription.questionnaire_id].discard(subscription)
+            if not self.subscribers[subscription.questionnaire_id]:
+                del self.subscribers[subscription.questionnaire_id]
+
+    def has_subscribers(self):
+        return bool(self.subscribers)
+
+    def count(self):
+        with self.lock:
+            return sum(len(subscriptions) for subscriptions in self.subscribers.values())
+
+    def publish(self, questionnaire_id, seq, data):
+        """
+        Sends an event to every stream of the questionnaire. A stream whose queue is full is marked
+        as overflowed and closed, instead of blocking the publisher.
+        """
+        with self.lock:
+            subscriptions = list(self.subscribers.get(questionnaire_id, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.queue.put_nowait((seq, data))
+            except queue.Full:
+                subscription.overflowed = True
+                self.unsubscribe(subscription)
+
+
+answer_broker = AnswerBroker()
+
+
+def remember_answer_event(session, questionnaire_id, seq, data):
+    """
+    Remembers a new answer in the session, to be published to the streams after the commit.
+    """
+    session.info.setdefault("answer_events", []).append((questionnaire_id, seq, data))
+
+
+@event.listens_for(Answer, "after_insert")
+def queue_answer_event(mapper, connection, target):
+    """
+    Remembers a new answer in the session, to be published after the commit. The event id is the
+    sequence number of the change which the trigger has just logged, so a disconnected stream can
+    resume from the change log. Nothing is done when this worker has no streams.
+    """
+    if not answer_broker.has_subscribers():
+        return
+    seq, questionnaire_id = connection.execute(
+        "SELECT seq, questionnaire_id FROM answer_change ORDER BY seq DESC LIMIT 1").first()
+    remember_answer_event(object_session(target), questionnaire_id, seq, {
+        "id": target.id,
+        "question_id": int(target.question_id),
+        "content": target.content,
+        "userName": target.userName
+    })
+
+
+@event.listens_for(db.session, "after_commit")
+def publish_committed_answers(session):
+    for questionnaire_id, seq, data in session.info.pop("answer_events", ()):
+        answer_broker.publish(questionnaire_id, seq, data)
+
+
+@event.listens_for(db.session, "after_rollback")
+def forget_answer_events(session):
+    session.info.pop("answer_events", None)
+
+
+def format_sse(seq, data):
+    return "id: {}\nevent: answer\ndata: {}\n\n".format(seq, json.dumps(data))
+
+
+def stream_answers(subscription, backlog, heartbeat):
+    """
+    Yields the events of a live stream: first the missed answers, then the new ones as they are
+    published. The events which are also in the backlog are skipped.
+    """
+    last_seq = 0
+    try:
+        for seq, data in backlog:
+            last_seq = seq
+            yield format_sse(seq, data)
+        while not subscription.overflowed:
+            try:
+                seq, data = subscription.queue.get(timeout=heartbeat)
+            except queue.Empty:
+                yield ": heartbeat\n\n"
+                continue
+            if seq > last_seq:
+                yield format_sse(seq, data)
+    finally:
+        answer_broker.unsubscribe(subscription)
+
+
+class AnswerStream(Resource):
+    """
+    This class represents a resource called AnswerStream, a Server-Sent Events stream of the new
+    answers of one questionnaire. On this resource, there is only one function a client can use: GET.
+    """
+
+    def get(self, questionnaire_id):
+        """
+        This method is used to receive the new answers of a questionnaire as they are committed. A client
+        which reconnects with the Last-Event-ID header first receives the answers it missed.
+        """
+
+        # Resolves the whole path of the resource, and returns an error if any level is not found.
+        try:
+            questionnaire, = resolve_parents(questionnaire_id)
+        except PathNotFound as e:
+            return MasonBuilder.create_error_response(404, "Not found", str(e))
+
+        try:
+            last_event_id = int(request.headers.get("Last-Event-ID", request.args.get("since", 0)))
+        except ValueError:
+            return MasonBuilder.create_error_response(400, "Invalid query parameters",
+                                                      "The Last-Event-ID must be an integer")
+
+        # Subscribes before reading the backlog, so no answer is lost in between.
+        subscription = answer_broker.subscribe(questionnaire.id)
+        backlog = []
+        if last_event_id:
+            changes = db.session.query(AnswerChange.seq, Answer).join(
+                Answer, Answer.id == AnswerChange.answer_id
+            ).filter(
+                AnswerChange.questionnaire_id == questionnaire.id,
+                AnswerChange.seq > last_event_id,
+                AnswerChange.operation == "insert"
+            ).order_by(AnswerChange.seq)
+            for seq, answer in changes:
+                backlog.append((seq, {"id": answer.id, "question_id": answer.question_id,
+                                      "content": answer.content, "userName": answer.userName}))
+
+        # The stream itself does not use the database, so the connection is released right away.
+        db.session.remove()
+
+        response = Response(stream_answers(subscription, backlog, app.config["SSE_HEARTBEAT"]),
+                            mimetype="text/event-stream",
+                            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+        response.call_on_close(lambda: answer_broker.unsubscribe(subscription))
+        return response
+
+
+def fts_query(text):
+    """
+    Turns the words of a search into an FTS5 query which matches the rows containing all of the words.
+    Every word is quoted, so the FTS5 operators in the user input are searched as plain text. A word
+    ending with * is searched as a prefix.
+    """
+    terms = []
+    for word in text.split():
+        prefix = "*" if word.endswith("*") else ""
+        word = word.rstrip("*")
+        if word:
+            terms.append('"{}"{}'.format(word.replace('"', '""'), prefix))
+    return " ".join(terms)
+
+
+# A full-text match, with the shard of its database.
+SearchMatch = collections.namedtuple("SearchMatch", ["shard", "type", "id", "score"])
+
+
+class Search(Resource):
+    """
+    This class represents a resource called Search.
+    On this resource, there is only one function a client can use: GET.
+    """
+    SEARCH_TYPES = ["questionnaire", "question", "answer"]
+    MAX_LIMIT = 100
+
+    # The rows of the deleted questionnaires, which are not found until they are purged.
+    HIDDEN = {
+        "questionnaire": "SELECT id FROM questionnaire WHERE deleted",
+        "question": "SELECT question.id FROM questionnaire JOIN question ON "
+                    "question.questionnaire_id = questionnaire.id WHERE questionnaire.deleted",
+        "answer": "SELECT answer.id FROM questionnaire JOIN question ON question.questionnaire_id = questionnaire.id "
+                  "JOIN answer ON answer.question_id = question.id WHERE questionnaire.deleted",
+    }
+
+    def databases(self, types):
+        """
+        Returns the databases to search, as pairs of the shard and the types searched in it. With shards the
+        questionnaires are searched in the catalog, and the questions and answers in every shard.
+        """
+        shard_count = db.shard_count()
+        if not shard_count:
+            return [(None, types)]
+        databases = []
+        if "questionnaire" in types:
+            databases.append((None, ["questionnaire"]))
+        shard_types = [search_type for search_type in types if search_type != "questionnaire"]
+        if shard_types:
+            databases.extend((shard, shard_types) for shard in range(shard_count))
+        return databases
+
+    def load(self, search_type, ids):
+        """
+        Yields the id and the representation of each matched row of one type.
+        """
+        if search_type == "questionnaire":
+            for item in Questionnaire.query.filter(Questionnaire.id.in_(ids)):
+                body = InventoryBuilder(id=item.id, title=item.title, description=item.description)
+                body.add_control("self", api.url_for(QuestionnaireItem, id=item.id))
+                body.add_control("profile", QUESTIONNAIRE_PROFILE)
+                yield item.id, body
+        elif search_type == "question":
+            for item in Question.query.filter(Question.id.in_(ids)):
+                body = InventoryBuilder(
+                    id=item.id, questionnaire_id=item.questionnaire_id, title=item.title, description=item.description)
+                body.add_control("self", api.url_for(QuestionItem, questionnaire_id=item.questionnaire_id, id=item.id))
+                body.add_control("profile", QUESTION_PROFILE)
+                yield item.id, body
+        else:
+            answers = db.session.query(Answer, Question.questionnaire_id).join(Question).filter(Answer.id.in_(ids))
+            for item, questionnaire_id in answers:
+                body = InventoryBuilder(
+                    id=item.id, question_id=item.question_id, content=item.content, userName=item.userName)
+                body.add_control("self", api.url_for(
+                    AnswerItem, questionnaire_id=questionnaire_id, question_id=item.question_id, id=item.id))
+                body.add_control("profile", ANSWER_PROFILE)
+                yield item.id, body
+
+    def get(self):
+        """
+        This method is used to search questionnaires, questions and answers by keywords. The results are
+        ranked by relevance and paginated with the 'page' and 'limit' query parameters. The searched
+        types can be restricted with the 'type' query parameter, for example type=question,answer.
+        """
+        text = request.args.get("q", "")
+        query = fts_query(text)
+        if not query:
+            return MasonBuilder.create_error_response(400, "Invalid search", "The query parameter q is required")
+
+        types = request.args.get("type", ",".join(self.SEARCH_TYPES)).split(",")
+        if not set(types).issubset(self.SEARCH_TYPES):
+            return MasonBuilder.create_error_response(400, "Invalid search", "The type must be one of {}".format(
+                ", ".join(self.SEARCH_TYPES)))
+        try:
+            page = int(request.args.get("page", 1))
+            limit = int(request.args.get("limit", 20))
+        except ValueError:
+            return MasonBuilder.create_error_response(400, "Invalid search", "The page and limit must be integers")
+        if page < 1 or not 1 <= limit <= self.MAX_LIMIT:
+            return MasonBuilder.create_error_response(400, "Invalid search", "The page must be positive and the "
+                                                      "limit between 1 and {}".format(self.MAX_LIMIT))
+
+        # Ranks the matches of every type together, and fetches one extra row to know if there is a next page.
+        # One database skips the rows of the previous pages itself, the merged rows of many are skipped here.
+        databases = self.databases(types)
+        skip = (page - 1) * limit
+        offset = skip if len(databases) == 1 else 0
+        rows = []
+        for shard, shard_types in databases:
+            selects = ["SELECT '{0}' AS type, rowid AS id, bm25({0}_fts) AS score FROM {0}_fts "
+                       "WHERE {0}_fts MATCH :query AND rowid NOT IN ({1})".format(search_type, self.HIDDEN[search_type])
+                       for search_type in shard_types]
+            with routed_to(shard):
+                rows.extend(SearchMatch(shard, *row) for row in db.session.execute(
+                    "SELECT type, id, score FROM ({}) ORDER BY score LIMIT :limit OFFSET :offset".format(
+                        " UNION ALL ".join(selects)),
+                    {"query": query, "limit": skip - offset + limit + 1, "offset": offset}))
+        rows.sort(key=lambda row: row.score)
+        rows = rows[skip - offset:]
+        has_next = len(rows) > limit
+        rows = rows[:limit]
+
+        # Loads the matched rows with one query per type and database.
+        ids = collections.defaultdict(list)
+        for row in rows:
+            ids[row.shard, row.type].append(row.id)
+        found = {}
+        for (shard, search_type), type_ids in ids.items():
+            with routed_to(shard):
+                for id, item in self.load(search_type, type_ids):
+                    found[shard, search_type, id] = item
+
+        items = []
+        for row in rows:
+            item = found[row.shard, row.type, row.id]
+            item["type"] = row.type
+            item["score"] = -row.score
+            items.append(item)
+
+        body = InventoryBuilder(
+            items=items
+        )
+        body.add_namespace("survey", LINK_RELATIONS_URL)
+        args = {"q": text, "type": ",".join(types), "limit": limit}
+        body.add_control("self", api.url_for(Search, page=page, **args))
+        if page > 1:
+            body.add_control("prev", api.url_for(Search, page=page - 1, **args))
+        if has_next:
+            body.add_control("next", api.url_for(Search, page=page + 1, **args))
+
+        return mason_response(body, 200)
+
+
+class Batch(Resource):
+    """
+    This class represents a resource called Batch, which runs many requests to the API in one
+    HTTP request. On this resource, there is only one function a client can use: POST.
+    """
+    MAX_REQUESTS = 100
+
+    # The streams do not end, and batches would nest, so these resources can not be batched.
+    UNBATCHABLE = {"answerstream", "batch"}
+
+    def dispatch(self, method, href, body):
+        """
+        Runs one request in the current application context and returns its response.
+        """
+        data = json.dumps(body) if body is not None else None
+        with app.test_request_context(href, method=method, data=data, content_type="application/json"):
+            if request.url_rule is not None and request.url_rule.endpoint in self.UNBATCHABLE:
+                return MasonBuilder.create_error_response(400, "Invalid batch", "This resource can not be batched")
+            return app.full_dispatch_request()
+
+    def shard_of(self, method, href):
+        """
+        Returns the index of the shard which a request works on, or None for the catalog.
+        """
+        with app.test_request_context(href, method=method):
+            return db.session().routed_shard()
+
+    def post(self):
+        """
+        This method is used to run a list of requests in order and to return all of their responses.
+        When 'atomic' is true the requests are run in one transaction. It is committed only if every
+        request succeeds, otherwise the requests after the failed one are not run.
+        With shards, the requests of an atomic batch must work on one database, since the databases
+        are committed one after the other and a batch spanning them could be committed partially.
+        """
+
+        # Validity check of the request..
+        if not request.json:
+            return MasonBuilder.create_error_response(415, "Unsupported media type", "Request must be JSON")
+        try:
+            validate(request.json, MasonBuilder.batch_schema(self))
+        except ValidationError as e:
+            return MasonBuilder.create_error_response(400, "Invalid JSON document", str(e))
+        if len(request.json["requests"]) > self.MAX_REQUESTS:
+            return MasonBuilder.create_error_response(400, "Invalid JSON document", "A batch can have at most "
+                                                      "{} requests".format(self.MAX_REQUESTS))
+
+        # In an atomic batch every request runs in a subtransaction, so the commits of the resources only
+        # flush the changes, and a rollback discards the whole batch.
+        # The GET requests of the batch run on the writer too, so they see the uncommitted changes.
+        atomic = request.json.get("atomic", False)
+        if atomic and not repository().transactional:
+            return MasonBuilder.create_error_response(501, "Not implemented", "Atomic batches need the sql "
+                                                      "storage backend")
+        if atomic and db.shard_count() and len(set(
+                self.shard_of(sub_request["method"], sub_request["href"])
+                for sub_request in request.json["requests"])) > 1:
+            return MasonBuilder.create_error_response(400, "Invalid batch", "The requests of an atomic batch "
+                                                      "must work on the questionnaires of one shard")
+        session = db.session()
+        use_writer(session)
+        transaction = session.transaction
+        committed = True
+        responses = []
+        for sub_request in request.json["requests"]:
+            if atomic:
+                db.session.begin(subtransactions=True)
+            try:
+                response = self.dispatch(sub_request["method"], sub_request["href"], sub_request.get("body"))
+            except Exception as e:
+                response = MasonBuilder.create_error_response(500, "Internal server error", str(e))
+            if db.shard_count():
+                # The ids of the questions and answers repeat across the shards, so the rows of one
+                # request must not be found in the identity map of the session by the next one.
+                session.expunge_all()
+
+            result = {"status": response.status_code, "headers": {}, "body": None}
+            for name, value in response.headers.items():
+                if name not in ("Content-Length", "Content-Type"):
+                    result["headers"][name] = value
+            if response.is_json or response.mimetype == MASON:
+                result["body"] = json.loads(response.get_data(as_text=True))
+            responses.append(result)
+
+            failed = response.status_code >= 400
+            if atomic and failed:
+                while session.transaction is not transaction:
+                    db.session.rollback()
+                db.session.rollback()
+                committed = False
+                break
+            elif atomic and session.transaction is not transaction:
+                db.session.commit()
+            elif failed:
+                db.session.rollback()
+
+        if atomic and committed:
+            db.session.commit()
+
+        body = InventoryBuilder(
+            responses=responses
+        )
+        if atomic:
+            body["committed"] = committed
+        body.add_namespace("survey", LINK_RELATIONS_URL)
+        body.add_control("self", api.url_for(Batch))
+
+        return mason_response(body, 200)
+
+
+class JobCancelled(Exception):
+    """
+    Raised in a job at its progress report when the job has been cancelled.
+    """
+
+
+# The functions running each kind of job, by kind. A job function is called with a JobContext and
+# the params of the job as keyword arguments, and returns the location of its result.
+JOB_KINDS = {}
+
+
+def job_kind(kind):
+    """
+    Registers the decorated function as the function of a kind of job.
+    """
+    def register(function):
+        JOB_KINDS[kind] = function
+        return function
+    return register
+
+
+class JobContext(object):
+    """
+    Given to a running job, to report its progress.
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+
+    def progress(self, fraction):
+        """
+        Saves the progress of the job, which also shows that the job is alive. Raises JobCancelled if
+        the job has been cancelled, so the job should report its progress often. The transaction is
+        ended, so the job does not hold the writer connection until its next report.
+        """
+        Job.query.filter_by(id=self.job_id).update({"progress": fraction, "updated": datetime.utcnow()})
+        cancelled = db.session.query(Job.cancel_requested).filter_by(id=self.job_id).scalar()
+        db.session.commit()
+        if cancelled:
+            raise JobCancelled()
+
+
+# The kinds of the jobs which finish a change that has already been made through the API, like the purge
+# of a deleted questionnaire, which is hidden until its job is done. They can not be cancelled, and they
+# are retried by the job runner when they have failed.
+REQUIRED_JOB_KINDS = ("purge", "archive")
+
+
+class JobRunner(object):
+    """
+    Runs the queued jobs in a bounded pool of threads. Each thread claims the oldest queued job with
+    a conditional update, so a job is run only once even when many processes share the job table,
+    and takes the next one until the queue is empty. The jobs which are retried later are woken by a
+    timer.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.executor = None
+        self.futures = set()
+
+    def wake(self):
+        """
+        Starts a thread for the queued jobs, unless all the threads are already running.
+        """
+        with self.lock:
+            self.futures = set(future for future in self.futures if not future.done())
+            if len(self.futures) >= app.config["JOB_WORKERS"]:
+                return
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(app.config["JOB_WORKERS"])
+            self.futures.add(self.executor.submit(self.run_queued))
+
+    def wake_later(self, delay):
+        """
+        Starts a thread for the queued jobs after delay seconds.
+        """
+        timer = threading.Timer(delay, self.wake)
+        timer.daemon = True
+        timer.start()
+
+    def wait(self, timeout=None):
+        """
+        Waits until the threads have run all the queued jobs.
+        """
+        with self.lock:
+            futures = list(self.futures)
+        wait(futures, timeout)
+
+    @staticmethod
+    def next_queued():
+        return Job.query.filter(Job.status == "queued", or_(
+            Job.run_after.is_(None), Job.run_after <= datetime.utcnow())).order_by(Job.id).first()
+
+    def claim(self):
+        job = self.next_queued()
+        while job is not None:
+            claimed = Job.query.filter_by(id=job.id, status="queued").update(
+                {"status": "running", "attempts": Job.attempts + 1}, synchronize_session=False)
+            db.session.commit()
+            if claimed:
+                return Job.query.get(job.id)
+            job = self.next_queued()
+        return None
+
+    def run_queued(self):
+        with app.app_context():
+            try:
+                job = self.claim()
+                while job is not None:
+                    self.run(job)
+                    job = self.claim()
+            finally:
+                db.session.remove()
+
+    def run(self, job):
+        job_id = job.id
+        params = json.loads(job.params)
+        try:
+            # The job works on the shard of its questionnaire.
+            with routed_to(db.shard_of(params.get("questionnaire_id"))):
+                result = JOB_KINDS[job.kind](JobContext(job_id), **params)
+        except JobCancelled:
+            db.session.rollback()
+            changes = {"status": "cancelled"}
+        except Exception as e:
+            db.session.rollback()
+            changes = {"status": "failed", "error": str(e)[:512]}
+            if job.kind in REQUIRED_JOB_KINDS and job.attempts < app.config["JOB_MAX_ATTEMPTS"]:
+                delay = app.config["JOB_RETRY_DELAY"] * 2 ** (job.attempts - 1)
+                changes.update({"status": "queued", "progress": 0,
+                                "run_after": datetime.utcnow() + timedelta(seconds=delay)})
+        else:
+            changes = {"status": "done", "progress": 1, "result": result}
+        changes["updated"] = datetime.utcnow()
+        Job.query.filter_by(id=job_id).update(changes)
+        db.session.commit()
+        # The timer starts after the commit, so the retry is queued when it fires.
+        if changes["status"] == "queued":
+            self.wake_later(delay)
+
+
+job_runner = JobRunner()
+
+
+@event.listens_for(Job, "after_insert")
+def queue_job(mapper, connection, target):
+    object_session(target).info["jobs_queued"] = True
+
+
+@event.listens_for(db.session, "after_commit")
+def wake_job_runner(session):
+    """
+    The threads are started after the commit, since they can not see the new jobs before it.
+    """
+    if session.info.pop("jobs_queued", False):
+        job_runner.wake()
+
+
+@event.listens_for(db.session, "after_rollback")
+def forget_queued_jobs(session):
+    session.info.pop("jobs_queued", None)
+
+
+def recover_jobs():
+    """
+    Queues again the running jobs which have not reported progress for a while, since their process has
+    crashed or has been restarted, and starts running the queued jobs. The jobs which are retried later
+    are started when their time comes.
+    """
+    # It runs before the first request, which may be a GET.
+    use_writer(db.session())
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=app.config["JOB_STALE_AFTER"])
+    Job.query.filter(Job.status == "running", Job.updated < stale).update(
+        {"status": "queued", "progress": 0}, synchronize_session=False)
+    retry = db.session.query(func.min(Job.run_after)).filter(Job.status == "queued", Job.run_after > now).scalar()
+    db.session.commit()
+    job_runner.wake()
+    if retry is not None:
+        job_runner.wake_later((retry - now).total_seconds())
+
+
+@app.before_first_request
+def start_jobs():
+    recover_jobs()
+
+
+@job_kind("export")
+def export_job(context, questionnaire_id):
+    """
+    Exports a questionnaire into a file in the export folder, and returns the location of the file.
+    """
+    # pandas is only imported by the workers which run exports.
+    from export import export_questionnaire
+
+    if not os.path.isdir(app.config["EXPORT_FOLDER"]):
+        os.makedirs(app.config["EXPORT_FOLDER"])
+    name = "questionnaire-{}-{}.h5".format(questionnaire_id, context.job_id)
+    export_questionnaire(questionnaire_id, os.path.join(app.config["EXPORT_FOLDER"], name),
+                         progress=context.progress)
+    return "/exports/{}".format(name)
+
+
+def delete_questions(context, questionnaire_id):
+    """
+    Deletes the questions of a questionnaire with their answers. Each batch of answers and of
+    questions is deleted in its own short transaction, and the progress is reported after each one.
+    """
+    batch_size = app.config["PURGE_BATCH_SIZE"]
+    params = {"id": questionnaire_id, "limit": batch_size}
+    total = db.session.execute(
+        "SELECT (SELECT count(*) FROM answer JOIN question ON question.id = answer.question_id "
+        "WHERE question.questionnaire_id = :id) + (SELECT count(*) FROM question WHERE questionnaire_id = :id)",
+        params).scalar()
+    done = 0
+
+    while True:
+        deleted = db.session.execute(
+            "DELETE FROM answer WHERE id IN (SELECT answer.id FROM answer JOIN question ON "
+            "question.id = answer.question_id WHERE question.questionnaire_id = :id LIMIT :limit)", params).rowcount
+        db.session.commit()
+        if not deleted:
+            break
+        done += deleted
+        context.progress(float(done) / total)
+
+    while True:
+        ids = [row[0] for row in db.session.execute(
+            "SELECT id FROM question WHERE questionnaire_id = :id LIMIT :limit", params)]
+        if not ids:
+            break
+        Question.query.filter(Question.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        for question_id in ids:
+            entity_cache.invalidate(Question.__tablename__, question_id)
+        done += len(ids)
+        context.progress(float(done) / total)
+
+
+@job_kind("purge")
+def purge_job(context, questionnaire_id):
+    """
+    Deletes a deleted questionnaire with its questions, answers, archive and published documents. The
+    questionnaire itself is deleted last.
+    """
+    delete_questions(context, questionnaire_id)
+    Archive.query.filter_by(questionnaire_id=questionnaire_id).delete(synchronize_session=False)
+    Questionnaire.query.filter_by(id=questionnaire_id, deleted=True).delete(synchronize_session=False)
+    sync_questionnaire(questionnaire_id)
+    db.session.commit()
+    entity_cache.invalidate(Questionnaire.__tablename__, questionnaire_id)
+    for path in glob.glob(os.path.join(app.config["PUBLISH_FOLDER"], "questionnaire-{}-v*".format(questionnaire_id))):
+        os.remove(path)
+
+
+@job_kind("archive")
+def archive_job(context, questionnaire_id):
+    """
+    Moves the questions and answers of a questionnaire into its archive, and returns the location of
+    the questionnaire. The questionnaire is marked archived and its archive is written in one
+    transaction, so the reads switch to the archive at once. The rows are then deleted from the
+    question and answer tables in batches, which a retried job continues.
+    """
+    # The update is the first statement of the transaction, so it takes the write lock of the database
+    # and no answer can be written between reading the rows and marking the questionnaire archived.
+    params = {"id": questionnaire_id}
+    if Questionnaire.query.filter_by(id=questionnaire_id, deleted=False, archived=False).update(
+            {"archived": True}, synchronize_session=False):
+        questions = db.session.execute(
+            "SELECT id, title, description FROM question WHERE questionnaire_id = :id ORDER BY position, id",
+            params).fetchall()
+        answers = db.session.execute(
+            'SELECT answer.id, answer.question_id, answer.content, "user".name FROM answer '
+            'JOIN question ON question.id = answer.question_id JOIN "user" ON "user".id = answer.user_id '
+            'WHERE question.questionnaire_id = :id ORDER BY answer.id', params).fetchall()
+        db.session.add(Archive(questionnaire_id=questionnaire_id, question_count=len(questions),
+                               answer_count=len(answers), data=Archive.pack(questions, answers)))
+        sync_questionnaire(questionnaire_id)
+        db.session.commit()
+        entity_cache.invalidate(Questionnaire.__tablename__, questionnaire_id)
+    else:
+        db.session.rollback()
+        if Archive.query.get(questionnaire_id) is None:
+            raise ValueError("No questionnaire which can be archived was found with the id {}".format(
+                questionnaire_id))
+
+    delete_questions(context, questionnaire_id)
+
+    # FTS5 only marks the deleted rows, so the full-text indexes are merged to give back their space.
+    for fts_table in ["question_fts", "answer_fts"]:
+        db.session.execute("INSERT INTO {0}({0}) VALUES ('optimize')".format(fts_table))
+    db.session.commit()
+    return "/api/questionnaires/{}/".format(questionnaire_id)
+
+
+class QuestionnaireExport(Resource):
+    """
+    This class represents a resource called QuestionnaireExport, which starts the exports of a
+    questionnaire. On this resource, there is only one function a client can use: POST.
+    """
+
+    def post(self, questionnaire_id):
+        """
+        This method is used to start exporting a questionnaire with its questions and answers into an
+        HDF5 file. The export runs in the background, and the job which reports it is returned.
+        """
+
+        # Resolves the whole path of the resource, and returns an error if any level is not found.
+        try:
+            questionnaire, = resolve_parents(questionnaire_id)
+        except PathNotFound as e:
+            return MasonBuilder.create_error_response(404, "Not found", str(e))
+
+        job = Job(kind="export", params=json.dumps({"questionnaire_id": questionnaire.id}))
+        db.session.add(job)
+        db.session.commit()
+
+        return Response(status=202, headers={"Location": api.url_for(JobItem, id=job.id)})
+
+
+class QuestionnaireArchive(Resource):
+    """
+    This class represents a resource called QuestionnaireArchive, which archives a questionnaire.
+    On this resource, there is only one function a client can use: POST.
+    """
+
+    def post(self, questionnaire_id):
+        """
+        This method is used to move the questions and answers of a questionnaire into its archive. They
+        can still be read, but not changed. The archiving runs in the background, and the job which
+        reports it is returned.
+        """
+
+        # Resolves the whole path of the resource, and returns an error if any level is not found.
+        try:
+            questionnaire, = resolve_parents(questionnaire_id)
+        except PathNotFound as e:
+            return MasonBuilder.create_error_response(404, "Not found", str(e))
+        if questionnaire.archived:
+            return MasonBuilder.create_error_response(409, "Already archived", "The questionnaire {} is "
+                                                      "already archived".format(questionnaire_id))
+
+        job = Job(kind="archive", params=json.dumps({"questionnaire_id": questionnaire.id}))
+        db.session.add(job)
+        db.session.commit()
+
+        return Response(status=202, headers={"Location": api.url_for(JobItem, id=job.id)})
+
+
+class QuestionnaireClone(Resource):
+    """
+    This class represents a resource called QuestionnaireClone, which copies a questionnaire.
+    On this resource, there is only one function a client can use: POST.
+    """
+
+    def post(self, questionnaire_id):
+        """
+        This method is used to copy a questionnaire with its questions, and optionally with their answers,
+        into a new questionnaire. The request body is optional. The copy is made by the server in one
+        transaction, and its location is returned.
+        """
+
+        # Resolves the whole path of the resource, and returns an error if any level is not found.
+        try:
+            questionnaire, = repository().find(questionnaire_id)
+        except PathNotFound as e:
+            return MasonBuilder.create_error_response(404, "Not found", str(e))
+
+        options = request.json or {}
+        try:
+            validate(options, MasonBuilder.clone_schema(self))
+        except ValidationError as e:
+            return MasonBuilder.create_error_response(400, "Invalid JSON document", str(e))
+
+        clone_id = repository().clone_questionnaire(questionnaire, options.get("title", questionnaire.title),
+                                                    options.get("answers", False))
+
+        return Response(status=201, headers={"Location": api.url_for(QuestionnaireItem, id=clone_id)})
+
+
+# The suffixes of the precompressed copies of the published documents, by content coding.
+PUBLISHED_SUFFIXES = {"gzip": ".gz", "br": ".br"}
+
+
+def published_url(questionnaire_id, version):
+    return "/published/questionnaire-{}-v{}.json".format(questionnaire_id, version)
+
+
+def render_published(questionnaire_id, version):
+    """
+    Returns the published document of a questionnaire: the questionnaire with its questions as items.
+    """
+    questionnaire = Questionnaire.query.get(questionnaire_id)
+    if questionnaire.archived:
+        questions = list(load_archive(questionnaire_id).questions.values())
+    else:
+        questions = Question.query.filter_by(questionnaire_id=questionnaire_id).order_by(
+            Question.position, Question.id).all()
+    items = []
+    for question in questions:
+        item = InventoryBuilder(id=question.id, questionnaire_id=questionnaire_id, title=question.title,
+                                description=question.description)
+        item.add_control("self", api.url_for(QuestionItem, questionnaire_id=questionnaire_id, id=question.id))
+        item.add_control("profile", QUESTION_PROFILE)
+        items.append(item)
+
+    body = InventoryBuilder(
+        id=questionnaire.id,
+        title=questionnaire.title,
+        description=questionnaire.description,
+        version=version,
+        items=items
+    )
+    body.add_namespace("survey", LINK_RELATIONS_URL)
+    body.add_control("self", published_url(questionnaire_id, version))
+    body.add_control("profile", QUESTIONNAIRE_PROFILE)
+    body.add_control("up", api.url_for(QuestionnaireItem, id=questionnaire_id))
+    return body
+
+
+def publish_questionnaire(questionnaire_id):
+    """
+    Publishes the next version of a questionnaire, and returns the location of its document. The version
+    is taken in the transaction which reads the questions, so the document of each version is written
+    once, with the questions of that version. A file is written under a temporary name and renamed, so
+    it is never read half written. The precompressed copies are written first.
+    """
+    Questionnaire.query.filter_by(id=questionnaire_id).update(
+        {"published_version": func.coalesce(Questionnaire.published_version, 0) + 1}, synchronize_session=False)
+    version = db.session.query(Questionnaire.published_version).filter_by(id=questionnaire_id).scalar()
+    data = json.dumps(render_published(questionnaire_id, version)).encode("utf-8")
+
+    folder = app.config["PUBLISH_FOLDER"]
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    path = os.path.join(folder, os.path.basename(published_url(questionnaire_id, version)))
+    files = [(path + PUBLISHED_SUFFIXES["gzip"], compress(data, "gzip", 9))]
+    if brotli is not None:
+        files.append((path + PUBLISHED_SUFFIXES["br"], compress(data, "br", 11)))
+    files.append((path, data))
+    for file_path, content in files:
+        with open(file_path + ".tmp", "wb") as f:
+            f.write(content)
+        os.replace(file_path + ".tmp", file_path)
+
+    db.session.commit()
+    entity_cache.invalidate(Questionnaire.__tablename__, questionnaire_id)
+    return published_url(questionnaire_id, version)
+
+
+class QuestionnairePublish(Resource):
+    """
+    This class represents a resource called QuestionnairePublish, which publishes a questionnaire.
+    On this resource, there are two functions a client can use: GET and POST.
+    """
+
+    def get(self, questionnaire_id):
+        """
+        This method is used to find the current version of the published document of a questionnaire. It
+        redirects to the document.
+        """
+
+        # Resolves the whole path of the resource, and returns an error if any level is not found.
+        try:
+            questionnaire, = resolve_parents(questionnaire_id)
+        except PathNotFound as e:
+            return MasonBuilder.create_error_response(404, "Not found", str(e))
+        if not questionnaire.published_version:
+            return MasonBuilder.create_error_response(404, "Not published", "The questionnaire {} has not been "
+                                                      "published".format(questionnaire_id))
+
+        return Response(status=302, headers={
+            "Location": published_url(questionnaire.id, questionnaire.published_version),
+            "Cache-Control": "no-cache"})
+
+    def post(self, questionnaire_id):
+        """
+        This method is used to publish a questionnaire with its questions as an immutable document, which
+        is served from a file. The questionnaire is published again whenever it or its questions change,
+        each time with a new version.
+        """
+
+        # Resolves the whole path of the resource, and returns an error if any level is not found.
+        try:
+            questionnaire, = resolve_parents(questionnaire_id)
+        except PathNotFound as e:
+            return MasonBuilder.create_error_response(404, "Not found", str(e))
+
+        return Response(status=201, headers={"Location": publish_questionnaire(questionnaire.id)})
+
+
+class JobItem(Resource):
+    """
+    This class represents a resource called JobItem, a background job.
+    On this resource, there are two functions a client can use: GET and DELETE.
+    """
+    UNFINISHED = ("queued", "running")
+
+    def get(self, id):
+        """
+        This method is used to retrieve the status and the progress of a job. When the job is done, the
+        "result" control tells the location of its result.
+        """
+        job = Job.query.get(id)
+        if job is None:
+            return MasonBuilder.create_error_response(404, "Not found", "No job was found with the id {}".format(id))
+
+        body = InventoryBuilder(
+            id=job.id,
+            kind=job.kind,
+            status=job.status,
+            progress=job.progress,
+            error=job.error
+        )
+        body.add_namespace("survey", LINK_RELATIONS_URL)
+        body.add_control("self", api.url_for(JobItem, id=id))
+        headers = {}
+        if job.status == "done" and job.result:
+            body.add_control("result", job.result)
+        if job.status in self.UNFINISHED:
+            if job.kind not in REQUIRED_JOB_KINDS:
+                body.add_control("survey:cancel", api.url_for(JobItem, id=id), method="DELETE",
+                                 title="Cancel this job")
+            headers["Retry-After"] = "1"
+
+        return mason_response(body, 200, headers)
+
+    def delete(self, id):
+        """
+        This method is used to cancel a job. A queued job is cancelled right away, a running job stops
+        at its next progress report. The purges and the archives can not be cancelled.
+        """
+        job = Job.query.get(id)
+        if job is None:
+            return MasonBuilder.create_error_response(404, "Not found", "No job was found with the id {}".format(id))
+        if job.status not in self.UNFINISHED:
+            return MasonBuilder.create_error_response(409, "Already finished", "The job {} is {}".format(
+                id, job.status))
+        if job.kind in REQUIRED_JOB_KINDS:
+            return MasonBuilder.create_error_response(409, "Not cancellable", "The {} job {} can not be "
+                                                      "cancelled".format(job.kind, id))
+
+        Job.query.filter_by(id=job.id, status="queued").update({"status": "cancelled"})
+        Job.query.filter_by(id=job.id).update({"cancel_requested": True})
+        db.session.commit()
+
+        return Response(status=202, headers={"Location": api.url_for(JobItem, id=id)})
+
+
+class CompressionCache(object):
+    """
+    A bounded LRU cache of compressed response bodies. The entries are keyed by the digest of the
+    uncompressed body, the encoding and the level, so a hot response which renders to the same bytes
+    is compressed only once. Hashing the body is much cheaper than compressing it again.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            data = self.entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        with self.lock:
+            self.entries[key] = data
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+compression_cache = CompressionCache(app.config["COMPRESS_CACHE_SIZE"])
+
+
+def compress(data, encoding, level):
+    """
+    Compresses the data with the given encoding, which is either "br" or "gzip".
+    The gzip header is written without a timestamp so the same body always gives the same bytes.
+    """
+    if encoding == "br":
+        return brotli.compress(data, quality=level)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def choose_encoding():
+    """
+    Chooses the content coding from the Accept-Encoding header of the request. Brotli is preferred
+    when the client accepts both with the same quality. Returns None if neither is accepted.
+    """
+    available = ["br", "gzip"] if brotli is not None else ["gzip"]
+    encoding = max(available, key=lambda name: request.accept_encodings[name])
+    if request.accept_encodings[encoding] <= 0:
+        return None
+    return encoding
+
+
+@app.after_request
+def compress_response(response):
+    """
+    Compresses the Mason responses, in JSON or MessagePack, and the JSON responses which are large
+    enough, using the compressed bytes from the compression cache when the same body was already compressed.
+    """
+    if response.mimetype not in (MASON, MASON_MSGPACK, "application/json"):
+        return response
+    if response.direct_passthrough or response.is_streamed or "Content-Encoding" in response.headers:
+        return response
+
+    response.vary.add("Accept-Encoding")
+    data = response.get_data()
+    if len(data) < app.config["COMPRESS_MIN_SIZE"]:
+        return response
+
+    encoding = choose_encoding()
+    if encoding is None:
+        return response
+
+    if encoding == "br":
+        level = app.config["COMPRESS_BROTLI_LEVEL"]
+    else:
+        level = app.config["COMPRESS_GZIP_LEVEL"]
+    key = (hashlib.sha1(data).digest(), encoding, level)
+    compressed = compression_cache.get(key)
+    if compressed is None:
+        compressed = compress(data, encoding, level)
+        compression_cache.put(key, compressed)
+
+    response.set_data(compressed)
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+class Flight(object):
+    """
+    One response being computed for the requests which wait for it. The result is the status, the
+    headers and the body of the response, or None if it can not be shared.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces the identical read requests which run at the same time in the worker. The first request
+    of a key computes the response, and the others wait for it and are sent a copy of it instead of
+    running the same queries and serialization.
+
+    The generation counts the commits of the worker. It is a part of the keys, so a request which
+    arrives after a commit does not wait for a response which may have been read before it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.generation = 0
+        self.leaders = 0
+        self.coalesced = 0
+
+    def join(self, key, timeout):
+        """
+        Returns (True, None) if the request is the first one of the key, which then has to finish it.
+        Otherwise waits for the first one and returns (False, its result). The result is None if the
+        response could not be shared or was not ready within the timeout.
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None:
+                self.flights[key] = Flight()
+                self.leaders += 1
+                return True, None
+        flight.done.wait(timeout)
+        if flight.result is not None:
+            with self.lock:
+                self.coalesced += 1
+        return False, flight.result
+
+    def finish(self, key, result):
+        """
+        Gives the result of a key to the requests waiting for it. The next request of the key computes
+        the response again.
+        """
+        with self.lock:
+            flight = self.flights.pop(key, None)
+        if flight is not None:
+            flight.result = result
+            flight.done.set()
+
+    def committed(self):
+        """
+        Starts a new generation, whose requests do not join the flights of the previous ones.
+        """
+        with self.lock:
+            self.generation += 1
+
+    def stats(self):
+        with self.lock:
+            return {"leaders": self.leaders, "coalesced": self.coalesced, "in_flight": len(self.flights)}
+
+
+single_flight = SingleFlight()
+
+
+@event.listens_for(db.session, "after_commit")
+def start_flight_generation(session):
+    single_flight.committed()
+
+
+@app.before_request
+def join_flight():
+    """
+    Sends the response of an identical request which is already running, if there is one. The key is
+    the method, the path with the query string, the Accept header which chooses the representation, and
+    the generation of the last commit of the worker.
+    The reads which run on the writer, like the ones of a batch, may see uncommitted changes, so they
+    are not coalesced.
+    """
+    if not app.config["COALESCE_REQUESTS"] or request.method not in RoutingSession.READ_METHODS:
+        return None
+    if db.session().info.get("writer"):
+        return None
+    key = (request.method, request.full_path, request.headers.get("Accept", ""), single_flight.generation)
+    leader, result = single_flight.join(key, app.config["COALESCE_TIMEOUT"])
+    if leader:
+        g.flight = key
+        return None
+    if result is None:
+        return None
+    status, headers, body = result
+    return Response(body, status, headers)
+
+
+# Flask runs the after_request functions in the reverse order of their registration, so this one runs
+# before compress_response. The shared body is compressed for each request, through the compression cache.
+@app.after_request
+def share_flight(response):
+    key = g.pop("flight", None)
+    if key is not None:
+        result = None
+        if not response.is_streamed and not response.direct_passthrough:
+            result = (response.status_code, list(response.headers), response.get_data())
+        single_flight.finish(key, result)
+    return response
+
+
+@app.teardown_request
+def end_flight(exc):
+    """
+    Lets the waiting requests compute their own response if the first one failed.
+    """
+    key = g.pop("flight", None)
+    if key is not None:
+        single_flight.finish(key, None)
 
 
 # url map
@@ -1060,12 +4382,32 @@ api.add_resource(QuestionnaireItem, "/api/questionnaires/<id>/")
 api.add_resource(QuestionCollection, "/api/questionnaires/<questionnaire_id>/questions/")
 # Adding the QuestionItem resource into our API.
 api.add_resource(QuestionItem, "/api/questionnaires/<questionnaire_id>/questions/<id>/")
+# Adding the QuestionMove resource into our API.
+api.add_resource(QuestionMove, "/api/questionnaires/<questionnaire_id>/questions/<id>/move/")
 # Adding the AnswerCollection resource into our API.
 api.add_resource(AnswerCollection, "/api/questionnaires/<questionnaire_id>/questions/<question_id>/answers/")
 # Adding the AnswerItem resource into our API.
 api.add_resource(AnswerItem, "/api/questionnaires/<questionnaire_id>/questions/<question_id>/answers/<id>/")
 # Adding the AnswerOfUserToQuestionnaire resource into our API.
 api.add_resource(AnswerOfUserToQuestionnaire, "/api/questionnaires/<questionnaire_id>/answers/<userName>/")
+# Adding the AnswerChangeCollection resource into our API.
+api.add_resource(AnswerChangeCollection, "/api/questionnaires/<questionnaire_id>/changes/")
+# Adding the AnswerStream resource into our API.
+api.add_resource(AnswerStream, "/api/questionnaires/<questionnaire_id>/changes/stream/")
+# Adding the Search resource into our API.
+api.add_resource(Search, "/api/search/")
+# Adding the Batch resource into our API.
+api.add_resource(Batch, "/api/batch/")
+# Adding the QuestionnaireExport resource into our API.
+api.add_resource(QuestionnaireExport, "/api/questionnaires/<questionnaire_id>/export/")
+# Adding the QuestionnaireArchive resource into our API.
+api.add_resource(QuestionnaireArchive, "/api/questionnaires/<questionnaire_id>/archive/")
+# Adding the QuestionnairePublish resource into our API.
+api.add_resource(QuestionnairePublish, "/api/questionnaires/<questionnaire_id>/publish/")
+# Adding the QuestionnaireClone resource into our API.
+api.add_resource(QuestionnaireClone, "/api/questionnaires/<questionnaire_id>/clone/")
+# Adding the JobItem resource into our API.
+api.add_resource(JobItem, "/api/jobs/<id>/")
 
 
 # The next lines for the addressability our API.
@@ -1089,6 +4431,51 @@ def profilesforerror():
     return "", 200
 
 
+@app.route("/profiles/compact/")
+def profilesforcompact():
+    return "", 200
+
+
+@app.route("/exports/<name>")
+def exported_file(name):
+    return send_from_directory(app.config["EXPORT_FOLDER"], name)
+
+
+@app.route("/published/<name>")
+def published_file(name):
+    """
+    Sends a published document from its file, precompressed if the client accepts it. The file is sent
+    by the server without being read into the application.
+    """
+    folder = app.config["PUBLISH_FOLDER"]
+    encoding = choose_encoding()
+    response = None
+    if encoding is not None:
+        try:
+            response = send_from_directory(folder, name + PUBLISHED_SUFFIXES[encoding], mimetype=MASON,
+                                           conditional=True)
+            response.headers["Content-Encoding"] = encoding
+        except NotFound:
+            pass
+    if response is None:
+        response = send_from_directory(folder, name, mimetype=MASON, conditional=True)
+    response.vary.add("Accept-Encoding")
+    response.headers["Cache-Control"] = "public, max-age={}, immutable".format(app.config["PUBLISH_MAX_AGE"])
+    return response
+
+
+# The counters of the caches of this worker.
+@app.route("/stats/")
+def stats():
+    return jsonify({
+        "entity_cache": entity_cache.stats(),
+        "compression_cache": {"hits": compression_cache.hits, "misses": compression_cache.misses},
+        "answer_streams": answer_broker.count(),
+        "writer_lock": writer_lock.stats(),
+        "single_flight": single_flight.stats(),
+    })
+
+
 @app.route("/survey/link-relations/")
 def relations():
     return "", 200
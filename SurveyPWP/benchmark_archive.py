@@ -0,0 +1,99 @@
+"""
+Benchmark of the archive: the size of the database and the latency of the reads before and after
+the old questionnaires are archived.
+
+Generates a temporary database with questionnaires whose questions have the given number of answers
+each, and measures the database and one active questionnaire. Then all the other questionnaires are
+archived by their jobs, the database is vacuumed and measured again, and the reads of an archived
+questionnaire are timed too. The sizes per table and index need SQLite with the dbstat table.
+
+Usage: python benchmark_archive.py [number of questionnaires] [answers per question]
+"""
+import os
+import sys
+import tempfile
+import timeit
+
+from sqlalchemy.exc import OperationalError
+
+from app import app, db, job_runner
+
+ROUNDS = 50
+QUESTIONS_PER_QUESTIONNAIRE = 10
+TABLES = ["answer", "ix_answer_question_id", "ix_answer_question_user", "ix_answer_question_content",
+          "answer_fts_data", "answer_change", "archive"]
+
+
+def populate(questionnaires, answers):
+    """
+    Creates the questionnaires, their questions and one answer of each user to every question.
+    """
+    db.session.execute('INSERT INTO "user" (id, name) VALUES ' + ", ".join(
+        "({0}, 'user-{0:06d}@example.com')".format(i) for i in range(1, answers + 1)))
+    for questionnaire_id in range(1, questionnaires + 1):
+        db.session.execute("INSERT INTO questionnaire (id, title, description, deleted, archived) "
+                           "VALUES (:id, :title, 'A generated questionnaire', 0, 0)",
+                           {"id": questionnaire_id, "title": "questionnaire-{}".format(questionnaire_id)})
+        for question in range(QUESTIONS_PER_QUESTIONNAIRE):
+            question_id = db.session.execute(
+                "INSERT INTO question (questionnaire_id, title, description) VALUES (:id, :title, NULL)",
+                {"id": questionnaire_id, "title": "question-{}".format(question)}).lastrowid
+            db.session.execute(
+                "INSERT INTO answer (question_id, content, user_id) SELECT :question_id, "
+                "'Generated answer of user ' || id || ' to question ' || :question_id, id FROM \"user\"",
+                {"question_id": question_id})
+    db.session.commit()
+
+
+def measure(name, path, client, urls):
+    db.session.execute("VACUUM")
+    print("{} ({} bytes)".format(name, os.path.getsize(path)))
+    try:
+        sizes = dict(db.session.execute("SELECT name, sum(pgsize) FROM dbstat GROUP BY name").fetchall())
+        for table in TABLES:
+            print("{:>40} {:>12}".format(table, sizes.get(table, 0)))
+    except OperationalError:
+        print("{:>40}".format("(no dbstat, sizes per table are not available)"))
+
+    for url_name, url in urls:
+        seconds = timeit.timeit(lambda: client.get(url), number=ROUNDS) / ROUNDS
+        print("{:>40} {:>12.3f} ms".format(url_name, seconds * 1000))
+    print("")
+
+
+def main(questionnaires, answers):
+    db_fd, db_fname = tempfile.mkstemp()
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + db_fname
+    try:
+        db.create_all()
+        populate(questionnaires, answers)
+        client = app.test_client()
+
+        # The first question of the last questionnaire stays active, the first one is archived.
+        active = (questionnaires - 1) * QUESTIONS_PER_QUESTIONNAIRE + 1
+        active_urls = [
+            ("active answers", "/api/questionnaires/{}/questions/{}/answers/".format(questionnaires, active)),
+            ("active answers of a user", "/api/questionnaires/{}/answers/user-000001@example.com/".format(
+                questionnaires)),
+        ]
+        measure("before archiving", db_fname, client, active_urls)
+
+        for questionnaire_id in range(1, questionnaires):
+            client.post("/api/questionnaires/{}/archive/".format(questionnaire_id))
+        job_runner.wait(3600)
+        db.session.remove()
+
+        measure("after archiving {} questionnaires".format(questionnaires - 1), db_fname, client, active_urls + [
+            ("archived answers", "/api/questionnaires/1/questions/1/answers/"),
+            ("archived answers of a user", "/api/questionnaires/1/answers/user-000001@example.com/"),
+            ("archived answer", "/api/questionnaires/1/questions/1/answers/1/"),
+        ])
+    finally:
+        db.session.remove()
+        os.close(db_fd)
+        os.unlink(db_fname)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
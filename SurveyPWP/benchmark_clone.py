@@ -0,0 +1,73 @@
+"""
+Benchmark of cloning a questionnaire: on the server with one request, with and without the answers,
+and by a client which reads the questions and posts them one by one to a new questionnaire.
+
+Creates a questionnaire with the given number of questions and answers to each on a temporary
+database, and prints the time of each way of cloning it.
+
+Usage: python benchmark_clone.py [number of questions] [answers per question] [rounds]
+"""
+import json
+import os
+import sys
+import tempfile
+import timeit
+
+from app import app, db, Questionnaire, Question, Answer, User
+
+
+def populate(questions, answers):
+    questionnaire = Questionnaire(title="benchmark")
+    db.session.add(questionnaire)
+    users = [User(name="user-{}".format(number)) for number in range(answers)]
+    for number in range(questions):
+        question = Question(title="question-{}".format(number), questionnaire=questionnaire)
+        db.session.add(question)
+        for user in users:
+            db.session.add(Answer(question=question, content="answer", user=user))
+    db.session.commit()
+    return questionnaire.id
+
+
+def fields(item):
+    return {name: item[name] for name in ["title", "description"] if item[name] is not None}
+
+
+def clone_by_client(client, questionnaire_id):
+    url = "/api/questionnaires/{}/".format(questionnaire_id)
+    questionnaire = json.loads(client.get(url).data)
+    location = client.post("/api/questionnaires/", json=fields(questionnaire)).headers["Location"]
+    for item in json.loads(client.get(url + "questions/").data)["items"]:
+        question = json.loads(client.get(item["@controls"]["self"]["href"]).data)
+        client.post(location + "questions/", json=fields(question))
+
+
+def main(questions, answers, rounds):
+    db_fd, db_fname = tempfile.mkstemp()
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + db_fname
+    try:
+        db.create_all()
+        questionnaire_id = populate(questions, answers)
+        db.session.remove()
+        client = app.test_client()
+        url = "/api/questionnaires/{}/clone/".format(questionnaire_id)
+
+        print("{} questions, {} answers per question, {} rounds".format(questions, answers, rounds))
+        print("{:>24} {:>10}".format("clone", "ms"))
+        for name, clone in [("server", lambda: client.post(url)),
+                            ("server with answers", lambda: client.post(url, json={"answers": True})),
+                            ("client", lambda: clone_by_client(client, questionnaire_id))]:
+            print("{:>24} {:>10.1f}".format(name, timeit.timeit(clone, number=rounds) / rounds * 1000))
+    finally:
+        db.session.remove()
+        db.dispose_engines()
+        os.close(db_fd)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_fname + suffix):
+                os.unlink(db_fname + suffix)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 10,
+         int(sys.argv[3]) if len(sys.argv) > 3 else 5)
@@ -0,0 +1,81 @@
+"""
+Benchmark of the coalescing of the identical GET requests.
+
+Runs the given number of client threads, which all get the questions of the same questionnaire at
+the same time, like the respondents of a survey link which was just sent, for the given number of
+seconds on a generated temporary database. The requests are run first without coalescing and then
+with it. Prints the throughput, the latencies and the number of requests which were sent the
+response of another one.
+
+Usage: python benchmark_coalescing.py [clients] [seconds] [number of questions]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from app import app, db, single_flight, Questionnaire, Question
+from benchmark_routing import percentile
+
+
+def populate(count):
+    questionnaire = Questionnaire(title="benchmark", description="A generated questionnaire")
+    db.session.add(questionnaire)
+    for i in range(count):
+        db.session.add(Question(questionnaire=questionnaire, title="question-{}".format(i),
+                                description="The generated question number {}".format(i)))
+    db.session.commit()
+    return questionnaire.id
+
+
+def work(url, deadline, latencies):
+    client = app.test_client()
+    while time.time() < deadline:
+        started = time.time()
+        client.get(url)
+        latencies.append(time.time() - started)
+
+
+def run(name, coalesce, url, clients, seconds):
+    app.config["COALESCE_REQUESTS"] = coalesce
+    coalesced = single_flight.stats()["coalesced"]
+    latencies = []
+    deadline = time.time() + seconds
+    threads = [threading.Thread(target=work, args=(url, deadline, latencies)) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print("{:>12} {:>10.1f} {:>10.1f} {:>10.1f} {:>10}".format(
+        name, len(latencies) / float(seconds), percentile(latencies, 0.5) * 1000,
+        percentile(latencies, 0.99) * 1000, single_flight.stats()["coalesced"] - coalesced))
+
+
+def main(clients, seconds, count):
+    db_fd, db_fname = tempfile.mkstemp()
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + db_fname
+    try:
+        db.create_all()
+        url = "/api/questionnaires/{}/questions/".format(populate(count))
+        db.session.remove()
+        app.test_client().get("/api/")
+
+        print("{} clients, {} questions, {} seconds".format(clients, count, seconds))
+        print("{:>12} {:>10} {:>10} {:>10} {:>10}".format("coalescing", "req/s", "p50 ms", "p99 ms", "coalesced"))
+        run("off", False, url, clients, seconds)
+        run("on", True, url, clients, seconds)
+    finally:
+        app.config["COALESCE_REQUESTS"] = True
+        db.session.remove()
+        db.dispose_engines()
+        os.close(db_fd)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_fname + suffix):
+                os.unlink(db_fname + suffix)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 32,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 10,
+         int(sys.argv[3]) if len(sys.argv) > 3 else 50)
@@ -0,0 +1,76 @@
+"""
+Benchmark of the response compression: CPU cost versus bytes saved.
+
+Renders the QuestionnaireCollection and AnswerCollection bodies from a generated temporary
+database, then compresses them with gzip and brotli on several levels. The last column shows the
+cost of serving the same body from the compression cache, which is only a digest and a lookup.
+
+Usage: python benchmark_compression.py [number of items]
+"""
+import hashlib
+import os
+import sys
+import tempfile
+import timeit
+
+from app import app, db, brotli, compress, Questionnaire, Question, Answer
+
+ROUNDS = 20
+
+
+def populate(count):
+    """
+    Creates the given number of questionnaires, and one question with the given number of answers.
+    """
+    for i in range(count):
+        db.session.add(Questionnaire(title="questionnaire-{}".format(i),
+                                     description="A generated questionnaire for the benchmark"))
+    question = Question(title="question", description="A generated question",
+                        questionnaire=Questionnaire(title="answered"))
+    db.session.add(question)
+    for i in range(count):
+        db.session.add(Answer(question=question, content="Generated answer number {}".format(i),
+                              userName="user-{}".format(i)))
+    db.session.commit()
+    return question
+
+
+def measure(name, data):
+    """
+    Prints the size and the time of each encoding and level for one body.
+    """
+    print("{} ({} bytes)".format(name, len(data)))
+    print("{:>8} {:>6} {:>10} {:>8} {:>12} {:>12}".format(
+        "encoding", "level", "bytes", "ratio", "ms/compress", "ms/cached"))
+    cases = [("gzip", level) for level in (1, 6, 9)]
+    if brotli is not None:
+        cases += [("br", level) for level in (1, 5, 11)]
+    for encoding, level in cases:
+        compressed = compress(data, encoding, level)
+        seconds = timeit.timeit(lambda: compress(data, encoding, level), number=ROUNDS) / ROUNDS
+        cache = {(hashlib.sha1(data).digest(), encoding, level): compressed}
+        cached = timeit.timeit(lambda: cache.get((hashlib.sha1(data).digest(), encoding, level)),
+                               number=ROUNDS) / ROUNDS
+        print("{:>8} {:>6} {:>10} {:>8.3f} {:>12.3f} {:>12.4f}".format(
+            encoding, level, len(compressed), len(compressed) / len(data), seconds * 1000, cached * 1000))
+    print("")
+
+
+def main(count):
+    db_fd, db_fname = tempfile.mkstemp()
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + db_fname
+    try:
+        db.create_all()
+        question = populate(count)
+        answers_url = "/api/questionnaires/{}/questions/{}/answers/".format(question.questionnaire_id, question.id)
+        client = app.test_client()
+        measure("QuestionnaireCollection.get", client.get("/api/questionnaires/").data)
+        measure("AnswerCollection.get", client.get(answers_url).data)
+    finally:
+        db.session.remove()
+        os.close(db_fd)
+        os.unlink(db_fname)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
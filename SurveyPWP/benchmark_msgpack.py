@@ -0,0 +1,60 @@
+"""
+Benchmark of the MessagePack encoding of the Mason documents against JSON: payload size, and the
+time to encode and decode a document.
+
+Renders the QuestionnaireCollection and AnswerCollection documents from a generated temporary
+database, then encodes and decodes them with both encodings, like the server and a client do.
+
+Usage: python benchmark_msgpack.py [number of items]
+"""
+import json
+import os
+import sys
+import tempfile
+import timeit
+
+import msgpack
+
+from app import app, db
+from benchmark_compression import populate
+
+ROUNDS = 20
+
+
+def measure(name, body):
+    """
+    Prints the size, the encoding time and the decoding time of one document in both encodings.
+    """
+    print(name)
+    print("{:>8} {:>10} {:>10} {:>10}".format("encoding", "bytes", "ms/encode", "ms/decode"))
+    cases = [
+        ("json", json.dumps, json.loads),
+        ("msgpack", lambda data: msgpack.packb(data, use_bin_type=True), lambda data: msgpack.unpackb(data, raw=False)),
+    ]
+    for encoding, encode, decode in cases:
+        data = encode(body)
+        encode_seconds = timeit.timeit(lambda: encode(body), number=ROUNDS) / ROUNDS
+        decode_seconds = timeit.timeit(lambda: decode(data), number=ROUNDS) / ROUNDS
+        print("{:>8} {:>10} {:>10.3f} {:>10.3f}".format(encoding, len(data), encode_seconds * 1000,
+                                                         decode_seconds * 1000))
+    print("")
+
+
+def main(count):
+    db_fd, db_fname = tempfile.mkstemp()
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + db_fname
+    try:
+        db.create_all()
+        question = populate(count)
+        answers_url = "/api/questionnaires/{}/questions/{}/answers/".format(question.questionnaire_id, question.id)
+        client = app.test_client()
+        measure("QuestionnaireCollection.get", json.loads(client.get("/api/questionnaires/").data))
+        measure("AnswerCollection.get", json.loads(client.get(answers_url).data))
+    finally:
+        db.session.remove()
+        os.close(db_fd)
+        os.unlink(db_fname)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
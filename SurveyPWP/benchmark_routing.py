@@ -0,0 +1,90 @@
+"""
+Benchmark of the routing of the requests to the read and write engines.
+
+Runs reader threads, which get the answers of a question, and writer threads, which post answers, at
+the same time for the given number of seconds on a generated temporary database. The requests are
+run first on the default engine (SQLITE_READ_CONNECTIONS = 0, rollback journal) and then routed to
+the read-only connections and the writer connection in WAL mode. Prints the throughput and the
+latencies of the reads and the writes, and the number of failed requests.
+
+Usage: python benchmark_routing.py [readers] [writers] [seconds] [number of answers]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from app import app, db
+from benchmark_compression import populate
+
+
+def work(client, method, url, body, deadline, latencies, errors):
+    count = 0
+    while time.time() < deadline:
+        count += 1
+        started = time.time()
+        if method == "GET":
+            resp = client.get(url)
+        else:
+            resp = client.post(url, json=dict(body, userName="{}-{}".format(body["userName"], count)))
+        if resp.status_code >= 400:
+            errors.append(resp.status_code)
+        else:
+            latencies.append(time.time() - started)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float("nan")
+
+
+def run(name, read_connections, readers, writers, seconds, count):
+    db_fd, db_fname = tempfile.mkstemp()
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + db_fname
+    app.config["SQLITE_READ_CONNECTIONS"] = read_connections
+    try:
+        db.create_all()
+        question = populate(count)
+        url = "/api/questionnaires/{}/questions/{}/answers/".format(question.questionnaire_id, question.id)
+        db.session.remove()
+
+        results = {"GET": ([], []), "POST": ([], [])}
+        deadline = time.time() + seconds
+        threads = []
+        for number in range(readers + writers):
+            method = "GET" if number < readers else "POST"
+            body = {"content": "posted", "userName": "writer-{}".format(number)}
+            threads.append(threading.Thread(target=work, args=(app.test_client(), method, url, body, deadline) +
+                                            results[method]))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for method, (latencies, errors) in sorted(results.items()):
+            print("{:>10} {:>6} {:>10.1f} {:>10.1f} {:>10.1f} {:>8}".format(
+                name, method, len(latencies) / float(seconds), percentile(latencies, 0.5) * 1000,
+                percentile(latencies, 0.99) * 1000, len(errors)))
+    finally:
+        db.session.remove()
+        db.dispose_engines()
+        os.close(db_fd)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_fname + suffix):
+                os.unlink(db_fname + suffix)
+
+
+def main(readers, writers, seconds, count):
+    print("{} readers, {} writers, {} answers, {} seconds".format(readers, writers, count, seconds))
+    print("{:>10} {:>6} {:>10} {:>10} {:>10} {:>8}".format("engines", "method", "req/s", "p50 ms", "p99 ms",
+                                                           "failed"))
+    run("default", 0, readers, writers, seconds, count)
+    run("routed", 8, readers, writers, seconds, count)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 8,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 2,
+         int(sys.argv[3]) if len(sys.argv) > 3 else 10,
+         int(sys.argv[4]) if len(sys.argv) > 4 else 100)
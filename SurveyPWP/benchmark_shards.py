@@ -0,0 +1,90 @@
+"""
+Benchmark of the write throughput with the questionnaires sharded into 1, 2 and 4 databases.
+
+Creates the given number of questionnaires with one question each on temporary databases, and then
+runs one writer process per questionnaire, like the worker processes of gunicorn, which posts
+answers to its question for the given number of seconds. The writers of the questionnaires of one
+shard wait for each other on the lock of its SQLite file, while the shards are written at the same
+time. Prints the throughput and the latencies of the writes, and the number of failed requests, for
+no sharding and for each number of shards.
+
+Usage: python benchmark_shards.py [questionnaires] [seconds]
+"""
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from app import app, db
+from benchmark_routing import percentile
+
+SHARDS = [0, 1, 2, 4]
+
+
+def write(url, number, deadline, results):
+    client = app.test_client()
+    latencies, errors = [], []
+    count = 0
+    while time.time() < deadline:
+        count += 1
+        started = time.time()
+        resp = client.post(url, json={"content": "posted", "userName": "writer-{}-{}".format(number, count)})
+        if resp.status_code >= 400:
+            errors.append(resp.status_code)
+        else:
+            latencies.append(time.time() - started)
+    results.put((latencies, errors))
+
+
+def run(shards, questionnaires, seconds):
+    folder = tempfile.mkdtemp()
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(folder, "catalog.db")
+    app.config["SHARD_URIS"] = ["sqlite:///" + os.path.join(folder, "shard-{}.db".format(i)) for i in range(shards)]
+    try:
+        db.create_all()
+        client = app.test_client()
+        urls = []
+        for number in range(questionnaires):
+            questionnaire = client.post("/api/questionnaires/", json={"title": "questionnaire-{}".format(number)})
+            question = client.post(questionnaire.headers["Location"] + "questions/", json={"title": "question"})
+            urls.append(question.headers["Location"] + "answers/")
+        # The processes open connections of their own.
+        db.session.remove()
+        db.dispose_engines()
+        db.engine.dispose()
+
+        results = multiprocessing.Queue()
+        deadline = time.time() + seconds
+        processes = [multiprocessing.Process(target=write, args=(url, number, deadline, results))
+                     for number, url in enumerate(urls)]
+        for process in processes:
+            process.start()
+        latencies, errors = [], []
+        for _ in processes:
+            process_latencies, process_errors = results.get()
+            latencies.extend(process_latencies)
+            errors.extend(process_errors)
+        for process in processes:
+            process.join()
+        print("{:>8} {:>10.1f} {:>10.1f} {:>10.1f} {:>8}".format(
+            shards or "none", len(latencies) / float(seconds), percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.99) * 1000, len(errors)))
+    finally:
+        db.session.remove()
+        db.dispose_engines()
+        app.config["SHARD_URIS"] = []
+        shutil.rmtree(folder)
+
+
+def main(questionnaires, seconds):
+    print("{} questionnaires, {} seconds".format(questionnaires, seconds))
+    print("{:>8} {:>10} {:>10} {:>10} {:>8}".format("shards", "writes/s", "p50 ms", "p99 ms", "failed"))
+    for shards in SHARDS:
+        run(shards, questionnaires, seconds)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 8,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 10)
@@ -0,0 +1,89 @@
+"""
+Load test of the live answer streams.
+
+Opens the given number of concurrent streams of one questionnaire on a running server, posts answers
+to one of its questions and measures how long it takes until every stream has received each answer.
+The clients are greenlets when gevent is installed, otherwise threads.
+
+Usage: python benchmark_sse.py <host:port> <questionnaire id> <question id> [subscribers] [answers]
+The server can be run for example with: gunicorn -k gevent -b 127.0.0.1:8000 app:app
+"""
+try:
+    from gevent import monkey
+    monkey.patch_all()
+except ImportError:
+    monkey = None
+
+import http.client
+import json
+import sys
+import threading
+import time
+
+received = []
+connected = []
+lock = threading.Lock()
+
+
+def subscribe(host, questionnaire_id, expected):
+    """
+    Reads one stream until the expected number of answers has been received.
+    """
+    conn = http.client.HTTPConnection(host, timeout=60)
+    conn.request("GET", "/api/questionnaires/{}/changes/stream/".format(questionnaire_id))
+    resp = conn.getresponse()
+    with lock:
+        connected.append(resp.status)
+    count = 0
+    while count < expected:
+        line = resp.fp.readline()
+        if not line:
+            break
+        if line.startswith(b"data: "):
+            data = json.loads(line[6:].decode())
+            with lock:
+                received.append((data["content"], time.time()))
+            count += 1
+    conn.close()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main(host, questionnaire_id, question_id, subscribers, answers):
+    threads = [threading.Thread(target=subscribe, args=(host, questionnaire_id, answers))
+               for _ in range(subscribers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    while len(connected) < subscribers:
+        time.sleep(0.1)
+    print("{} streams connected with {}".format(len(connected), "gevent" if monkey else "threads"))
+
+    posted = {}
+    conn = http.client.HTTPConnection(host)
+    for number in range(answers):
+        content = "benchmark-{}-{}".format(time.time(), number)
+        posted[content] = time.time()
+        conn.request("POST", "/api/questionnaires/{}/questions/{}/answers/".format(questionnaire_id, question_id),
+                     json.dumps({"content": content, "userName": "benchmark-{}".format(number)}),
+                     {"Content-Type": "application/json"})
+        conn.getresponse().read()
+        time.sleep(0.05)
+
+    for thread in threads:
+        thread.join(30)
+
+    latencies = [(at - posted[content]) * 1000 for content, at in received if content in posted]
+    print("delivered {} of {} events".format(len(latencies), subscribers * answers))
+    if latencies:
+        print("latency ms: p50 {:.1f}, p99 {:.1f}, max {:.1f}".format(
+            percentile(latencies, 0.5), percentile(latencies, 0.99), max(latencies)))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1], sys.argv[2], sys.argv[3],
+         int(sys.argv[4]) if len(sys.argv) > 4 else 100,
+         int(sys.argv[5]) if len(sys.argv) > 5 else 10)
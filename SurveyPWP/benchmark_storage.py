@@ -0,0 +1,81 @@
+"""
+Benchmark of the storage backends: the latency of the requests with the SQL database and with the
+memory repository.
+
+Creates the same questionnaire, with the given number of questions and answers to each, in both
+backends, and then times the same requests on each one. The database is a temporary file with the
+default configuration.
+
+Usage: python benchmark_storage.py [number of questions] [answers per question] [rounds]
+"""
+import os
+import sys
+import tempfile
+import timeit
+
+from app import app, db, repository
+
+REQUESTS = [
+    ("GET", "/api/questionnaires/1/"),
+    ("GET", "/api/questionnaires/1/questions/"),
+    ("GET", "/api/questionnaires/1/questions/1/"),
+    ("GET", "/api/questionnaires/1/questions/1/answers/"),
+    ("GET", "/api/questionnaires/1/questions/1/answers/?userName=user-1&sort=-content"),
+    ("GET", "/api/questionnaires/1/answers/user-1/"),
+    ("POST", "/api/questionnaires/1/questions/1/answers/"),
+]
+
+
+def populate(questions, answers):
+    storage = repository()
+    questionnaire, = storage.find(storage.add_questionnaire("benchmark", "A generated questionnaire"))
+    for number in range(questions):
+        question_id = storage.add_question(questionnaire, "question-{}".format(number), None)
+        for user in range(answers):
+            storage.save_answer(questionnaire, question_id, "answer {}".format(user), "user-{}".format(user))
+
+
+def measure(client, rounds):
+    results = []
+    for method, url in REQUESTS:
+        if method == "GET":
+            request = lambda: client.get(url)
+        else:
+            request = lambda: client.post(url, json={"content": "posted", "userName": "user-1"})
+        results.append(timeit.timeit(request, number=rounds) / rounds * 1000)
+    return results
+
+
+def main(questions, answers, rounds):
+    db_fd, db_fname = tempfile.mkstemp()
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + db_fname
+    try:
+        db.create_all()
+        client = app.test_client()
+        client.get("/api/")
+        timings = {}
+        for backend in ["sql", "memory"]:
+            app.config["STORAGE_BACKEND"] = backend
+            populate(questions, answers)
+            db.session.remove()
+            timings[backend] = measure(client, rounds)
+
+        print("{} questions, {} answers per question, {} rounds".format(questions, answers, rounds))
+        print("{:>6} {:<76} {:>8} {:>8}".format("method", "url", "sql ms", "mem ms"))
+        for (method, url), sql, memory in zip(REQUESTS, timings["sql"], timings["memory"]):
+            print("{:>6} {:<76} {:>8.3f} {:>8.3f}".format(method, url, sql, memory))
+    finally:
+        repository().clear()
+        app.config["STORAGE_BACKEND"] = "sql"
+        db.session.remove()
+        db.dispose_engines()
+        os.close(db_fd)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_fname + suffix):
+                os.unlink(db_fname + suffix)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 200,
+         int(sys.argv[3]) if len(sys.argv) > 3 else 200)
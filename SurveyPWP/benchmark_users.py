@@ -0,0 +1,125 @@
+"""
+Benchmark of the user table: storage and per-user lookups with the user names stored on every
+answer, as before, compared with the answers referring to the user table by id.
+
+Creates the question and answer tables of both schemas with their indexes in temporary databases,
+fills them with the same generated answers, and prints the size of each table and index and the
+time of the per-user queries. The sizes per table and index need SQLite with the dbstat table.
+
+Usage: python benchmark_users.py [number of answers] [number of users]
+"""
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import timeit
+
+ROUNDS = 200
+QUESTIONS_PER_QUESTIONNAIRE = 10
+
+LEGACY_SCHEMA = [
+    "CREATE TABLE question (id INTEGER PRIMARY KEY, questionnaire_id INTEGER NOT NULL)",
+    "CREATE TABLE answer (id INTEGER PRIMARY KEY, question_id INTEGER NOT NULL, "
+    "content VARCHAR(512) NOT NULL, userName VARCHAR(64) NOT NULL)",
+    "CREATE INDEX ix_answer_question_id ON answer (question_id)",
+    "CREATE UNIQUE INDEX ix_answer_question_user ON answer (question_id, userName)",
+    "CREATE INDEX ix_answer_question_content ON answer (question_id, content)",
+]
+
+NORMALIZED_SCHEMA = [
+    "CREATE TABLE question (id INTEGER PRIMARY KEY, questionnaire_id INTEGER NOT NULL)",
+    'CREATE TABLE "user" (id INTEGER PRIMARY KEY, name VARCHAR(64) NOT NULL UNIQUE)',
+    "CREATE TABLE answer (id INTEGER PRIMARY KEY, question_id INTEGER NOT NULL, "
+    'content VARCHAR(512) NOT NULL, user_id INTEGER NOT NULL REFERENCES "user"(id))',
+    "CREATE INDEX ix_answer_question_id ON answer (question_id)",
+    "CREATE UNIQUE INDEX ix_answer_question_user ON answer (question_id, user_id)",
+    "CREATE INDEX ix_answer_question_content ON answer (question_id, content)",
+]
+
+# The answers of one user to one questionnaire, and all the answers of one user.
+LEGACY_QUERIES = {
+    "questionnaire": "SELECT answer.id, answer.question_id, answer.content, answer.userName FROM answer "
+                     "JOIN question ON question.id = answer.question_id "
+                     "WHERE question.questionnaire_id = :questionnaire_id AND answer.userName = :name",
+    "all": "SELECT id, question_id, content, userName FROM answer WHERE userName = :name",
+}
+
+NORMALIZED_QUERIES = {
+    "questionnaire": 'SELECT answer.id, answer.question_id, answer.content, "user".name FROM "user" '
+                     'JOIN answer ON answer.user_id = "user".id JOIN question ON question.id = answer.question_id '
+                     'WHERE question.questionnaire_id = :questionnaire_id AND "user".name = :name',
+    "all": 'SELECT answer.id, answer.question_id, answer.content, "user".name FROM "user" '
+           'JOIN answer ON answer.user_id = "user".id WHERE "user".name = :name',
+}
+
+
+def generate(count, users):
+    """
+    Returns the generated answers as (question id, content, user name), one per question and user.
+    """
+    random.seed(1)
+    names = ["user-{:08d}@example.com".format(i) for i in range(users)]
+    questions = max(1, count // users + 1)
+    answers = set()
+    while len(answers) < count:
+        answers.add((random.randint(1, questions), random.choice(names)))
+    return questions, names, [(question, "answer {}".format(i), name) for i, (question, name) in
+                              enumerate(sorted(answers))]
+
+
+def build(path, schema, questions, names, answers, normalized):
+    conn = sqlite3.connect(path)
+    for statement in schema:
+        conn.execute(statement)
+    conn.executemany("INSERT INTO question (id, questionnaire_id) VALUES (?, ?)",
+                     [(i, i // QUESTIONS_PER_QUESTIONNAIRE + 1) for i in range(1, questions + 1)])
+    if normalized:
+        conn.executemany('INSERT INTO "user" (id, name) VALUES (?, ?)', enumerate(names, 1))
+        ids = {name: i for i, name in enumerate(names, 1)}
+        answers = [(question, content, ids[name]) for question, content, name in answers]
+        conn.executemany("INSERT INTO answer (question_id, content, user_id) VALUES (?, ?, ?)", answers)
+    else:
+        conn.executemany("INSERT INTO answer (question_id, content, userName) VALUES (?, ?, ?)", answers)
+    conn.commit()
+    conn.execute("VACUUM")
+    conn.execute("ANALYZE")
+    return conn
+
+
+def measure(name, conn, path, queries, names, questions):
+    print("{} ({} bytes)".format(name, os.path.getsize(path)))
+    try:
+        sizes = conn.execute("SELECT name, sum(pgsize) FROM dbstat GROUP BY name ORDER BY name").fetchall()
+        for table, size in sizes:
+            print("{:>40} {:>12}".format(table, size))
+    except sqlite3.OperationalError:
+        print("{:>40}".format("(no dbstat, sizes per table are not available)"))
+
+    for query_name, query in sorted(queries.items()):
+        params = [{"name": random.choice(names),
+                   "questionnaire_id": random.randint(1, questions // QUESTIONS_PER_QUESTIONNAIRE + 1)}
+                  for _ in range(ROUNDS)]
+        it = iter(params)
+        seconds = timeit.timeit(lambda: conn.execute(query, next(it)).fetchall(), number=ROUNDS) / ROUNDS
+        print("{:>40} {:>12.4f} ms".format("query " + query_name, seconds * 1000))
+    print("")
+
+
+def main(count, users):
+    questions, names, answers = generate(count, users)
+    for name, schema, queries, normalized in [("userName on the answers", LEGACY_SCHEMA, LEGACY_QUERIES, False),
+                                              ("user table", NORMALIZED_SCHEMA, NORMALIZED_QUERIES, True)]:
+        db_fd, db_fname = tempfile.mkstemp()
+        try:
+            conn = build(db_fname, schema, questions, names, answers, normalized)
+            measure(name, conn, db_fname, queries, names, questions)
+            conn.close()
+        finally:
+            os.close(db_fd)
+            os.unlink(db_fname)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 5000)
@@ -0,0 +1,155 @@
+"""
+Concurrency benchmark of the gunicorn workers: sync, threaded (gthread) and gevent.
+
+Starts the application with each kind of worker on a copy of a generated temporary database, opens
+the given number of answer streams, and then runs concurrent clients which read the answers of a
+question and post new answers for the given number of seconds. Prints the throughput, the latencies
+and the number of failed requests. A request which is not answered within the timeout fails, which
+is what happens to the sync workers once the streams occupy them.
+
+Usage: python benchmark_workers.py [clients] [streams] [seconds] [workers]
+"""
+import http.client
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+PORT = 8765
+TIMEOUT = 5
+THREADS = 8
+ANSWERS = 1000
+
+MODES = [
+    ("sync", ["-k", "sync"]),
+    ("gthread", ["-k", "gthread", "--threads", str(THREADS)]),
+    ("gevent", ["-c", "gunicorn_gevent.py"]),
+]
+
+
+def populate(path):
+    """
+    Creates the database with one questionnaire, one question and its answers.
+    """
+    os.environ["SURVEY_DATABASE_URI"] = "sqlite:///" + path
+    from app import db, Questionnaire, Question, Answer
+
+    question = Question(title="question", questionnaire=Questionnaire(title="benchmark"))
+    db.session.add(question)
+    for i in range(ANSWERS):
+        db.session.add(Answer(question=question, content="answer {}".format(i), userName="user-{}".format(i)))
+    db.session.commit()
+    db.session.remove()
+
+
+def start(mode_args, path, workers):
+    env = dict(os.environ, SURVEY_DATABASE_URI="sqlite:///" + path)
+    server = subprocess.Popen(["gunicorn", "-b", "127.0.0.1:{}".format(PORT), "-w", str(workers)] + mode_args +
+                              ["app:app"], cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", PORT, timeout=1)
+            conn.request("GET", "/api/")
+            conn.getresponse().read()
+            return server
+        except (OSError, http.client.HTTPException):
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("The server did not start")
+
+
+def stream():
+    """
+    Keeps one answer stream open until the server stops.
+    """
+    try:
+        conn = http.client.HTTPConnection("127.0.0.1", PORT)
+        conn.request("GET", "/api/questionnaires/1/changes/stream/")
+        resp = conn.getresponse()
+        while resp.fp.readline():
+            pass
+    except (OSError, http.client.HTTPException):
+        pass
+
+
+def client(number, deadline, latencies, errors):
+    """
+    Reads the answers and posts a new answer in turns until the deadline.
+    """
+    count = 0
+    while time.time() < deadline:
+        count += 1
+        if count % 2:
+            method, url, body = "GET", "/api/questionnaires/1/questions/1/answers/?maxId=50", None
+        else:
+            method, url = "POST", "/api/questionnaires/1/questions/1/answers/"
+            body = json.dumps({"content": "posted", "userName": "client-{}-{}".format(number, count)})
+        started = time.time()
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", PORT, timeout=TIMEOUT)
+            conn.request(method, url, body, {"Content-Type": "application/json"})
+            resp = conn.getresponse()
+            resp.read()
+            conn.close()
+            if resp.status >= 400:
+                errors.append(resp.status)
+            else:
+                latencies.append(time.time() - started)
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(type(e).__name__)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float("nan")
+
+
+def run(name, mode_args, template, clients, streams, seconds, workers):
+    folder = tempfile.mkdtemp()
+    path = os.path.join(folder, "database.db")
+    shutil.copy(template, path)
+    server = start(mode_args, path, workers)
+    try:
+        for _ in range(streams):
+            threading.Thread(target=stream, daemon=True).start()
+        time.sleep(0.5)
+
+        latencies, errors = [], []
+        deadline = time.time() + seconds
+        threads = [threading.Thread(target=client, args=(i, deadline, latencies, errors)) for i in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        print("{:>8} {:>10.1f} {:>10.1f} {:>10.1f} {:>8}".format(
+            name, len(latencies) / float(seconds), percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.99) * 1000, len(errors)))
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(folder)
+
+
+def main(clients, streams, seconds, workers):
+    folder = tempfile.mkdtemp()
+    try:
+        template = os.path.join(folder, "database.db")
+        populate(template)
+        print("{} clients, {} streams, {} workers, {} seconds".format(clients, streams, workers, seconds))
+        print("{:>8} {:>10} {:>10} {:>10} {:>8}".format("worker", "req/s", "p50 ms", "p99 ms", "failed"))
+        for name, mode_args in MODES:
+            run(name, mode_args, template, clients, streams, seconds, workers)
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 32,
+         int(sys.argv[2]) if len(sys.argv) > 2 else 0,
+         int(sys.argv[3]) if len(sys.argv) > 3 else 10,
+         int(sys.argv[4]) if len(sys.argv) > 4 else 2)
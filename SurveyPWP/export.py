@@ -0,0 +1,129 @@
+"""
+Exports the questionnaires with their questions and answers to HDF5 files, for the analysis of the
+answers with pandas. The tables are written in the PyTables format of pandas, so an export is
+loaded with:
+
+    questionnaire = pandas.read_hdf(path, "questionnaire")
+    questions = pandas.read_hdf(path, "questions")
+    answers = pandas.read_hdf(path, "answers")
+
+The question titles and the user names of the answers are categorical columns. Each distinct value
+is stored once, and the rows only store the integer codes of the values. The answers are read from
+the database and appended to the file in chunks, so the memory use does not depend on their number.
+All of them are read from one snapshot of the database, so the chunks match the categories even when
+answers are written during the export.
+pandas does not write empty tables, so the export of a questionnaire without answers has no answers.
+The questions and answers of an archived questionnaire are read from its archive.
+
+Usage: python export.py <questionnaire id> <path of the file>
+"""
+import sys
+
+import pandas
+
+from app import app, db, load_archive, resolve_path, routed_to
+
+CHUNK_SIZE = 50000
+COMPLEVEL = 5
+COMPLIB = "blosc"
+# PyTables stores the strings as UTF-8 and sizes the column in bytes, so the column fits the 512
+# characters of an answer only if each of them takes the 4 bytes of the longest UTF-8 character.
+CONTENT_ITEMSIZE = 4 * 512
+
+
+def _categories(values):
+    """
+    Returns the sorted distinct values, and a dict from each value to its code.
+    """
+    categories = sorted(set(values))
+    return categories, dict((value, code) for code, value in enumerate(categories))
+
+
+def _answer_chunks(connection, questionnaire_id, chunk_size):
+    """
+    Yields the answers to the questions of a questionnaire as lists of (id, question_id, content, user name)
+    rows, in the order of their ids. Each chunk is read after the last id of the previous one.
+    """
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            'SELECT answer.id, answer.question_id, answer.content, "user".name FROM answer '
+            'JOIN question ON question.id = answer.question_id JOIN "user" ON "user".id = answer.user_id '
+            'WHERE question.questionnaire_id = :id AND answer.id > :last_id ORDER BY answer.id LIMIT :limit',
+            {"id": questionnaire_id, "last_id": last_id, "limit": chunk_size}).fetchall()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1][0]
+
+
+def export_questionnaire(questionnaire_id, path, chunk_size=CHUNK_SIZE, progress=None):
+    """
+    Writes the questionnaire, its questions and the answers to them into the HDF5 file at path.
+    Returns the number of exported answers. If progress is given, it is called after each chunk with
+    the exported part of the answers, from 0 to 1. It may commit the session.
+
+    Raises PathNotFound if the questionnaire does not exist.
+    """
+    questionnaire, = resolve_path(questionnaire_id)
+    with db.snapshot(db.session().routed_shard()) as connection:
+        if questionnaire.archived:
+            archive = load_archive(questionnaire.id)
+            questions = list(archive.questions.values())
+            user_names = set(answer.userName for answer in archive.answers)
+            total = len(archive.answers)
+            chunks = (archive.answers[start:start + chunk_size] for start in range(0, total, chunk_size))
+        else:
+            questions = connection.execute(
+                "SELECT id, title, description FROM question WHERE questionnaire_id = :id ORDER BY position, id",
+                {"id": questionnaire.id}).fetchall()
+            user_names = set(row[0] for row in connection.execute(
+                'SELECT DISTINCT "user".name FROM answer JOIN question ON question.id = answer.question_id '
+                'JOIN "user" ON "user".id = answer.user_id WHERE question.questionnaire_id = :id',
+                {"id": questionnaire.id}))
+            total = connection.execute(
+                "SELECT count(*) FROM answer JOIN question ON question.id = answer.question_id "
+                "WHERE question.questionnaire_id = :id", {"id": questionnaire.id}).scalar()
+            chunks = _answer_chunks(connection, questionnaire.id, chunk_size)
+
+        # The values of the categorical columns have to be known before the first chunk, since every
+        # chunk is appended with the same categories.
+        title_categories, title_codes = _categories(row.title for row in questions)
+        question_titles = dict((row.id, title_codes[row.title]) for row in questions)
+        user_categories, user_codes = _categories(user_names)
+
+        with pandas.HDFStore(path, mode="w", complevel=COMPLEVEL, complib=COMPLIB) as store:
+            store.put("questionnaire", pandas.DataFrame({
+                "id": [questionnaire.id],
+                "title": [questionnaire.title],
+                "description": [questionnaire.description or ""],
+            }, columns=["id", "title", "description"]), format="table")
+            store.put("questions", pandas.DataFrame({
+                "id": [row.id for row in questions],
+                "title": pandas.Categorical.from_codes([title_codes[row.title] for row in questions],
+                                                       title_categories),
+                "description": [row.description or "" for row in questions],
+            }, columns=["id", "title", "description"]), format="table")
+
+            count = 0
+            for rows in chunks:
+                store.append("answers", pandas.DataFrame({
+                    "id": [row[0] for row in rows],
+                    "question_id": [row[1] for row in rows],
+                    "question_title": pandas.Categorical.from_codes([question_titles[row[1]] for row in rows],
+                                                                    title_categories),
+                    "content": [row[2] for row in rows],
+                    "userName": pandas.Categorical.from_codes([user_codes[row[3]] for row in rows],
+                                                              user_categories),
+                }, columns=["id", "question_id", "question_title", "content", "userName"]),
+                    format="table", min_itemsize={"content": CONTENT_ITEMSIZE}, data_columns=["question_id"])
+                count += len(rows)
+                if progress is not None:
+                    progress(float(count) / total)
+
+    return count
+
+
+if __name__ == "__main__":
+    with app.app_context(), routed_to(db.shard_of(sys.argv[1])):
+        print("{} answers were exported.".format(export_questionnaire(int(sys.argv[1]), sys.argv[2])))
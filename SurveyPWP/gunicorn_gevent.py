@@ -0,0 +1,25 @@
+"""
+Configuration of gunicorn for serving the application with gevent workers. A gevent worker serves
+each request in a greenlet, so the answer streams and the slow clients do not tie up the workers
+like they tie up the default sync workers.
+
+The worker patches the standard library before it imports the application, which then enables the
+cooperative locking of SQLite (see SQLITE_COOPERATIVE_LOCKING in app.py). The sessions are scoped to
+the greenlet of the request, since the application context is.
+
+Usage: gunicorn -c gunicorn_gevent.py app:app
+The port is read from the PORT environment variable and the number of workers from WEB_CONCURRENCY,
+like with the default configuration.
+"""
+import multiprocessing
+import os
+
+worker_class = "gevent"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+
+# The number of requests which one worker serves at once. The open answer streams count too.
+worker_connections = 1000
+
+# The application must not be imported before the worker has patched the standard library, or its
+# locks, queues and threads would be the blocking ones.
+preload_app = False
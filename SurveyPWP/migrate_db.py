@@ -0,0 +1,185 @@
+"""
+Migrates an existing database to the current schema. The tables and indexes which do not exist yet
+are created by create_all, this script only changes the existing ones. Every step can be run again.
+With shards, the catalog and every shard are migrated.
+
+Usage: python migrate_db.py
+"""
+from app import db, FTS_TABLES, _fts_update_trigger, reconcile_counters, routed_to
+
+
+def create_all():
+    """
+    Creates the missing tables, indexes and triggers in the database which the session is routed to.
+    """
+    db.Model.metadata.create_all(bind=db.session.get_bind())
+
+
+def columns(table):
+    return [row[1] for row in db.session.execute("PRAGMA table_info({})".format(table))]
+
+
+def unique_answers():
+    """
+    Makes the answers unique per question and user. Of the duplicates, the latest answer is kept.
+    """
+    if "userName" not in columns("answer"):
+        print("Answers are already unique per question and user.")
+        return
+    deleted = db.session.execute(
+        "DELETE FROM answer WHERE id NOT IN (SELECT max(id) FROM answer GROUP BY question_id, userName)"
+    ).rowcount
+    db.session.execute("DROP INDEX IF EXISTS ix_answer_question_user")
+    db.session.execute("CREATE UNIQUE INDEX ix_answer_question_user ON answer (question_id, userName)")
+    db.session.commit()
+    print("Answers are unique per question and user, {} duplicates were deleted.".format(deleted))
+
+
+def normalize_users():
+    """
+    Moves the user names of the answers into the user table. SQLite can not change the columns of a
+    table in place, so the answer table is renamed, created again and its rows are copied. The
+    triggers and the full-text table of the answers are created again by create_all. The ids of the
+    answers are kept, the copy is not logged as new changes, and the answers of the archived and
+    deleted questionnaires are copied too.
+    """
+    if "userName" not in columns("answer"):
+        print("User names are already normalized.")
+        return
+
+    db.session.execute("ALTER TABLE answer RENAME TO answer_old")
+    objects = db.session.execute("SELECT type, name FROM sqlite_master WHERE tbl_name = 'answer_old' "
+                                 "AND type IN ('index', 'trigger') AND sql IS NOT NULL").fetchall()
+    for object_type, name in objects:
+        db.session.execute("DROP {} {}".format(object_type.upper(), name))
+    db.session.execute("DROP TABLE IF EXISTS answer_fts")
+    db.session.commit()
+
+    create_all()
+    db.session.execute("DROP TRIGGER answer_change_insert")
+    db.session.execute("DROP TRIGGER answer_guard_insert")
+    db.session.execute('INSERT INTO "user" (name) SELECT DISTINCT userName FROM answer_old '
+                       'WHERE true ON CONFLICT (name) DO NOTHING')
+    copied = db.session.execute(
+        'INSERT INTO answer (id, question_id, content, user_id) '
+        'SELECT answer_old.id, answer_old.question_id, answer_old.content, "user".id '
+        'FROM answer_old JOIN "user" ON "user".name = answer_old.userName'
+    ).rowcount
+    db.session.execute("DROP TABLE answer_old")
+    db.session.commit()
+    create_all()
+    print("User names are normalized, {} answers were copied.".format(copied))
+
+
+def soft_delete_questionnaires():
+    """
+    Adds the deleted flag of the questionnaires.
+    """
+    if "deleted" in columns("questionnaire"):
+        print("Questionnaires can already be soft deleted.")
+        return
+    db.session.execute("ALTER TABLE questionnaire ADD COLUMN deleted BOOLEAN NOT NULL DEFAULT 0")
+    db.session.execute("CREATE INDEX ix_questionnaire_deleted ON questionnaire (deleted)")
+    db.session.commit()
+    print("Questionnaires can be soft deleted.")
+
+
+def archive_questionnaires():
+    """
+    Adds the archived flag of the questionnaires. The triggers of the answer change log are created
+    again by create_all, so the answers which are moved into an archive are not logged as deleted.
+    """
+    if "archived" in columns("questionnaire"):
+        print("Questionnaires can already be archived.")
+        return
+    db.session.execute("ALTER TABLE questionnaire ADD COLUMN archived BOOLEAN NOT NULL DEFAULT 0")
+    for event_name in ["insert", "update", "delete"]:
+        db.session.execute("DROP TRIGGER IF EXISTS answer_change_{}".format(event_name))
+    db.session.commit()
+    create_all()
+    print("Questionnaires can be archived.")
+
+
+def publish_questionnaires():
+    """
+    Adds the version of the published document of the questionnaires.
+    """
+    if "published_version" in columns("questionnaire"):
+        print("Questionnaires can already be published.")
+        return
+    db.session.execute("ALTER TABLE questionnaire ADD COLUMN published_version INTEGER")
+    db.session.commit()
+    print("Questionnaires can be published.")
+
+
+def order_questions():
+    """
+    Adds the positions of the questions. The existing questions keep the order of their ids.
+    """
+    if "position" in columns("question"):
+        print("Questions are already ordered.")
+        return
+    db.session.execute("ALTER TABLE question ADD COLUMN position FLOAT NOT NULL DEFAULT 0")
+    db.session.execute("UPDATE question SET position = id")
+    db.session.execute("CREATE INDEX ix_question_questionnaire_position ON question (questionnaire_id, position)")
+    db.session.commit()
+    print("Questions are ordered.")
+
+
+def count_questions_and_answers():
+    """
+    Adds the counters of the questions and answers. The triggers of the full-text indexes are created
+    again, so that they do not index a row again when only its counters change. The triggers of the
+    counters are created by create_all, and the counters are filled in by migrate after the last step.
+    """
+    if "answer_count" in columns("question"):
+        print("Questions and answers are already counted.")
+        return
+    db.session.execute("ALTER TABLE questionnaire ADD COLUMN question_count INTEGER NOT NULL DEFAULT 0")
+    db.session.execute("ALTER TABLE questionnaire ADD COLUMN answer_count INTEGER NOT NULL DEFAULT 0")
+    db.session.execute("ALTER TABLE question ADD COLUMN answer_count INTEGER NOT NULL DEFAULT 0")
+    for fts_table, (table, fts_columns) in FTS_TABLES.items():
+        db.session.execute("DROP TRIGGER IF EXISTS {}_au".format(fts_table))
+        db.session.execute(_fts_update_trigger(fts_table, table, fts_columns))
+    db.session.commit()
+    create_all()
+    print("Questions and answers can be counted.")
+
+
+def retry_jobs():
+    """
+    Adds the attempts of the jobs and the time of their next retry.
+    """
+    if "attempts" in columns("job"):
+        print("Jobs can already be retried.")
+        return
+    db.session.execute("ALTER TABLE job ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+    db.session.execute("ALTER TABLE job ADD COLUMN run_after DATETIME")
+    db.session.commit()
+    print("Jobs can be retried.")
+
+
+def migrate():
+    """
+    Runs every step. The steps which add columns run first, since the triggers which create_all installs
+    already use the new columns, and they fire on the changes of the rows in the later steps. The
+    counters are counted last, since the answers which normalize_users copies are counted again by the
+    triggers.
+    """
+    for shard in [None] + list(range(db.shard_count())):
+        with routed_to(shard):
+            print("Migrating {}.".format("the catalog" if shard is None else "the shard {}".format(shard)))
+            create_all()
+            soft_delete_questionnaires()
+            archive_questionnaires()
+            publish_questionnaires()
+            order_questions()
+            count_questions_and_answers()
+            retry_jobs()
+            unique_answers()
+            normalize_users()
+    print("{} counters were filled in.".format(reconcile_counters()))
+
+
+if __name__ == "__main__":
+    migrate()
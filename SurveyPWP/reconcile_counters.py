@@ -0,0 +1,12 @@
+"""
+Repairs the counters of the questions and answers of the questionnaires and questions, which the
+triggers keep up to date, if they have drifted from the rows. Every database is checked, the catalog
+and each shard. It can be run while the application serves requests.
+
+Usage: python reconcile_counters.py
+"""
+from app import reconcile_counters
+
+
+if __name__ == "__main__":
+    print("{} counters were repaired.".format(reconcile_counters()))
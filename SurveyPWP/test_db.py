@@ -1,6 +1,6 @@
 import app as app
 import populate_db as populate
-import pytest, os, tempfile
+import pytest, os, shutil, tempfile
 from app import db, Questionnaire, Question, Answer
 from sqlalchemy import event, update, exc
 from sqlalchemy.engine import Engine
@@ -368,4 +368,76 @@ def test_answer_filter2(db_handle):
 
 	assert query_answer.count() == 0
 
+
+# The schema of the database before the questionnaires could be deleted, archived, published or
+# ordered, and before the users were moved into their own table.
+BASELINE_SCHEMA = """
+CREATE TABLE questionnaire (id INTEGER NOT NULL, title VARCHAR(64) NOT NULL, description VARCHAR(512), PRIMARY KEY (id));
+CREATE TABLE question (id INTEGER NOT NULL, questionnaire_id INTEGER NOT NULL, title VARCHAR(64) NOT NULL,
+	description VARCHAR(512), PRIMARY KEY (id), FOREIGN KEY(questionnaire_id) REFERENCES questionnaire (id));
+CREATE TABLE answer (id INTEGER NOT NULL, question_id INTEGER NOT NULL, content VARCHAR(512) NOT NULL,
+	userName VARCHAR(64) NOT NULL, PRIMARY KEY (id), FOREIGN KEY(question_id) REFERENCES question (id));
+INSERT INTO questionnaire VALUES (1, 'questionnaire', NULL);
+INSERT INTO question VALUES (1, 1, 'first', NULL), (2, 1, 'second', NULL);
+INSERT INTO answer VALUES (1, 1, 'old', 'user-1'), (2, 1, 'new', 'user-1'), (3, 1, 'other', 'user-2'), (4, 2, 'x', 'user-2');
+"""
+
+def test_migrate_baseline():
+	"""
+	Tests that a database with the baseline schema is migrated to the current one, and that the
+	migration can be run again.
+	"""
+	import sqlite3
+	import migrate_db
+
+	db_fd, db_fname = tempfile.mkstemp()
+	connection = sqlite3.connect(db_fname)
+	connection.executescript(BASELINE_SCHEMA)
+	connection.close()
+	app.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + db_fname
+	try:
+		for _ in range(2):
+			migrate_db.migrate()
+			assert [(answer.id, answer.userName) for answer in Answer.query.order_by(Answer.id)] == \
+				[(2, "user-1"), (3, "user-2"), (4, "user-2")]
+			questionnaire = Questionnaire.query.get(1)
+			assert not questionnaire.deleted and not questionnaire.archived
+			assert (questionnaire.question_count, questionnaire.answer_count) == (2, 3)
+			questions = Question.query.order_by(Question.id).all()
+			assert [(question.position, question.answer_count) for question in questions] == [(1, 2), (2, 1)]
+			db.session.remove()
+	finally:
+		db.session.remove()
+		db.dispose_engines()
+		os.close(db_fd)
+		os.unlink(db_fname)
+
+def test_migrate_shards():
+	"""
+	Tests that every shard is migrated with the catalog.
+	"""
+	import sqlite3
+	import migrate_db
+
+	folder = tempfile.mkdtemp()
+	shard_fname = os.path.join(folder, "shard-0.db")
+	connection = sqlite3.connect(shard_fname)
+	connection.executescript(BASELINE_SCHEMA)
+	connection.close()
+	app.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(folder, "catalog.db")
+	app.app.config["SHARD_URIS"] = ["sqlite:///" + shard_fname]
+	try:
+		migrate_db.migrate()
+		with app.routed_to(0):
+			assert [(answer.id, answer.userName) for answer in Answer.query.order_by(Answer.id)] == \
+				[(2, "user-1"), (3, "user-2"), (4, "user-2")]
+			questions = Question.query.order_by(Question.id).all()
+			assert [(question.position, question.answer_count) for question in questions] == [(1, 2), (2, 1)]
+			assert Questionnaire.query.get(1).answer_count == 3
+	finally:
+		app.app.config["SHARD_URIS"] = []
+		db.session.remove()
+		db.dispose_engines()
+		shutil.rmtree(folder)
+
 # END OF TEST
\ No newline at end of file
@@ -1,14 +1,22 @@
+import gzip
 import json
+import msgpack
 import os
 import pytest
+import shutil
+import sqlite3
 import tempfile
+import threading
 import time
 from datetime import datetime
 from jsonschema import validate
 from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
 from sqlalchemy import event
-from sqlalchemy.exc import IntegrityError, StatementError
-from app import app, db, Questionnaire, Question, Answer
+from sqlalchemy.exc import IntegrityError, OperationalError, StatementError
+from app import app, db, Questionnaire, Question, Answer, Job, Archive, brotli, compression_cache, entity_cache, MASON_MSGPACK
+from app import job_kind, job_runner, reconcile_counters, recover_jobs, repository, Repository, routed_to
+from app import purge_job, single_flight, writer_lock
 
 
 @pytest.fixture
@@ -119,7 +127,7 @@ def _check_control_post_method(ctrl, client, obj):
     if ctrl.endswith("question"):
         body = _get_question_json()
     elif ctrl.endswith("answer"):
-        body = _get_answer_json()
+        body = _get_answer_json(4)
     validate(body, schema)
     resp = client.post(href, json=body)
     assert resp.status_code == 201
@@ -179,6 +187,39 @@ class TestQuestionnaireCollection(object):
             assert "title" in item
             assert "description" in item
 
+    def test_get_compact(self, client):
+        """
+        Tests the compact representation. The items should not have any controls, the collection
+        should have an item template instead, and only the requested fields should be present.
+        """
+        resp = client.get(self.RESOURCE_URL + "?compact=true&fields=title")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["@controls"]["item"]["isHrefTemplate"]
+        assert len(body["items"]) == 2
+        for item in body["items"]:
+            assert "@controls" not in item
+            assert sorted(item.keys()) == ["id", "title"]
+            resp = client.get(body["@controls"]["item"]["href"].replace("{id}", str(item["id"])))
+            assert resp.status_code == 200
+
+        # the compact profile in the Accept header works the same way
+        resp = client.get(self.RESOURCE_URL, headers={
+            "Accept": 'application/vnd.mason+json; profile="/profiles/compact/"'})
+        body = json.loads(resp.data)
+        assert "item" in body["@controls"]
+        assert all("@controls" not in item for item in body["items"])
+
+        # the full representation keeps the controls but still honors the fields
+        resp = client.get(self.RESOURCE_URL + "?fields=description")
+        body = json.loads(resp.data)
+        for item in body["items"]:
+            _check_control_get_method("self", client, item)
+            assert "title" not in item
+
+        resp = client.get(self.RESOURCE_URL + "?fields=title,password")
+        assert resp.status_code == 400
+
     def test_post(self, client):
         """
         Tests the POST method. Checks all of the possible error codes, and 
@@ -276,6 +317,45 @@ class TestQuestionnaireItem(object):
         resp = client.delete(self.INVALID_URL)
         assert resp.status_code == 404
 
+    def test_delete_purge(self, client):
+        """
+        Tests that a deleted questionnaire is hidden right away from every read path, and that the
+        purge job removes it with its questions and answers in batches.
+        """
+        app.config["PURGE_BATCH_SIZE"] = 2
+        try:
+            client.get("/api/questionnaires/1/questions/1/")
+            assert client.delete("/api/questionnaires/1/").status_code == 204
+            job_runner.wait(10)
+        finally:
+            app.config["PURGE_BATCH_SIZE"] = 500
+
+        body = json.loads(client.get("/api/questionnaires/").data)
+        assert [item["id"] for item in body["items"]] == [2]
+        for url in ["/api/questionnaires/1/", "/api/questionnaires/1/questions/", "/api/questionnaires/1/questions/1/",
+                    "/api/questionnaires/1/questions/1/answers/", "/api/questionnaires/1/answers/test-user-1/"]:
+            assert client.get(url).status_code == 404
+        assert json.loads(client.get("/api/search/?q=test").data)["items"][0]["id"] == 2
+
+        db.session.remove()
+        assert Questionnaire.query.count() == 1
+        assert Question.query.count() == 0 and Answer.query.count() == 0
+        job = Job.query.filter_by(kind="purge").one()
+        assert job.status == "done" and job.progress == 1
+
+    def test_delete_hidden(self, client):
+        """
+        Tests that a deleted questionnaire is hidden before it is purged.
+        """
+        questionnaire = Questionnaire.query.get(2)
+        questionnaire.deleted = True
+        db.session.commit()
+        assert client.get("/api/questionnaires/2/").status_code == 404
+        assert client.get("/api/questionnaires/2/questions/").status_code == 404
+        assert client.delete("/api/questionnaires/2/").status_code == 404
+        assert [item["type"] for item in json.loads(client.get("/api/search/?q=questionnaire").data)["items"]] == [
+            "questionnaire"]
+
 
 class TestQuestionsByQuestionnaire(object):
     RESOURCE_URL = "/api/questionnaires/1/questions/"
@@ -429,6 +509,74 @@ class TestAnswersToQuestion(object):
         resp = client.get(self.MISMATCH_URL)
         assert resp.status_code == 404
 
+    def test_get_compact(self, client):
+        """
+        Tests the compact representation with a sparse fieldset for the answers.
+        """
+        resp = client.get(self.RESOURCE_URL + "?compact=1&fields=userName")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["@controls"]["item"]["href"] == self.RESOURCE_URL + "{id}/"
+        assert body["items"] == [{"id": 1, "userName": "test-user-1"}]
+
+    def test_get_filtered(self, client):
+        """
+        Tests the filter and sort query parameters, and that the filters and sort keys of the answer
+        table are served by an index.
+        """
+        for number in (3, 2, 4):
+            client.post(self.RESOURCE_URL, json={"userName": "user-{}".format(number),
+                                                 "content": "answer {}".format(number)})
+
+        def ids(query):
+            resp = client.get(self.RESOURCE_URL + query)
+            assert resp.status_code == 200
+            return [item["id"] for item in json.loads(resp.data)["items"]]
+
+        assert ids("") == [1, 4, 5, 6]
+        assert ids("?sort=-id") == [6, 5, 4, 1]
+        assert ids("?sort=userName") == [1, 5, 4, 6]
+        assert ids("?sort=-content&contentPrefix=answer") == [6, 4, 5]
+        assert ids("?userName=user-2") == [5]
+        assert ids("?minId=2&maxId=5") == [4, 5]
+
+        assert client.get(self.RESOURCE_URL + "?sort=question_id").status_code == 400
+        assert client.get(self.RESOURCE_URL + "?minId=first").status_code == 400
+
+    def test_sort_plans(self, client):
+        """
+        Tests that the queries which sort the answers find the answers of the question with an index,
+        and read them in the order of an index instead of sorting them in memory, except for the user
+        names, which only the answers of the question are sorted by.
+        """
+        for number in (3, 2, 4):
+            client.post(self.RESOURCE_URL, json={"userName": "user-{}".format(number),
+                                                 "content": "answer {}".format(number)})
+
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if "FROM answer" in statement or "JOIN answer" in statement:
+                statements.append((statement, parameters))
+
+        for key in ("id", "userName", "content"):
+            for sort in (key, "-" + key):
+                del statements[:]
+                event.listen(Engine, "before_cursor_execute", capture)
+                try:
+                    assert client.get(self.RESOURCE_URL + "?sort=" + sort).status_code == 200
+                finally:
+                    event.remove(Engine, "before_cursor_execute", capture)
+                statement, parameters = statements[-1]
+                cursor = db.session.connection().connection.cursor()
+                plan = str(cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters).fetchall())
+                assert "SEARCH answer" in plan and "SCAN" not in plan
+                assert ("TEMP B-TREE" in plan) == (key == "userName")
+
+        plan = db.session.execute("EXPLAIN QUERY PLAN SELECT id FROM answer WHERE question_id = 1 "
+                                  "AND user_id = 1").fetchall()
+        assert "ix_answer_question_user" in str(plan)
+
     def test_post(self, client):
         valid = _get_answer_json()
 
@@ -437,6 +585,7 @@ class TestAnswersToQuestion(object):
         assert resp.status_code == 415
 
         # test with valid and see that it exists afterward
+        valid = _get_answer_json(4)
         resp = client.post(self.RESOURCE_URL, json=valid)
         body = json.loads(client.get(self.RESOURCE_URL).data)
         id = body["items"][-1]["id"]
@@ -446,7 +595,16 @@ class TestAnswersToQuestion(object):
         assert resp.status_code == 200
         body = json.loads(resp.data)
         assert body["content"] == "test-answer-content"
-        assert body["userName"] == "test-user-1"
+        assert body["userName"] == "test-user-4"
+
+        # test a resubmission, which replaces the answer in place
+        valid["content"] = "resubmitted"
+        resp = client.post(self.RESOURCE_URL, json=valid)
+        assert resp.status_code == 200
+        assert resp.headers["Location"].endswith(self.RESOURCE_URL + str(id) + "/")
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        assert len(body["items"]) == 2
+        assert body["items"][-1]["content"] == "resubmitted"
 
         # test with invalid url
         resp = client.post(self.INVALID_URL, json=valid)
@@ -501,6 +659,11 @@ class TestAnswerItem(object):
         resp = client.put(self.RESOURCE_URL, json=valid)
         assert resp.status_code == 204
 
+        # test with a user who has already answered the question
+        client.post("/api/questionnaires/1/questions/1/answers/", json=_get_answer_json(4))
+        resp = client.put(self.RESOURCE_URL, json=_get_answer_json(4))
+        assert resp.status_code == 409
+
         # test with another url
         resp = client.put(self.INVALID_URL, json=valid)
         assert resp.status_code == 404
@@ -550,3 +713,1454 @@ class TestAnswerItem(object):
         assert resp.status_code == 404
         resp = client.delete(self.MISMATCH_URL2)
         assert resp.status_code == 404
+
+
+class TestCompression(object):
+    RESOURCE_URL = "/api/questionnaires/"
+
+    def test_gzip(self, client):
+        """
+        Tests that large enough bodies are compressed with gzip when the client accepts it, and that
+        the second identical response is served from the compression cache.
+        """
+        app.config["COMPRESS_MIN_SIZE"] = 0
+        compression_cache.clear()
+        try:
+            resp = client.get(self.RESOURCE_URL, headers={"Accept-Encoding": "gzip"})
+            assert resp.status_code == 200
+            assert resp.headers["Content-Encoding"] == "gzip"
+            assert "Accept-Encoding" in resp.headers["Vary"]
+            body = json.loads(gzip.decompress(resp.data).decode())
+            assert len(body["items"]) == 2
+
+            client.get(self.RESOURCE_URL, headers={"Accept-Encoding": "gzip"})
+            assert compression_cache.hits == 1
+
+            # without Accept-Encoding the body is sent as it is
+            resp = client.get(self.RESOURCE_URL)
+            assert "Content-Encoding" not in resp.headers
+            assert len(json.loads(resp.data)["items"]) == 2
+        finally:
+            app.config["COMPRESS_MIN_SIZE"] = 512
+
+    def test_min_size(self, client):
+        """
+        Tests that bodies smaller than the threshold are not compressed.
+        """
+        resp = client.get("/api/questionnaires/9/", headers={"Accept-Encoding": "gzip, br"})
+        assert "Content-Encoding" not in resp.headers
+
+    @pytest.mark.skipif(brotli is None, reason="brotli is not installed")
+    def test_brotli(self, client):
+        """
+        Tests that brotli is preferred when the client accepts both encodings.
+        """
+        app.config["COMPRESS_MIN_SIZE"] = 0
+        try:
+            resp = client.get(self.RESOURCE_URL, headers={"Accept-Encoding": "gzip, br"})
+            assert resp.headers["Content-Encoding"] == "br"
+            assert len(json.loads(brotli.decompress(resp.data).decode())["items"]) == 2
+        finally:
+            app.config["COMPRESS_MIN_SIZE"] = 512
+
+
+class TestSearch(object):
+    RESOURCE_URL = "/api/search/"
+
+    def test_get(self, client):
+        """
+        Tests the GET method. Checks that the matching questionnaires, questions and answers are found,
+        that the results are paginated and their controls work.
+        """
+        resp = client.get(self.RESOURCE_URL + "?q=answer")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        _check_namespace(client, body)
+        assert len(body["items"]) == 3
+        for item in body["items"]:
+            assert item["type"] == "answer"
+            _check_control_get_method("self", client, item)
+
+        # every word must match, and the type can be restricted
+        resp = client.get(self.RESOURCE_URL + "?q=test questionnaire&type=questionnaire,question")
+        body = json.loads(resp.data)
+        assert sorted(item["id"] for item in body["items"]) == [1, 2]
+        assert all(item["type"] == "questionnaire" for item in body["items"])
+
+        # pagination
+        resp = client.get(self.RESOURCE_URL + "?q=test&limit=2")
+        body = json.loads(resp.data)
+        assert len(body["items"]) == 2
+        assert "prev" not in body["@controls"]
+        resp = client.get(body["@controls"]["next"]["href"])
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert len(body["items"]) == 2
+        assert "prev" in body["@controls"]
+
+        # prefix search and FTS5 syntax in the input
+        resp = client.get(self.RESOURCE_URL + "?q=questionn*")
+        assert len(json.loads(resp.data)["items"]) == 2
+        resp = client.get(self.RESOURCE_URL + '?q="NEAR(test')
+        assert resp.status_code == 200
+
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?q=test&type=user")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?q=test&page=0")
+        assert resp.status_code == 400
+
+    def test_index_follows_changes(self, client):
+        """
+        Tests that the full-text index is kept in sync when the rows are edited and deleted.
+        """
+        client.put("/api/questionnaires/2/", json={"title": "Summer picnic"})
+        body = json.loads(client.get(self.RESOURCE_URL + "?q=picnic").data)
+        assert [item["id"] for item in body["items"]] == [2]
+
+        client.delete("/api/questionnaires/2/")
+        body = json.loads(client.get(self.RESOURCE_URL + "?q=picnic").data)
+        assert body["items"] == []
+
+
+class TestEntityCache(object):
+    RESOURCE_URL = "/api/questionnaires/1/questions/1/answers/"
+
+    def test_hits(self, client):
+        """
+        Tests that the parent questionnaire and question are loaded from the database only once, and
+        that the hits are reported in the stats.
+        """
+        client.get(self.RESOURCE_URL)
+        client.get("/api/questionnaires/1/questions/")
+        before = entity_cache.stats()
+        client.get(self.RESOURCE_URL)
+        client.get("/api/questionnaires/1/questions/")
+        after = entity_cache.stats()
+        assert after["hits"] == before["hits"] + 3
+        assert after["misses"] == before["misses"]
+
+        body = json.loads(client.get("/stats/").data)
+        assert body["entity_cache"]["hits"] == after["hits"]
+
+    def test_invalidation(self, client):
+        """
+        Tests that deleted parents are not served from the cache.
+        """
+        assert client.get(self.RESOURCE_URL).status_code == 200
+        assert client.delete("/api/questionnaires/1/questions/1/").status_code == 204
+        assert client.get(self.RESOURCE_URL).status_code == 404
+
+        assert client.get("/api/questionnaires/2/questions/").status_code == 200
+        assert client.delete("/api/questionnaires/2/").status_code == 204
+        assert client.get("/api/questionnaires/2/questions/").status_code == 404
+
+    def test_expiry(self, client):
+        """
+        Tests that a parent which another worker deleted is served from the cache only until its entry
+        expires.
+        """
+        url = "/api/questionnaires/2/questions/"
+        ttl = entity_cache.ttl
+        entity_cache.ttl = 0.5
+        try:
+            assert client.get(url).status_code == 200
+            # Another worker deletes the questionnaire, so the entry of this one is not invalidated.
+            connection = sqlite3.connect(make_url(app.config["SQLALCHEMY_DATABASE_URI"]).database)
+            connection.execute("UPDATE questionnaire SET deleted = 1 WHERE id = 2")
+            connection.commit()
+            connection.close()
+            assert client.get(url).status_code == 200
+            time.sleep(0.6)
+            assert client.get(url).status_code == 404
+        finally:
+            entity_cache.ttl = ttl
+
+
+class TestPathResolution(object):
+    RESOURCE_URL = "/api/questionnaires/1/questions/1/answers/1/"
+
+    def _count_selects(self, client, method, url, **kwargs):
+        statements = []
+        thread = threading.current_thread()
+
+        # The statements of the request, which is served in this thread, on any of the engines.
+        def count(conn, cursor, statement, parameters, context, executemany):
+            if threading.current_thread() is thread and statement.lstrip().upper().startswith("SELECT"):
+                statements.append(statement)
+
+        event.listen(Engine, "before_cursor_execute", count)
+        try:
+            resp = getattr(client, method)(url, **kwargs)
+        finally:
+            event.remove(Engine, "before_cursor_execute", count)
+        return resp, len(statements)
+
+    def test_round_trips(self, client):
+        """
+        Tests that the nested item resources resolve their whole path with one query.
+        """
+        resp, selects = self._count_selects(client, "get", self.RESOURCE_URL)
+        assert resp.status_code == 200 and selects == 1
+        resp, selects = self._count_selects(client, "put", self.RESOURCE_URL, json=_get_answer_json())
+        assert resp.status_code == 204 and selects == 1
+        resp, selects = self._count_selects(client, "delete", self.RESOURCE_URL)
+        assert resp.status_code == 204 and selects == 1
+
+    def test_not_found_level(self, client):
+        """
+        Tests that the error message tells which level of the path was not found.
+        """
+        for url, missing in [("/api/questionnaires/9/questions/1/answers/1/", "questionnaire"),
+                             ("/api/questionnaires/2/questions/1/answers/1/", "question"),
+                             ("/api/questionnaires/1/questions/1/answers/2/", "answer"),
+                             ("/api/questionnaires/2/questions/1/answers/", "question")]:
+            resp = client.get(url)
+            assert resp.status_code == 404
+            message = json.loads(resp.data)["@error"]["@messages"][0]
+            assert message.startswith("No {} was found".format(missing))
+
+
+class TestAnswerChanges(object):
+    RESOURCE_URL = "/api/questionnaires/1/changes/"
+    ANSWERS_URL = "/api/questionnaires/1/questions/2/answers/"
+
+    def test_get(self, client):
+        """
+        Tests that inserts, updates and deletes of answers are returned in order after the given
+        sequence number, and that the next control continues from the last change.
+        """
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        _check_namespace(client, body)
+        assert [item["answer_id"] for item in body["items"]] == [1, 2, 3]
+        assert all(item["operation"] == "insert" for item in body["items"])
+        next_url = body["@controls"]["next"]["href"]
+
+        # nothing new yet
+        body = json.loads(client.get(next_url).data)
+        assert body["items"] == []
+
+        location = client.post(self.ANSWERS_URL, json=_get_answer_json(4)).headers["Location"]
+        client.put(location, json={"userName": "test-user-4", "content": "changed"})
+        client.delete(location)
+        client.put("/api/questionnaires/1/questions/1/answers/1/", json={"userName": "test-user-1",
+                                                                         "content": "changed"})
+        body = json.loads(client.get(next_url).data)
+        assert [item["operation"] for item in body["items"]] == ["insert", "update", "delete", "update"]
+        assert [item["answer_id"] for item in body["items"]] == [4, 4, 4, 1]
+        assert "content" not in body["items"][0]
+        assert body["items"][3]["content"] == "changed"
+        _check_control_get_method("self", client, body["items"][3])
+
+        # paginated with limit
+        body = json.loads(client.get(self.RESOURCE_URL + "?since=0&limit=2").data)
+        assert len(body["items"]) == 2
+        body = json.loads(client.get(body["@controls"]["next"]["href"]).data)
+        assert body["items"][0]["seq"] == 3
+
+        # the other questionnaire has no changes
+        body = json.loads(client.get("/api/questionnaires/2/changes/").data)
+        assert body["items"] == []
+
+        assert client.get(self.RESOURCE_URL + "?since=-1").status_code == 400
+        assert client.get("/api/questionnaires/9/changes/").status_code == 404
+
+
+class TestAnswerStream(object):
+    RESOURCE_URL = "/api/questionnaires/1/changes/stream/"
+    ANSWERS_URL = "/api/questionnaires/1/questions/2/answers/"
+
+    def test_get(self, client):
+        """
+        Tests that committed answers are pushed to the stream of their questionnaire, that idle
+        streams receive heartbeats, and that the subscription is removed when the stream is closed.
+        """
+        app.config["SSE_HEARTBEAT"] = 0.01
+        try:
+            resp = client.get(self.RESOURCE_URL, buffered=False)
+            assert resp.status_code == 200
+            assert resp.mimetype == "text/event-stream"
+            events = iter(resp.response)
+            assert next(events).startswith(b": heartbeat")
+
+            client.post(self.ANSWERS_URL, json=_get_answer_json(4))
+            client.post("/api/questionnaires/2/questions/", json=_get_question_json())
+            event = next(events).decode()
+            assert event.startswith("id: 4\nevent: answer\n")
+            data = json.loads(event.split("data: ")[1])
+            assert data["userName"] == "test-user-4" and data["question_id"] == 2
+
+            resp.close()
+            assert json.loads(client.get("/stats/").data)["answer_streams"] == 0
+        finally:
+            app.config["SSE_HEARTBEAT"] = 15
+
+    def test_resume(self, client):
+        """
+        Tests that a stream opened with Last-Event-ID starts with the answers it missed.
+        """
+        resp = client.get(self.RESOURCE_URL, headers={"Last-Event-ID": "1"}, buffered=False)
+        events = iter(resp.response)
+        assert next(events).decode().startswith("id: 2\n")
+        assert next(events).decode().startswith("id: 3\n")
+        resp.close()
+
+        assert client.get("/api/questionnaires/9/changes/stream/").status_code == 404
+
+
+class TestBatch(object):
+    RESOURCE_URL = "/api/batch/"
+    ANSWERS_URL = "/api/questionnaires/1/questions/2/answers/"
+
+    def test_post(self, client):
+        """
+        Tests that the requests of a batch are run in order and that their responses are returned
+        together, also when some of them fail.
+        """
+        resp = client.get("/api/")
+        body = json.loads(resp.data)
+        assert body["@controls"]["survey:batch"]["href"] == self.RESOURCE_URL
+
+        resp = client.post(self.RESOURCE_URL, json={"requests": [
+            {"method": "POST", "href": self.ANSWERS_URL, "body": _get_answer_json(4)},
+            {"method": "GET", "href": "/api/questionnaires/1/questions/2/answers/?sort=-id"},
+            {"method": "GET", "href": "/api/questionnaires/9/"},
+            {"method": "POST", "href": self.ANSWERS_URL, "body": {"content": "no user"}},
+        ]})
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        _check_namespace(client, body)
+        statuses = [sub["status"] for sub in body["responses"]]
+        assert statuses == [201, 200, 404, 400]
+        assert body["responses"][0]["headers"]["Location"].endswith("/answers/4/")
+        assert body["responses"][0]["body"] is None
+        assert body["responses"][1]["body"]["items"][0]["userName"] == "test-user-4"
+        assert "committed" not in body
+        assert Answer.query.count() == 4
+
+        assert client.post(self.RESOURCE_URL, data="notjson").status_code == 415
+        assert client.post(self.RESOURCE_URL, json={"requests": [{"method": "GET"}]}).status_code == 400
+        assert client.post(self.RESOURCE_URL, json={"requests": [
+            {"method": "GET", "href": "http://example.com/api/"}]}).status_code == 400
+        resp = client.post(self.RESOURCE_URL, json={"requests": [
+            {"method": "GET", "href": "/api/questionnaires/1/changes/stream/"}]})
+        assert json.loads(resp.data)["responses"][0]["status"] == 400
+
+    def test_atomic(self, client):
+        """
+        Tests that an atomic batch is committed only when all of its requests succeed.
+        """
+        resp = client.post(self.RESOURCE_URL, json={"atomic": True, "requests": [
+            {"method": "POST", "href": self.ANSWERS_URL, "body": _get_answer_json(4)},
+            {"method": "PUT", "href": "/api/questionnaires/1/", "body": {"title": "changed"}},
+            {"method": "POST", "href": self.ANSWERS_URL, "body": {"content": "no user"}},
+            {"method": "DELETE", "href": "/api/questionnaires/2/"},
+        ]})
+        body = json.loads(resp.data)
+        assert [sub["status"] for sub in body["responses"]] == [201, 204, 400]
+        assert body["committed"] is False
+        assert Answer.query.count() == 3
+        assert Questionnaire.query.get(1).title == "test-questionnaire-1"
+        assert Questionnaire.query.count() == 2
+
+        resp = client.post(self.RESOURCE_URL, json={"atomic": True, "requests": [
+            {"method": "POST", "href": self.ANSWERS_URL, "body": _get_answer_json(4)},
+            {"method": "PUT", "href": "/api/questionnaires/1/", "body": {"title": "changed"}},
+            {"method": "GET", "href": "/api/questionnaires/1/"},
+            {"method": "DELETE", "href": "/api/questionnaires/2/"},
+        ]})
+        body = json.loads(resp.data)
+        assert [sub["status"] for sub in body["responses"]] == [201, 204, 200, 204]
+        assert body["responses"][2]["body"]["title"] == "changed"
+        assert body["committed"] is True
+        job_runner.wait(10)
+        db.session.remove()
+        assert Answer.query.count() == 4
+        assert Questionnaire.query.get(1).title == "changed"
+        assert Questionnaire.query.count() == 1
+
+
+class TestMessagePack(object):
+    RESOURCE_URL = "/api/questionnaires/1/questions/2/answers/"
+    HEADERS = {"Accept": MASON_MSGPACK}
+
+    def test_get(self, client):
+        """
+        Tests that the Mason documents and the errors are encoded with MessagePack when the client
+        asks for it, and with JSON otherwise.
+        """
+        resp = client.get(self.RESOURCE_URL, headers=self.HEADERS)
+        assert resp.status_code == 200
+        assert resp.mimetype == MASON_MSGPACK
+        assert "Accept" in resp.headers["Vary"]
+        body = msgpack.unpackb(resp.data, raw=False)
+        assert body == json.loads(client.get(self.RESOURCE_URL).data)
+
+        resp = client.get(self.RESOURCE_URL, headers={"Accept": "application/vnd.mason+json, {};q=0.5".format(
+            MASON_MSGPACK)})
+        assert resp.mimetype == "application/vnd.mason+json"
+
+        resp = client.get("/api/questionnaires/9/", headers=self.HEADERS)
+        assert resp.status_code == 404
+        assert resp.mimetype == MASON_MSGPACK
+        assert msgpack.unpackb(resp.data, raw=False)["@error"]["@message"] == "Not found"
+
+    def test_post(self, client):
+        """
+        Tests that the request bodies can be encoded with MessagePack.
+        """
+        resp = client.post(self.RESOURCE_URL, data=msgpack.packb(_get_answer_json(4), use_bin_type=True),
+                           content_type=MASON_MSGPACK)
+        assert resp.status_code == 201
+        body = json.loads(client.get(resp.headers["Location"]).data)
+        assert body["userName"] == "test-user-4"
+
+        resp = client.put(resp.headers["Location"], data=msgpack.packb({"content": "changed"}, use_bin_type=True),
+                          content_type=MASON_MSGPACK)
+        assert resp.status_code == 400
+
+        resp = client.post(self.RESOURCE_URL, data=b"\xc1", content_type=MASON_MSGPACK)
+        assert resp.status_code == 400
+
+
+class TestExport(object):
+
+    def test_export(self, client):
+        """
+        Tests that the questionnaire, its questions and their answers are exported, in chunks, with the
+        question titles and the user names as categorical columns.
+        """
+        pandas = pytest.importorskip("pandas")
+        pytest.importorskip("tables")
+        from app import PathNotFound
+        from export import export_questionnaire
+
+        client.post("/api/questionnaires/1/questions/1/answers/", json=_get_answer_json(2))
+        fd, fname = tempfile.mkstemp(suffix=".h5")
+        os.close(fd)
+        try:
+            assert export_questionnaire(1, fname, chunk_size=2) == 4
+            questionnaire = pandas.read_hdf(fname, "questionnaire")
+            assert list(questionnaire["title"]) == ["test-questionnaire-1"]
+            assert list(pandas.read_hdf(fname, "questions")["id"]) == [1, 2, 3]
+
+            answers = pandas.read_hdf(fname, "answers")
+            assert list(answers["id"]) == [1, 2, 3, 4]
+            assert str(answers["userName"].dtype) == "category"
+            assert list(answers["userName"].cat.categories) == ["test-user-1", "test-user-2", "test-user-3"]
+            assert list(answers["userName"]) == ["test-user-1", "test-user-2", "test-user-3", "test-user-2"]
+            assert list(answers["question_title"]) == ["test-question-1", "test-question-2", "test-question-3",
+                                                       "test-question-1"]
+
+            assert export_questionnaire(2, fname) == 0
+            with pytest.raises(PathNotFound):
+                export_questionnaire(9, fname)
+        finally:
+            os.unlink(fname)
+
+    def test_non_ascii(self, client):
+        """
+        Tests that the answers of the longest length are exported in any chunk when their characters
+        take more than one byte.
+        """
+        pandas = pytest.importorskip("pandas")
+        pytest.importorskip("tables")
+        from export import export_questionnaire
+
+        contents = ["\u00e4" * 400, "\U0001f600" * 512]
+        for number, content in enumerate(contents, 4):
+            resp = client.post("/api/questionnaires/1/questions/1/answers/",
+                               json={"userName": "test-user-{}".format(number), "content": content})
+            assert resp.status_code == 201
+        fd, fname = tempfile.mkstemp(suffix=".h5")
+        os.close(fd)
+        try:
+            assert export_questionnaire(1, fname, chunk_size=2) == 5
+            answers = pandas.read_hdf(fname, "answers")
+            assert list(answers["content"])[3:] == contents
+        finally:
+            os.unlink(fname)
+
+    def test_concurrent_answers(self, client):
+        """
+        Tests that the answers which are committed during an export, by new users too, are not exported,
+        since the export reads one snapshot of the database.
+        """
+        pandas = pytest.importorskip("pandas")
+        pytest.importorskip("tables")
+        from export import export_questionnaire
+
+        late_users = []
+
+        def progress(fraction):
+            late_users.append("late-user-{}".format(len(late_users) + 1))
+            answer = Answer(question_id=2, content="late answer")
+            answer.userName = late_users[-1]
+            db.session.add(answer)
+            db.session.commit()
+
+        fd, fname = tempfile.mkstemp(suffix=".h5")
+        os.close(fd)
+        try:
+            assert export_questionnaire(1, fname, chunk_size=1, progress=progress) == 3
+            answers = pandas.read_hdf(fname, "answers")
+            assert list(answers["id"]) == [1, 2, 3]
+            assert list(answers["userName"].cat.categories) == ["test-user-1", "test-user-2", "test-user-3"]
+            assert Answer.query.filter_by(content="late answer").count() == len(late_users) == 3
+        finally:
+            os.unlink(fname)
+
+
+class TestJobs(object):
+    EXPORT_URL = "/api/questionnaires/1/export/"
+
+    def test_export(self, client):
+        """
+        Tests that an export runs in the background, and that its job reports the progress and the
+        location of the exported file.
+        """
+        pandas = pytest.importorskip("pandas")
+        pytest.importorskip("tables")
+        folder = tempfile.mkdtemp()
+        app.config["EXPORT_FOLDER"] = folder
+        try:
+            body = json.loads(client.get("/api/questionnaires/1/").data)
+            assert body["@controls"]["survey:export"]["href"] == self.EXPORT_URL
+            resp = client.post(self.EXPORT_URL)
+            assert resp.status_code == 202
+            job_runner.wait(10)
+
+            resp = client.get(resp.headers["Location"])
+            assert resp.status_code == 200
+            body = json.loads(resp.data)
+            _check_namespace(client, body)
+            assert body["kind"] == "export"
+            assert body["status"] == "done" and body["progress"] == 1
+            assert "survey:cancel" not in body["@controls"]
+            resp = client.get(body["@controls"]["result"]["href"])
+            assert resp.status_code == 200
+            resp.close()
+
+            assert client.post("/api/questionnaires/9/export/").status_code == 404
+            assert client.get("/api/jobs/9/").status_code == 404
+        finally:
+            app.config["EXPORT_FOLDER"] = os.path.join(app.instance_path, "exports")
+            for name in os.listdir(folder):
+                os.unlink(os.path.join(folder, name))
+            os.rmdir(folder)
+
+    def test_cancel(self, client):
+        """
+        Tests that a running job stops at its next progress report when it is cancelled, and that a
+        failed job reports its error.
+        """
+        started = threading.Event()
+
+        @job_kind("test-wait")
+        def wait_job(context, steps):
+            for step in range(steps):
+                context.progress(float(step) / steps)
+                started.set()
+                time.sleep(0.01)
+            return "/done/"
+
+        @job_kind("test-fail")
+        def fail_job(context):
+            raise ValueError("failed on purpose")
+
+        db.session.add(Job(kind="test-wait", params=json.dumps({"steps": 1000})))
+        db.session.add(Job(kind="test-fail"))
+        db.session.commit()
+        job_runner.wake()
+        assert started.wait(10)
+
+        resp = client.get("/api/jobs/1/")
+        body = json.loads(resp.data)
+        assert body["status"] == "running"
+        assert resp.headers["Retry-After"] == "1"
+        assert client.delete(body["@controls"]["survey:cancel"]["href"]).status_code == 202
+        job_runner.wait(10)
+
+        assert json.loads(client.get("/api/jobs/1/").data)["status"] == "cancelled"
+        body = json.loads(client.get("/api/jobs/2/").data)
+        assert body["status"] == "failed" and body["error"] == "failed on purpose"
+        assert client.delete("/api/jobs/2/").status_code == 409
+
+    def test_recovery(self, client):
+        """
+        Tests that the jobs which were running in a crashed process are run again, and that the queued
+        jobs are started.
+        """
+        job_kind("test-done")(lambda context: "/done/")
+        db.session.add(Job(kind="test-done", status="running", updated=datetime(2000, 1, 1)))
+        db.session.add(Job(kind="test-done"))
+        db.session.commit()
+
+        recover_jobs()
+        job_runner.wait(10)
+        db.session.remove()
+        assert [job.status for job in Job.query.order_by(Job.id)] == ["done", "done"]
+        assert Job.query.get(1).result == "/done/"
+
+    def test_required_jobs(self, client):
+        """
+        Tests that a purge can not be cancelled but is polled like the other jobs, and that a failed purge
+        is retried by the job runner after a delay until it has been run the maximum number of times.
+        """
+        db.session.add(Job(kind="purge", status="running", updated=datetime.utcnow(),
+                           params=json.dumps({"questionnaire_id": 2})))
+        db.session.commit()
+        resp = client.get("/api/jobs/1/")
+        assert "survey:cancel" not in json.loads(resp.data)["@controls"]
+        assert resp.headers["Retry-After"] == "1"
+        assert client.delete("/api/jobs/1/").status_code == 409
+        assert Job.query.get(1).cancel_requested is False
+        Job.query.filter_by(id=1).update({"status": "done"})
+        db.session.commit()
+
+        attempts = []
+
+        @job_kind("purge")
+        def failing_purge(context, questionnaire_id):
+            attempts.append(questionnaire_id)
+            if len(attempts) < 3:
+                raise ValueError("failed on purpose")
+
+        delay, max_attempts = app.config["JOB_RETRY_DELAY"], app.config["JOB_MAX_ATTEMPTS"]
+        app.config["JOB_RETRY_DELAY"] = 0.05
+        try:
+            db.session.add(Job(kind="purge", params=json.dumps({"questionnaire_id": 2})))
+            db.session.commit()
+            # The session of the test is removed before it waits, since it holds the writer connection.
+            for _ in range(100):
+                job_runner.wait(10)
+                status = Job.query.get(2).status
+                db.session.remove()
+                if status in ("done", "failed"):
+                    break
+                time.sleep(0.05)
+            job = Job.query.get(2)
+            assert job.status == "done" and job.attempts == 3 and attempts == [2, 2, 2]
+
+            app.config["JOB_MAX_ATTEMPTS"] = 1
+            db.session.add(Job(kind="purge", params=json.dumps({"questionnaire_id": 2})))
+            del attempts[:]
+            db.session.commit()
+            job_runner.wait(10)
+            db.session.remove()
+            job = Job.query.get(3)
+            assert job.status == "failed" and job.attempts == 1 and job.error == "failed on purpose"
+        finally:
+            app.config["JOB_RETRY_DELAY"], app.config["JOB_MAX_ATTEMPTS"] = delay, max_attempts
+            job_kind("purge")(purge_job)
+
+
+class TestArchive(object):
+    RESOURCE_URL = "/api/questionnaires/1/archive/"
+    READ_URLS = [
+        "/api/questionnaires/1/questions/",
+        "/api/questionnaires/1/questions/?fields=title",
+        "/api/questionnaires/1/questions/2/answers/",
+        "/api/questionnaires/1/questions/2/answers/?sort=-userName&contentPrefix=test",
+        "/api/questionnaires/1/answers/test-user-3/",
+    ]
+
+    def _archive(self, client):
+        resp = client.post(self.RESOURCE_URL)
+        assert resp.status_code == 202
+        job_runner.wait(10)
+        return json.loads(client.get(resp.headers["Location"]).data)
+
+    def test_archive(self, client):
+        """
+        Tests that the questions and answers of an archived questionnaire are moved out of their
+        tables, and that they are read from the archive like before.
+        """
+        client.post("/api/questionnaires/1/questions/2/answers/", json=_get_answer_json(4))
+        before = dict((url, json.loads(client.get(url).data)["items"]) for url in self.READ_URLS)
+        body = json.loads(client.get("/api/questionnaires/1/").data)
+        assert body["archived"] is False
+        assert body["@controls"]["survey:archive"]["href"] == self.RESOURCE_URL
+
+        body = self._archive(client)
+        assert body["kind"] == "archive" and body["status"] == "done"
+        body = json.loads(client.get(body["@controls"]["result"]["href"]).data)
+        assert body["archived"] is True
+        assert "survey:archive" not in body["@controls"]
+
+        for url in self.READ_URLS:
+            resp = client.get(url)
+            assert resp.status_code == 200
+            assert json.loads(resp.data)["items"] == before[url]
+        body = json.loads(client.get("/api/questionnaires/1/questions/2/answers/4/").data)
+        assert body["userName"] == "test-user-4"
+        assert "edit" not in body["@controls"]
+        assert client.get("/api/questionnaires/1/questions/2/answers/1/").status_code == 404
+        assert client.get("/api/questionnaires/1/questions/9/").status_code == 404
+
+        db.session.remove()
+        assert Question.query.count() == 0 and Answer.query.count() == 0
+        archive = Archive.query.get(1)
+        assert archive.question_count == 3 and archive.answer_count == 4
+        # the answers moved into the archive are not logged as deleted
+        body = json.loads(client.get("/api/questionnaires/1/changes/").data)
+        assert [item["operation"] for item in body["items"]] == ["insert"] * 4
+
+    def test_read_only(self, client):
+        """
+        Tests that the questions and answers of an archived questionnaire can not be changed, and that
+        an archived questionnaire is purged with its archive.
+        """
+        self._archive(client)
+        assert client.post(self.RESOURCE_URL).status_code == 409
+        assert client.post("/api/questionnaires/1/questions/", json=_get_question_json()).status_code == 409
+        assert client.put("/api/questionnaires/1/questions/1/", json=_get_question_json()).status_code == 409
+        assert client.delete("/api/questionnaires/1/questions/1/").status_code == 409
+        assert client.post("/api/questionnaires/1/questions/1/answers/",
+                           json=_get_answer_json(4)).status_code == 409
+        assert client.put("/api/questionnaires/1/questions/1/answers/1/",
+                          json=_get_answer_json()).status_code == 409
+        assert client.delete("/api/questionnaires/1/questions/1/answers/1/").status_code == 409
+        assert client.put("/api/questionnaires/1/", json=_get_questionnaire_json()).status_code == 204
+
+        assert client.delete("/api/questionnaires/1/").status_code == 204
+        job_runner.wait(10)
+        db.session.remove()
+        assert Archive.query.count() == 0 and Questionnaire.query.count() == 1
+
+
+class TestWriteGuard(object):
+    RESOURCE_URL = "/api/questionnaires/1/questions/"
+
+    def _change_in_other_worker(self, column):
+        # The change is not seen by the entity cache of this worker, which still has the old row.
+        connection = sqlite3.connect(make_url(app.config["SQLALCHEMY_DATABASE_URI"]).database)
+        connection.execute("UPDATE questionnaire SET {} = 1 WHERE id = 1".format(column))
+        connection.commit()
+        connection.close()
+
+    def _check_refused(self, client):
+        resp = client.post(self.RESOURCE_URL + "1/answers/", json=_get_answer_json(4))
+        assert resp.status_code == 409
+        assert json.loads(resp.data)["@error"]["@message"] == "Read only"
+        resp = client.post(self.RESOURCE_URL + "1/answers/", json=_get_answer_json(1))
+        assert resp.status_code == 409
+        assert client.post(self.RESOURCE_URL, json=_get_question_json(4)).status_code == 409
+        db.session.remove()
+        assert Answer.query.count() == 3 and Question.query.count() == 3
+        assert Answer.query.get(1).content == "test-answer"
+
+    def test_archived(self, client):
+        """
+        Tests that no question or answer is written to a questionnaire which another worker has archived,
+        when the path of the request is resolved from the entity cache.
+        """
+        assert client.get(self.RESOURCE_URL + "1/answers/").status_code == 200
+        self._change_in_other_worker("archived")
+        self._check_refused(client)
+
+    def test_deleted(self, client):
+        """
+        Tests that no question or answer is written to a questionnaire which another worker has deleted,
+        so the rows do not race its purge.
+        """
+        assert client.get(self.RESOURCE_URL + "1/answers/").status_code == 200
+        self._change_in_other_worker("deleted")
+        self._check_refused(client)
+
+
+class TestCooperativeLocking(object):
+
+    def test_writer_lock(self, client):
+        """
+        Tests that with the cooperative locking a writer waits for the transaction of another writer on
+        the writer lock, and that the lock is released by the commit. The requests are not routed, since
+        the one writer connection would serialize the writers before the lock.
+        """
+        app.config["SQLITE_COOPERATIVE_LOCKING"] = True
+        app.config["SQLITE_READ_CONNECTIONS"] = 0
+        written = threading.Event()
+        finish = threading.Event()
+
+        def write():
+            with app.app_context():
+                db.session.add(Question(questionnaire_id=2, title="locked"))
+                db.session.flush()
+                written.set()
+                finish.wait(10)
+                db.session.commit()
+                db.session.remove()
+
+        try:
+            db.session.remove()
+            waits = writer_lock.waits
+            thread = threading.Thread(target=write)
+            thread.start()
+            assert written.wait(10)
+            timer = threading.Timer(0.2, finish.set)
+            timer.start()
+            resp = client.post("/api/questionnaires/2/questions/", json=_get_question_json())
+            thread.join()
+            assert resp.status_code == 201
+            assert writer_lock.waits == waits + 1
+            assert db.session.execute("PRAGMA journal_mode").scalar() == "wal"
+            assert json.loads(client.get("/stats/").data)["writer_lock"]["waits"] == waits + 1
+        finally:
+            app.config["SQLITE_COOPERATIVE_LOCKING"] = False
+            app.config["SQLITE_READ_CONNECTIONS"] = 8
+            db.session.remove()
+
+
+class TestReadWriteRouting(object):
+
+    def test_routing(self, client):
+        """
+        Tests that the GET requests read through the read-only connections, that the other requests use
+        the writer connection, and that the readers see the committed writes.
+        """
+        read_engine, write_engine = db.get_engines()
+        with app.test_request_context("/api/", method="GET"):
+            assert db.session.get_bind() is read_engine
+            assert db.session.execute("PRAGMA journal_mode").scalar() == "wal"
+            with pytest.raises(OperationalError):
+                db.session.execute("INSERT INTO questionnaire (title, deleted, archived) VALUES ('x', 0, 0)")
+            db.session.remove()
+        with app.test_request_context("/api/", method="POST"):
+            assert db.session.get_bind() is write_engine
+            db.session.remove()
+
+        client.post("/api/questionnaires/", json=_get_questionnaire_json())
+        body = json.loads(client.get("/api/questionnaires/").data)
+        assert len(body["items"]) == 3
+
+
+class TestSharding(object):
+
+    def test_sharding(self, client):
+        """
+        Tests that the questions and answers of each questionnaire are stored in the shard of its id, that
+        the catalog follows the changes of the questionnaires, and that the search finds the rows of every
+        shard.
+        """
+        folder = tempfile.mkdtemp()
+        app.config["SHARD_URIS"] = ["sqlite:///" + os.path.join(folder, "shard-{}.db".format(i)) for i in range(2)]
+        try:
+            questions = []
+            for i in range(2):
+                resp = client.post("/api/questionnaires/", json={"title": "sharded-{}".format(i)})
+                assert resp.status_code == 201
+                questionnaire = resp.headers["Location"]
+                resp = client.post(questionnaire + "questions/", json={"title": "sharded question {}".format(i)})
+                assert resp.status_code == 201
+                questions.append(resp.headers["Location"])
+                resp = client.post(questions[-1] + "answers/", json={"content": "sharded answer",
+                                                                     "userName": "sharded-user"})
+                assert resp.status_code == 201
+
+            # The questionnaires 3 and 4 are in different shards, so their questions have the same id.
+            assert questions[0].endswith("/api/questionnaires/3/questions/1/")
+            assert questions[1].endswith("/api/questionnaires/4/questions/1/")
+            assert json.loads(client.get(questions[0]).data)["title"] == "sharded question 0"
+            assert json.loads(client.get(questions[1]).data)["title"] == "sharded question 1"
+            assert client.get("/api/questionnaires/3/questions/1/answers/1/").status_code == 200
+            for shard in range(2):
+                with routed_to(shard):
+                    assert Question.query.count() == 1
+                    assert Answer.query.count() == 1
+            with routed_to(None):
+                assert Question.query.count() == 3
+                assert Questionnaire.query.count() == 4
+
+            resp = client.put("/api/questionnaires/3/", json={"title": "renamed"})
+            assert resp.status_code == 204
+            body = json.loads(client.get("/api/questionnaires/").data)
+            assert [item["title"] for item in body["items"]][2:] == ["renamed", "sharded-1"]
+            assert [(item["question_count"], item["answer_count"]) for item in body["items"]][2:] == [(1, 1), (1, 1)]
+
+            body = json.loads(client.get("/api/search/?q=sharded&limit=3").data)
+            assert len(body["items"]) == 3
+            assert "next" in body["@controls"]
+            body = json.loads(client.get("/api/search/?q=sharded&limit=3&page=2").data)
+            assert len(body["items"]) == 2
+            assert "next" not in body["@controls"]
+            body = json.loads(client.get("/api/search/?q=sharded&type=question").data)
+            assert sorted(item["questionnaire_id"] for item in body["items"]) == [3, 4]
+
+            assert client.delete("/api/questionnaires/4/").status_code == 204
+            job_runner.wait(10)
+            body = json.loads(client.get("/api/questionnaires/").data)
+            assert len(body["items"]) == 3
+            assert client.get(questions[1]).status_code == 404
+            with routed_to(0):
+                assert Question.query.count() == 0
+            with routed_to(None):
+                assert Questionnaire.query.count() == 3
+        finally:
+            app.config["SHARD_URIS"] = []
+            db.session.remove()
+            db.dispose_engines()
+            shutil.rmtree(folder)
+
+    def test_atomic_batch(self, client):
+        """
+        Tests that an atomic batch whose requests work on more than one shard is refused without running
+        any of them, and that an atomic batch in one shard is committed.
+        """
+        folder = tempfile.mkdtemp()
+        app.config["SHARD_URIS"] = ["sqlite:///" + os.path.join(folder, "shard-{}.db".format(i)) for i in range(2)]
+        try:
+            for i in range(2):
+                resp = client.post("/api/questionnaires/", json={"title": "sharded-{}".format(i)})
+                client.post(resp.headers["Location"] + "questions/", json={"title": "sharded question"})
+
+            requests = [{"method": "POST", "href": "/api/questionnaires/{}/questions/1/answers/".format(id),
+                         "body": {"content": "batched", "userName": "batch-user"}} for id in (3, 4)]
+            resp = client.post("/api/batch/", json={"atomic": True, "requests": requests})
+            assert resp.status_code == 400
+            for shard in range(2):
+                with routed_to(shard):
+                    assert Answer.query.count() == 0
+
+            resp = client.post("/api/batch/", json={"atomic": True, "requests": requests[:1]})
+            assert json.loads(resp.data)["committed"] is True
+            resp = client.post("/api/batch/", json={"requests": requests})
+            assert [item["status"] for item in json.loads(resp.data)["responses"]] == [200, 201]
+        finally:
+            app.config["SHARD_URIS"] = []
+            db.session.remove()
+            db.dispose_engines()
+            shutil.rmtree(folder)
+
+
+class TestPublish(object):
+
+    def test_publish(self, client):
+        """
+        Tests that a published questionnaire is served from its immutable document, precompressed when
+        the client accepts it, and that it is published again with a new version when a question changes.
+        """
+        folder = tempfile.mkdtemp()
+        app.config["PUBLISH_FOLDER"] = folder
+        try:
+            assert client.get("/api/questionnaires/1/publish/").status_code == 404
+            resp = client.post("/api/questionnaires/1/publish/")
+            assert resp.status_code == 201
+            assert resp.headers["Location"].endswith("/published/questionnaire-1-v1.json")
+            body = json.loads(client.get("/api/questionnaires/1/").data)
+            assert body["@controls"]["survey:published"]["href"] == "/published/questionnaire-1-v1.json"
+            resp = client.get("/api/questionnaires/1/publish/")
+            assert resp.status_code == 302
+            assert resp.headers["Location"].endswith("/published/questionnaire-1-v1.json")
+
+            resp = client.get("/published/questionnaire-1-v1.json", headers={"Accept-Encoding": "identity"})
+            assert resp.status_code == 200
+            assert "immutable" in resp.headers["Cache-Control"]
+            assert "Content-Encoding" not in resp.headers
+            published = json.loads(resp.data)
+            assert published["version"] == 1
+            assert [item["title"] for item in published["items"]] == [
+                "test-question-1", "test-question-2", "test-question-3"]
+            resp = client.get("/published/questionnaire-1-v1.json", headers={"Accept-Encoding": "gzip"})
+            assert resp.headers["Content-Encoding"] == "gzip"
+            assert json.loads(gzip.decompress(resp.data)) == published
+
+            resp = client.put("/api/questionnaires/1/questions/1/", json={"title": "edited"})
+            assert resp.status_code == 204
+            resp = client.get("/api/questionnaires/1/publish/")
+            assert resp.headers["Location"].endswith("/published/questionnaire-1-v2.json")
+            resp = client.get("/published/questionnaire-1-v2.json", headers={"Accept-Encoding": "identity"})
+            assert json.loads(resp.data)["items"][0]["title"] == "edited"
+            resp = client.get("/published/questionnaire-1-v1.json", headers={"Accept-Encoding": "identity"})
+            assert json.loads(resp.data) == published
+
+            assert client.delete("/api/questionnaires/1/").status_code == 204
+            job_runner.wait(10)
+            assert client.get("/published/questionnaire-1-v1.json").status_code == 404
+        finally:
+            app.config["PUBLISH_FOLDER"] = os.path.join(app.instance_path, "published")
+            shutil.rmtree(folder)
+
+
+class TestSingleFlight(object):
+
+    def test_coalescing(self, client):
+        """
+        Tests that an identical GET request which arrives while the first one is running waits for it and
+        is sent its response without running any query, and that the requests are counted.
+        """
+        url = "/api/questionnaires/1/questions/"
+        threads = {}
+        statements = {"leader": 0, "follower": 0}
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_leader(conn, cursor, statement, parameters, context, executemany):
+            for name, thread in list(threads.items()):
+                if thread is threading.current_thread():
+                    statements[name] += 1
+                    if name == "leader" and "FROM question" in statement:
+                        started.set()
+                        release.wait(10)
+
+        responses = {}
+
+        def get(name):
+            responses[name] = app.test_client().get(url, headers={"Accept-Encoding": "identity"})
+
+        # The first request recovers the jobs on the writer, so it is not coalesced.
+        client.get("/api/")
+        before = single_flight.stats()
+        event.listen(Engine, "before_cursor_execute", slow_leader)
+        try:
+            threads["leader"] = threading.Thread(target=get, args=("leader",))
+            threads["leader"].start()
+            assert started.wait(10)
+            threads["follower"] = threading.Thread(target=get, args=("follower",))
+            threads["follower"].start()
+            time.sleep(0.2)
+            release.set()
+            threads["leader"].join()
+            threads["follower"].join()
+        finally:
+            event.remove(Engine, "before_cursor_execute", slow_leader)
+
+        assert responses["leader"].status_code == responses["follower"].status_code == 200
+        assert responses["leader"].data == responses["follower"].data
+        assert len(json.loads(responses["follower"].data)["items"]) == 3
+        assert statements["leader"] > 0
+        assert statements["follower"] == 0
+        after = single_flight.stats()
+        assert after["leaders"] == before["leaders"] + 1
+        assert after["coalesced"] == before["coalesced"] + 1
+        assert after["in_flight"] == 0
+        assert json.loads(client.get("/stats/").data)["single_flight"]["coalesced"] == after["coalesced"]
+
+    def test_read_your_writes(self, client):
+        """
+        Tests that a GET request which arrives after a commit does not wait for an identical request which
+        started before it, and is sent what was committed.
+        """
+        url = "/api/questionnaires/1/questions/"
+        threads = {}
+        statements = {"leader": 0, "follower": 0}
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_leader(conn, cursor, statement, parameters, context, executemany):
+            for name, thread in list(threads.items()):
+                if thread is threading.current_thread():
+                    statements[name] += 1
+                    if name == "leader" and "FROM question \n" in statement:
+                        started.set()
+                        release.wait(10)
+
+        responses = {}
+
+        def get(name):
+            responses[name] = app.test_client().get(url, headers={"Accept-Encoding": "identity"})
+
+        # The leader is held after reading the first row of the questions, so it sends the questions
+        # which were committed before the new one.
+        client.get("/api/")
+        event.listen(Engine, "after_cursor_execute", slow_leader)
+        try:
+            threads["leader"] = threading.Thread(target=get, args=("leader",))
+            threads["leader"].start()
+            assert started.wait(10)
+            assert client.post(url, json=_get_question_json()).status_code == 201
+            threads["follower"] = threading.Thread(target=get, args=("follower",))
+            threads["follower"].start()
+            time.sleep(0.2)
+            release.set()
+            threads["leader"].join()
+            threads["follower"].join()
+        finally:
+            release.set()
+            event.remove(Engine, "after_cursor_execute", slow_leader)
+
+        assert responses["leader"].status_code == responses["follower"].status_code == 200
+        assert len(json.loads(responses["leader"].data)["items"]) == 3
+        assert statements["follower"] > 0
+        assert len(json.loads(responses["follower"].data)["items"]) == 4
+        assert single_flight.stats()["in_flight"] == 0
+
+
+class TestQuestionOrder(object):
+    RESOURCE_URL = "/api/questionnaires/1/questions/"
+
+    def _move(self, client, id, after):
+        return client.post(self.RESOURCE_URL + "{}/move/".format(id), json={"after": after})
+
+    def _order(self, client):
+        return [item["id"] for item in json.loads(client.get(self.RESOURCE_URL).data)["items"]]
+
+    def test_move(self, client):
+        """
+        Tests that the questions are listed in their order, that a moved question keeps its place, and
+        that the invalid moves are refused.
+        """
+        body = json.loads(client.get(self.RESOURCE_URL + "1/").data)
+        ctrl = body["@controls"]["survey:move-question"]
+        assert ctrl["method"] == "POST" and ctrl["encoding"] == "json"
+        validate({"after": None}, ctrl["schema"])
+        validate({"after": 2}, ctrl["schema"])
+        assert self._order(client) == [1, 2, 3]
+
+        assert self._move(client, 3, None).status_code == 204
+        assert self._order(client) == [3, 1, 2]
+        assert self._move(client, 1, 2).status_code == 204
+        assert self._order(client) == [3, 2, 1]
+        client.post(self.RESOURCE_URL, json=_get_question_json())
+        assert self._order(client) == [3, 2, 1, 4]
+
+        assert self._move(client, 2, 2).status_code == 400
+        assert self._move(client, 2, 99).status_code == 400
+        assert self._move(client, 2, "1").status_code == 400
+        assert client.post(self.RESOURCE_URL + "2/move/", data=json.dumps({"after": 1})).status_code == 415
+        assert client.post("/api/questionnaires/2/questions/2/move/", json={"after": None}).status_code == 404
+        assert self._order(client) == [3, 2, 1, 4]
+
+    def test_narrow_gap(self, client):
+        """
+        Tests that the order stays right when the moves have halved the gap between two questions more
+        times than a float can.
+        """
+        for _ in range(30):
+            assert self._move(client, 3, 1).status_code == 204
+            assert self._move(client, 2, 1).status_code == 204
+        assert self._order(client) == [1, 2, 3]
+        positions = [position for position, in db.session.query(Question.position).filter_by(questionnaire_id=1)]
+        assert len(set(positions)) == 3
+
+    def test_one_row(self, client):
+        """
+        Tests that a move changes only the moved row, and that the questions are read in the order of the
+        index without sorting them.
+        """
+        positions = dict(db.session.query(Question.id, Question.position))
+        db.session.remove()
+        assert self._move(client, 3, 1).status_code == 204
+        moved = dict(db.session.query(Question.id, Question.position))
+        assert [id for id in positions if positions[id] != moved[id]] == [3]
+        assert positions[1] < moved[3] < positions[2]
+
+        plan = " ".join(row[-1] for row in db.session.execute(
+            "EXPLAIN QUERY PLAN SELECT id, title FROM question WHERE questionnaire_id = 1 ORDER BY position, id"))
+        assert "ix_question_questionnaire_position" in plan and "TEMP B-TREE" not in plan
+
+
+class TestCounters(object):
+    RESOURCE_URL = "/api/questionnaires/1/"
+
+    def _counts(self, client, url=RESOURCE_URL):
+        body = json.loads(client.get(url).data)
+        return body.get("question_count"), body["answer_count"]
+
+    def test_counts(self, client):
+        """
+        Tests that the counts of the questions and answers follow the changes and are shown in the items
+        and the collections.
+        """
+        assert self._counts(client) == (3, 3)
+        client.post(self.RESOURCE_URL + "questions/1/answers/", json=_get_answer_json(4))
+        client.post(self.RESOURCE_URL + "questions/1/answers/", json=_get_answer_json(4))
+        assert self._counts(client) == (3, 4)
+        assert self._counts(client, self.RESOURCE_URL + "questions/1/") == (None, 2)
+        client.post(self.RESOURCE_URL + "questions/", json=_get_question_json())
+        client.delete(self.RESOURCE_URL + "questions/1/")
+        assert self._counts(client) == (3, 2)
+
+        items = json.loads(client.get("/api/questionnaires/").data)["items"]
+        assert [(item["question_count"], item["answer_count"]) for item in items] == [(3, 2), (0, 0)]
+        items = json.loads(client.get(self.RESOURCE_URL + "questions/?fields=answer_count").data)["items"]
+        assert [item["answer_count"] for item in items] == [1, 1, 0]
+
+    def test_head(self, client):
+        """
+        Tests that the collections give their counts in the X-Total-Count header of HEAD requests.
+        """
+        for url, count in [("/api/questionnaires/", 2),
+                           (self.RESOURCE_URL + "questions/", 3),
+                           ("/api/questionnaires/2/questions/", 0),
+                           (self.RESOURCE_URL + "questions/1/answers/", 1),
+                           (self.RESOURCE_URL + "questions/1/answers/?userName=test-user-1", 1),
+                           (self.RESOURCE_URL + "questions/1/answers/?userName=test-user-2", 0)]:
+            resp = client.head(url)
+            assert resp.status_code == 200
+            assert resp.headers["X-Total-Count"] == str(count)
+            assert resp.data == b""
+        assert client.head("/api/questionnaires/9/questions/").status_code == 404
+        assert client.head(self.RESOURCE_URL + "questions/1/answers/?minId=x").status_code == 400
+
+    def test_reconcile(self, client):
+        """
+        Tests that the reconciliation repairs the counters which have drifted, and that an archived
+        questionnaire keeps its counts.
+        """
+        db.session.execute("UPDATE questionnaire SET answer_count = 7 WHERE id = 1")
+        db.session.execute("UPDATE question SET answer_count = 0")
+        db.session.commit()
+        assert reconcile_counters() == 4
+        assert reconcile_counters() == 0
+        assert self._counts(client) == (3, 3)
+
+        client.post(self.RESOURCE_URL + "archive/")
+        job_runner.wait(10)
+        assert Question.query.count() == 0
+        assert self._counts(client) == (3, 3)
+        assert client.head(self.RESOURCE_URL + "questions/").headers["X-Total-Count"] == "3"
+        assert self._counts(client, self.RESOURCE_URL + "questions/2/") == (None, 1)
+        assert reconcile_counters() == 0
+
+
+class TestClone(object):
+    RESOURCE_URL = "/api/questionnaires/1/clone/"
+
+    def _titles(self, client, location):
+        body = json.loads(client.get(location + "questions/").data)
+        return [item["title"] for item in body["items"]]
+
+    def _answers(self, client, location):
+        answers = []
+        for item in json.loads(client.get(location + "questions/").data)["items"]:
+            resp = client.get(location + "questions/{}/answers/".format(item["id"]))
+            answers.extend((item["title"], answer["userName"]) for answer in json.loads(resp.data)["items"])
+        return answers
+
+    def test_clone(self, client):
+        """
+        Tests that a clone copies the questionnaire with its questions in their order, with the answers
+        only when they are asked for, and that the original is not changed.
+        """
+        body = json.loads(client.get("/api/questionnaires/1/").data)
+        ctrl = body["@controls"]["survey:clone"]
+        assert ctrl["method"] == "POST" and ctrl["href"] == self.RESOURCE_URL
+        validate({"title": "rerun", "answers": True}, ctrl["schema"])
+        client.post("/api/questionnaires/1/questions/3/move/", json={"after": None})
+
+        resp = client.post(self.RESOURCE_URL)
+        assert resp.status_code == 201
+        location = resp.headers["Location"]
+        assert location.endswith("/api/questionnaires/3/")
+        body = json.loads(client.get(location).data)
+        assert body["title"] == "test-questionnaire-1" and body["description"] == "test-questionnaire"
+        assert (body["question_count"], body["answer_count"]) == (3, 0)
+        assert self._titles(client, location) == ["test-question-3", "test-question-1", "test-question-2"]
+        assert self._answers(client, location) == []
+
+        resp = client.post(self.RESOURCE_URL, json={"title": "rerun", "answers": True})
+        assert resp.status_code == 201
+        location = resp.headers["Location"]
+        body = json.loads(client.get(location).data)
+        assert body["title"] == "rerun"
+        assert (body["question_count"], body["answer_count"]) == (3, 3)
+        assert self._answers(client, location) == self._answers(client, "/api/questionnaires/1/")
+        assert self._answers(client, location)[0] == ("test-question-3", "test-user-3")
+
+        body = json.loads(client.get("/api/questionnaires/1/").data)
+        assert (body["question_count"], body["answer_count"]) == (3, 3)
+        assert client.post("/api/questionnaires/9/clone/").status_code == 404
+        assert client.post(self.RESOURCE_URL, json={"answers": "yes"}).status_code == 400
+
+    def test_clone_archived(self, client):
+        """
+        Tests that an archived questionnaire is cloned from its archive into a questionnaire which can be
+        changed.
+        """
+        client.post("/api/questionnaires/1/archive/")
+        job_runner.wait(10)
+        resp = client.post(self.RESOURCE_URL, json={"answers": True})
+        assert resp.status_code == 201
+        location = resp.headers["Location"]
+        body = json.loads(client.get(location).data)
+        assert not body["archived"] and (body["question_count"], body["answer_count"]) == (3, 3)
+        assert self._answers(client, location) == self._answers(client, "/api/questionnaires/1/")
+        assert client.post(location + "questions/", json=_get_question_json()).status_code == 201
+
+    def test_clone_sharded(self, client):
+        """
+        Tests that a questionnaire is cloned into the shard of the copy.
+        """
+        folder = tempfile.mkdtemp()
+        app.config["SHARD_URIS"] = ["sqlite:///" + os.path.join(folder, "shard-{}.db".format(i)) for i in range(2)]
+        try:
+            location = client.post("/api/questionnaires/", json=_get_questionnaire_json()).headers["Location"]
+            for i in range(2):
+                question = client.post(location + "questions/", json=_get_question_json(i)).headers["Location"]
+                client.post(question + "answers/", json=_get_answer_json(i))
+
+            resp = client.post(location + "clone/", json={"answers": True})
+            assert resp.status_code == 201
+            assert resp.headers["Location"].endswith("/api/questionnaires/4/")
+            assert self._answers(client, resp.headers["Location"]) == self._answers(client, location)
+            for shard in range(2):
+                with routed_to(shard):
+                    assert Question.query.count() == 2
+                    assert Answer.query.count() == 2
+        finally:
+            app.config["SHARD_URIS"] = []
+            db.session.remove()
+            db.dispose_engines()
+            shutil.rmtree(folder)
+
+
+class InMemory(object):
+    """
+    Runs the tests of a resource test class with the memory storage backend. The database is still
+    created, but it stays empty.
+    """
+
+    @pytest.fixture
+    def client(self):
+        db_fd, db_fname = tempfile.mkstemp()
+        app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + db_fname
+        app.config["TESTING"] = True
+        app.config["STORAGE_BACKEND"] = "memory"
+        db.create_all()
+        _populate_repository()
+
+        yield app.test_client()
+
+        repository().clear()
+        app.config["STORAGE_BACKEND"] = "sql"
+        db.session.remove()
+        os.close(db_fd)
+        os.unlink(db_fname)
+
+
+def _populate_repository():
+    """
+    Populates the repository like _populate_db.
+    """
+    memory = repository()
+    memory.clear()
+    questionnaire_id = memory.add_questionnaire("test-questionnaire-1", "test-questionnaire")
+    memory.add_questionnaire("test-questionnaire-2", "test-questionnaire")
+    questionnaire, = memory.find(questionnaire_id)
+    for i in range(1, 4):
+        question_id = memory.add_question(questionnaire, "test-question-{}".format(i), "test-question")
+        memory.save_answer(questionnaire, question_id, "test-answer", "test-user-{}".format(i))
+
+
+SQL_ONLY = pytest.mark.skip(reason="needs the sql storage backend")
+
+
+class TestQuestionnaireCollectionInMemory(InMemory, TestQuestionnaireCollection):
+    pass
+
+
+class TestQuestionnaireItemInMemory(InMemory, TestQuestionnaireItem):
+
+    @SQL_ONLY
+    def test_delete_purge(self, client):
+        pass
+
+    @SQL_ONLY
+    def test_delete_hidden(self, client):
+        pass
+
+
+class TestQuestionsByQuestionnaireInMemory(InMemory, TestQuestionsByQuestionnaire):
+    pass
+
+
+class TestQuestionItemInMemory(InMemory, TestQuestionItem):
+    pass
+
+
+class TestAnswersToQuestionInMemory(InMemory, TestAnswersToQuestion):
+
+    @SQL_ONLY
+    def test_sort_plans(self, client):
+        pass
+
+
+class TestAnswerItemInMemory(InMemory, TestAnswerItem):
+    pass
+
+
+class TestCompressionInMemory(InMemory, TestCompression):
+    pass
+
+
+class TestMessagePackInMemory(InMemory, TestMessagePack):
+    pass
+
+
+class TestQuestionOrderInMemory(InMemory, TestQuestionOrder):
+
+    @SQL_ONLY
+    def test_narrow_gap(self, client):
+        pass
+
+    @SQL_ONLY
+    def test_one_row(self, client):
+        pass
+
+
+class TestCountersInMemory(InMemory, TestCounters):
+
+    @SQL_ONLY
+    def test_reconcile(self, client):
+        pass
+
+
+class TestCloneInMemory(InMemory, TestClone):
+
+    @SQL_ONLY
+    def test_clone_archived(self, client):
+        pass
+
+    @SQL_ONLY
+    def test_clone_sharded(self, client):
+        pass
+
+
+class TestMemoryRepository(InMemory):
+
+    def test_unsupported(self, client):
+        """
+        Tests that the resources which need the database are refused with the memory backend, and that
+        their controls are not shown.
+        """
+        assert client.get("/api/search/?q=test").status_code == 501
+        assert client.post("/api/questionnaires/1/export/").status_code == 501
+        assert client.post("/api/batch/", json={"atomic": True, "requests": []}).status_code == 501
+        body = json.loads(client.get("/api/questionnaires/1/").data)
+        assert "survey:export" not in body["@controls"]
+        assert "survey:search" not in json.loads(client.get("/api/").data)["@controls"]
+
+    def test_incomplete_backend(self, client):
+        """
+        Tests that a backend which does not implement every method of the repository can not be created.
+        """
+        class PartialRepository(Repository):
+            def find(self, questionnaire_id, question_id=None, answer_id=None):
+                return repository().find(questionnaire_id, question_id, answer_id)
+
+        with pytest.raises(TypeError) as e:
+            PartialRepository()
+        assert "move_question" in str(e.value)
+
+    def test_indexes(self, client):
+        """
+        Tests that the secondary indexes follow the changes of the answers.
+        """
+        memory = repository()
+        client.post("/api/questionnaires/1/questions/1/answers/", json={"userName": "test-user-2", "content": "x"})
+        assert memory.answers_by_question[1] == {"test-user-1": 1, "test-user-2": 4}
+        assert memory.answers_by_user["test-user-2"] == {2, 4}
+        assert client.put("/api/questionnaires/1/questions/1/answers/4/",
+                          json={"userName": "test-user-5", "content": "y"}).status_code == 204
+        assert memory.answers_by_question[1] == {"test-user-1": 1, "test-user-5": 4}
+        assert memory.answers_by_user["test-user-2"] == {2}
+        resp = client.get("/api/questionnaires/1/answers/test-user-5/")
+        assert [item["content"] for item in json.loads(resp.data)["items"]] == ["y"]
+
+        assert client.delete("/api/questionnaires/1/").status_code == 204
+        assert memory.questions == {} and memory.answers == {}
+        assert list(memory.questionnaires) == [2]
+        assert client.get("/api/questionnaires/1/questions/1/answers/1/").status_code == 404